@@ -24,6 +24,10 @@ def setup_module_path():
 setup_module_path()
 
 if __name__ == "__main__":
+    # Image transcoding runs in worker processes; frozen Windows builds need this first
+    import multiprocessing
+    multiprocessing.freeze_support()
+    
     try:
         from PySide6.QtWidgets import QApplication
         
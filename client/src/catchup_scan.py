@@ -0,0 +1,147 @@
+"""
+Catch-up scan
+Finds files added to or changed in monitored folders while the client was not running
+"""
+
+import os
+import time
+import sqlite3
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from upload_queue import FILE_MANAGER_DB
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scan_manifest (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS scan_roots (
+    root TEXT PRIMARY KEY,
+    baselined_at REAL NOT NULL
+);
+"""
+
+
+def walk_files(root: str, extensions: Iterable[str]) -> Iterator[Tuple[str, int, int]]:
+    """(path, size, mtime_ns) of every matching file under `root`, via os.scandir"""
+    extensions = {ext.lower() for ext in extensions}
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = os.scandir(directory)
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif os.path.splitext(entry.name)[1].lower() in extensions and entry.is_file():
+                        stat = entry.stat()
+                        yield entry.path, stat.st_size, stat.st_mtime_ns
+                except OSError:
+                    continue
+
+
+class CatchUpScanner:
+    """
+    Reconciles monitored folders against a manifest of (path, size, mtime_ns)
+
+    The manifest is a WITHOUT ROWID table keyed by path, so one folder's rows are a
+    single range read. The first scan of a folder only records what is there; later
+    scans put files that are new or whose size or mtime changed into the
+    persistent upload queue - unless it already uploaded that exact version - and
+    only then record them in the manifest, so nothing found is lost if the client
+    is offline or quits before uploading it.
+    """
+
+    def __init__(self, upload_queue, db_path: Path = FILE_MANAGER_DB):
+        self.db_path = Path(db_path)
+        self.upload_queue = upload_queue
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+
+    def _connect(self) -> sqlite3.Connection:
+        # Scans run on their own thread, each with its own connection
+        conn = sqlite3.connect(str(self.db_path), timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        return conn
+
+    @staticmethod
+    def _prefix_range(root: str) -> Tuple[str, str]:
+        prefix = os.path.join(root, "")
+        return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+    def scan_root(self, conn: sqlite3.Connection, root: str,
+                  extensions: Iterable[str]) -> Tuple[List[str], int, bool]:
+        """Queue new/changed files of one folder, then update its manifest; returns (paths queued, files seen, was first scan)"""
+        low, high = self._prefix_range(root)
+        known: Dict[str, Tuple[int, int]] = {
+            path: (size, mtime_ns)
+            for path, size, mtime_ns in conn.execute(
+                "SELECT path, size, mtime_ns FROM scan_manifest WHERE path >= ? AND path < ?", (low, high)
+            )
+        }
+        baselined = conn.execute("SELECT 1 FROM scan_roots WHERE root = ?", (root,)).fetchone() is not None
+
+        changed = []
+        seen = 0
+        for path, size, mtime_ns in walk_files(root, extensions):
+            seen += 1
+            if known.pop(path, None) != (size, mtime_ns):
+                changed.append((path, size, mtime_ns))
+
+        queued = []
+        if baselined:
+            queued = [
+                path for path, size, mtime_ns in changed
+                if not self.upload_queue.uploaded_url(path, size, mtime_ns)
+            ]
+            # Queued before the manifest moves on: a crash in between only means they are found again
+            self.upload_queue.enqueue_many([(path, None) for path in queued])
+
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO scan_manifest (path, size, mtime_ns) VALUES (?, ?, ?)", changed
+            )
+            # Whatever is left in `known` was deleted while we weren't looking
+            conn.executemany("DELETE FROM scan_manifest WHERE path = ?", [(path,) for path in known])
+            if not baselined:
+                conn.execute("INSERT INTO scan_roots (root, baselined_at) VALUES (?, ?)", (root, time.time()))
+
+        return queued, seen, not baselined
+
+    def scan(self, roots: Iterable[str], extensions: Iterable[str]) -> Dict[str, float]:
+        """Scan every root, putting new/changed files into the upload queue"""
+        start = time.perf_counter()
+        extensions = set(extensions)
+        summary = {'roots': 0, 'baselined': 0, 'files': 0, 'queued': 0}
+        conn = self._connect()
+        try:
+            for root in roots:
+                if not os.path.isdir(root):
+                    continue
+                paths, seen, first = self.scan_root(conn, root, extensions)
+                summary['roots'] += 1
+                summary['baselined'] += int(first)
+                summary['files'] += seen
+                summary['queued'] += len(paths)
+        finally:
+            conn.close()
+        summary['seconds'] = time.perf_counter() - start
+        return summary
+
+    def forget_root(self, root: str):
+        """Drop a folder's manifest (it is no longer monitored)"""
+        low, high = self._prefix_range(root)
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM scan_manifest WHERE path >= ? AND path < ?", (low, high))
+                conn.execute("DELETE FROM scan_roots WHERE root = ?", (root,))
+        finally:
+            conn.close()
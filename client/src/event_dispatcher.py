@@ -0,0 +1,102 @@
+"""
+Coalescing event dispatcher
+One scheduler thread turns bursts of file system events into debounced, batched upload requests
+"""
+
+import heapq
+import logging
+import itertools
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Paths due within this window of each other are handed over together
+BATCH_WINDOW = 0.05
+# Upper bound on one handoff, so a huge drop doesn't block on a single callback
+MAX_BATCH = 500
+
+
+class CoalescingDispatcher:
+    """
+    Debounces events per path on a min-heap of deadlines
+
+    `schedule(path, delay)` (re)arms a path: repeated events for the same path - a
+    create followed by modifies, a rename - only move its deadline, they never add
+    work. Superseded heap entries are skipped lazily when they surface. Due paths
+    are passed to `callback(paths)` in batches from the scheduler thread.
+    """
+
+    def __init__(self, callback: Callable[[List[str]], None]):
+        self.callback = callback
+        self._cond = threading.Condition()
+        self._heap: List[Tuple[float, int, str]] = []
+        self._deadlines: Dict[str, float] = {}
+        self._counter = itertools.count()
+        self._running = False
+        self._thread = None
+
+    def __len__(self) -> int:
+        with self._cond:
+            return len(self._deadlines)
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name="event-dispatcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the scheduler; paths that were not yet due are dropped"""
+        with self._cond:
+            self._running = False
+            self._heap.clear()
+            self._deadlines.clear()
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def schedule(self, path: str, delay: float):
+        """Hand `path` over `delay` seconds from now, replacing any earlier deadline"""
+        deadline = time.monotonic() + delay
+        with self._cond:
+            self._deadlines[path] = deadline
+            heapq.heappush(self._heap, (deadline, next(self._counter), path))
+            # Only the scheduler's sleep can be too long; wake it if this is now the earliest
+            if self._heap[0][2] == path:
+                self._cond.notify()
+
+    def discard(self, path: str):
+        """Forget a pending path (e.g. it was renamed away)"""
+        with self._cond:
+            self._deadlines.pop(path, None)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                batch = self._take_due()
+                while not batch and self._running:
+                    timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                    self._cond.wait(timeout=timeout)
+                    batch = self._take_due()
+                if not self._running:
+                    return
+            try:
+                self.callback(batch)
+            except Exception:
+                logger.exception(f"Error dispatching {len(batch)} files")
+
+    def _take_due(self) -> List[str]:
+        """Pop every path due now (plus BATCH_WINDOW), skipping superseded entries"""
+        horizon = time.monotonic() + BATCH_WINDOW
+        batch = []
+        while self._heap and self._heap[0][0] <= horizon and len(batch) < MAX_BATCH:
+            deadline, _, path = heapq.heappop(self._heap)
+            if self._deadlines.get(path) == deadline:
+                del self._deadlines[path]
+                batch.append(path)
+        return batch
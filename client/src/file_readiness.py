@@ -0,0 +1,143 @@
+"""
+File readiness detection
+Decides when a newly written file is complete: from close-after-write events where the
+platform reports them (inotify IN_CLOSE_WRITE on Linux), from short stat polling elsewhere
+"""
+
+import os
+import sys
+import time
+import threading
+from typing import Dict, Optional
+
+try:
+    from watchdog.events import FileClosedEvent  # noqa: F401 - only present in watchdog >= 2.1
+    # Only the inotify observer reports closes; Windows and macOS observers never do
+    CLOSE_EVENTS_AVAILABLE = sys.platform.startswith("linux")
+except ImportError:
+    CLOSE_EVENTS_AVAILABLE = False
+
+# After a close-after-write, wait this long for a follow-up write or rename
+CLOSE_DEBOUNCE = 0.2
+# Writes seen but no close for this long (attribute-only changes also report as
+# modifications): stop waiting for a close and fall back to polling
+CLOSE_WAIT_LIMIT = 2.0
+# Polling fallback: a file untouched for this long (and openable) is complete
+QUIET_PERIOD = 0.75
+POLL_INTERVAL = 0.25
+READY_TIMEOUT = 60.0
+
+
+class ReadinessDetector:
+    """
+    Tracks write/close events per path and answers "is this file finished?"
+
+    Files whose writes were observed wait for the writer's close (plus a short
+    debounce) when close events are available. Everything else - other platforms,
+    files that were dropped in or renamed into place - is polled: ready once its
+    mtime is QUIET_PERIOD old and it can be opened.
+    """
+
+    def __init__(self, close_events: bool = CLOSE_EVENTS_AVAILABLE):
+        self.close_events = close_events
+        self._cond = threading.Condition()
+        self._last_write: Dict[str, float] = {}
+        self._closed_at: Dict[str, float] = {}
+        self._first_seen: Dict[str, float] = {}
+
+    def file_seen(self, path: str):
+        """First sighting of a path (wall clock, for time-to-URL)"""
+        with self._cond:
+            self._first_seen.setdefault(path, time.time())
+
+    def file_modified(self, path: str):
+        with self._cond:
+            self._first_seen.setdefault(path, time.time())
+            self._last_write[path] = time.monotonic()
+            self._closed_at.pop(path, None)
+            self._cond.notify_all()
+
+    def file_closed(self, path: str):
+        """The writer closed the file (IN_CLOSE_WRITE)"""
+        with self._cond:
+            self._closed_at[path] = time.monotonic()
+            self._cond.notify_all()
+
+    def file_moved(self, src_path: str, dest_path: str):
+        """A rename keeps the file's state; the old path is gone"""
+        with self._cond:
+            for state in (self._last_write, self._closed_at, self._first_seen):
+                if src_path in state:
+                    state[dest_path] = state.pop(src_path)
+            self._first_seen.setdefault(dest_path, time.time())
+            self._cond.notify_all()
+
+    def first_seen(self, path: str) -> Optional[float]:
+        return self._first_seen.get(path)
+
+    def forget(self, path: str):
+        """Drop state for a path once it has been handled"""
+        with self._cond:
+            self._last_write.pop(path, None)
+            self._closed_at.pop(path, None)
+            self._first_seen.pop(path, None)
+
+    @staticmethod
+    def _openable(path: str) -> bool:
+        try:
+            with open(path, 'rb') as f:
+                f.read(1)
+            return True
+        except PermissionError:
+            # Still held exclusively by the writer (Windows)
+            return False
+
+    def wait_until_ready(self, path: str, stop_event: Optional[threading.Event] = None,
+                         timeout: float = READY_TIMEOUT) -> bool:
+        """
+        Block until `path` is complete
+
+        Returns False on timeout or stop; raises FileNotFoundError if the file goes away
+        and PermissionError if it is still locked when the timeout expires.
+        """
+        deadline = time.monotonic() + timeout
+        stopped = (lambda: stop_event.is_set()) if stop_event is not None else (lambda: False)
+
+        if self.close_events and path in self._last_write:
+            with self._cond:
+                while not stopped():
+                    now = time.monotonic()
+                    closed = self._closed_at.get(path)
+                    if closed is not None and now - closed >= CLOSE_DEBOUNCE:
+                        break
+                    if closed is None and now - self._last_write.get(path, now) >= CLOSE_WAIT_LIMIT:
+                        break
+                    if now >= deadline:
+                        return False
+                    wait = CLOSE_DEBOUNCE - (now - closed) if closed is not None else POLL_INTERVAL
+                    self._cond.wait(timeout=max(min(wait, deadline - now), 0.01))
+                else:
+                    return False
+            if not os.path.exists(path):
+                raise FileNotFoundError(path)
+            if path in self._closed_at and self._openable(path):
+                return True
+            # No close seen, or locked again (e.g. a virus scanner) - fall through to polling
+
+        locked = False
+        while not stopped():
+            stat = os.stat(path)
+            settled = stat.st_size > 0 and time.time() - stat.st_mtime >= QUIET_PERIOD
+            if settled:
+                if self._openable(path):
+                    return True
+                locked = True
+            if time.monotonic() >= deadline:
+                if locked:
+                    raise PermissionError(path)
+                return False
+            if stop_event is not None:
+                stop_event.wait(POLL_INTERVAL)
+            else:
+                time.sleep(POLL_INTERVAL)
+        return False
@@ -0,0 +1,157 @@
+"""
+Client-side image transcoding
+Downscales and re-encodes images in a process pool before upload, per the Image settings
+"""
+
+import os
+import time
+import hashlib
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional, Tuple
+
+try:
+    from PIL import Image, ImageOps
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+TRANSCODE_DIR = Path.home() / ".custom_server_client" / "transcoded"
+# GIFs may be animated; everything else Pillow reads as a still image
+TRANSCODABLE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.bmp', '.tiff', '.tif', '.webp'}
+# Leave a core for the GUI and the uploads
+TRANSCODE_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))
+# An image that wasn't downscaled is only replaced if re-encoding saves at least this much
+MIN_SAVING = 0.1
+# Outputs not cleaned up after upload (crash, abandoned job) are removed after this long
+STALE_OUTPUT_AGE = 24 * 3600
+
+
+def _has_transparency(image) -> bool:
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        alpha = image.convert("RGBA").getchannel("A")
+        return alpha.getextrema()[0] < 255
+    return False
+
+
+def transcode_image(source: str, destination: str, max_resolution: int, quality: int) -> Optional[str]:
+    """
+    Downscale `source` to fit `max_resolution` and re-encode it (runs in a worker process)
+
+    Opaque images become JPEG at `quality`, images with real transparency stay PNG.
+    Writes `destination` plus the extension and returns that path, or None when
+    the original is already the better upload.
+    """
+    with Image.open(source) as opened:
+        image = ImageOps.exif_transpose(opened)
+        resized = max(image.size) > max_resolution
+        if resized:
+            image.thumbnail((max_resolution, max_resolution), Image.Resampling.LANCZOS)
+
+        if _has_transparency(image):
+            output = destination + ".png"
+            temp = output + ".tmp"
+            image.save(temp, "PNG", optimize=True)
+        else:
+            output = destination + ".jpg"
+            temp = output + ".tmp"
+            image.convert("RGB").save(temp, "JPEG", quality=quality, optimize=True, progressive=True)
+
+    if not resized and os.path.getsize(temp) > os.path.getsize(source) * (1 - MIN_SAVING):
+        os.remove(temp)
+        return None
+    os.replace(temp, output)
+    return output
+
+
+class ImageTranscoder:
+    """
+    Pre-upload transcode stage
+
+    Outputs are named after the source's path, size, mtime and the settings, so a
+    retried or resumed upload finds the same file (and the same resumable session)
+    instead of transcoding again. The process pool starts on first use.
+    """
+
+    def __init__(self, directory: Path = TRANSCODE_DIR, workers: int = TRANSCODE_WORKERS):
+        self.directory = Path(directory)
+        self.workers = workers
+        self.enabled = False
+        self.max_resolution = 2048
+        self.quality = 85
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def configure(self, enabled: bool, max_resolution: int = 2048, quality: int = 85):
+        """Apply the auto_resize / max_resolution / jpeg_quality settings"""
+        self.enabled = bool(enabled) and PIL_AVAILABLE
+        self.max_resolution = max_resolution
+        self.quality = quality
+        if self.enabled:
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+    def wants(self, file_path: str) -> bool:
+        return self.enabled and Path(file_path).suffix.lower() in TRANSCODABLE_EXTENSIONS
+
+    def _output_stem(self, file_path: str) -> Path:
+        stat = os.stat(file_path)
+        key = f"{Path(file_path).resolve()}|{stat.st_size}|{stat.st_mtime_ns}|{self.max_resolution}|{self.quality}"
+        return self.directory / hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def _executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self._pool
+
+    def prepare(self, file_path: str) -> Optional[Tuple[str, str]]:
+        """
+        (path to upload, filename to upload it as), or None to upload the original
+
+        Blocks until the worker process is done; any failure falls back to the original.
+        """
+        stem = self._output_stem(file_path)
+        for extension in (".jpg", ".png"):
+            cached = stem.with_name(stem.name + extension)
+            if cached.exists():
+                return str(cached), Path(file_path).stem + extension
+
+        try:
+            output = self._executor().submit(
+                transcode_image, file_path, str(stem), self.max_resolution, self.quality
+            ).result()
+        except Exception as e:
+            logger.warning(f"Could not transcode {file_path}, uploading the original: {e}")
+            return None
+        if output is None:
+            return None
+        logger.info(f"Transcoded {Path(file_path).name}: {os.path.getsize(file_path)} -> {os.path.getsize(output)} bytes")
+        return output, Path(file_path).stem + Path(output).suffix
+
+    def discard(self, upload_path: Optional[str]):
+        """Delete a transcoded output once it is no longer needed"""
+        if upload_path and Path(upload_path).parent == self.directory:
+            Path(upload_path).unlink(missing_ok=True)
+
+    def remove_stale(self) -> int:
+        """Delete outputs left behind by a crash or an abandoned upload"""
+        if not self.directory.exists():
+            return 0
+        cutoff = time.time() - STALE_OUTPUT_AGE
+        removed = 0
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    Path(entry.path).unlink(missing_ok=True)
+                    removed += 1
+        return removed
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
@@ -7,7 +7,6 @@ Beautiful modern desktop client for the Custom Server File Manager
 import sys
 import os
 import threading
-import time
 import json
 import requests
 import subprocess
@@ -37,208 +36,75 @@ from PySide6.QtGui import QFont, QDragEnterEvent, QDropEvent, QColor, QPalette,
 # Local imports
 from ui_components import ModernCard, ActionButton, StatusIndicator, FileDropZone, ModernProgressBar, NotificationCard
 from server_client import ServerManager
+from upload_engine import UploadWorker
+from file_readiness import ReadinessDetector
+from event_dispatcher import CoalescingDispatcher
+from catchup_scan import CatchUpScanner
 from settings_dialog import SettingsDialog
 
 class FileMonitorHandler(FileSystemEventHandler):
     """Enhanced file monitor for automatic uploads"""
     
-    def __init__(self, callback):
+    # Settle before handing a path to the upload worker; every further event for the
+    # path restarts it. Readiness itself is decided by the ReadinessDetector.
+    CREATED_DELAY = 0.5
+    MOVED_DELAY = 0.3
+    
+    def __init__(self, dispatcher, readiness=None):
         super().__init__()
-        self.callback = callback
+        self.dispatcher = dispatcher
+        self.readiness = readiness
         self.photo_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.tiff', '.tif'}
         self.allowed_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.tiff', '.tif', 
                                  '.mp4', '.avi', '.mov', '.wmv', '.flv', '.mkv', '.m4v',
                                  '.mp3', '.wav', '.flac', '.aac', '.ogg', '.wma',
                                  '.pdf', '.txt', '.doc', '.docx', '.zip', '.rar', '.7z'}
-        self.pending_uploads = {}  # Track files pending upload to avoid duplicates
+    
+    def _is_allowed(self, filepath):
+        return any(filepath.lower().endswith(ext) for ext in self.allowed_extensions)
         
     def on_created(self, event):
         """Handle new file creation"""
         if not event.is_directory:
             filepath = event.src_path
-            filename = os.path.basename(filepath)
             
             # Check if it's an allowed file type
-            if any(filename.lower().endswith(ext) for ext in self.allowed_extensions):
-                delay = 5.0 if any(filename.lower().endswith(ext) for ext in self.photo_extensions) else 2.0
-                self.pending_uploads[filepath] = time.time()
-                threading.Timer(delay, lambda: self._process_file(filepath)).start()
+            if self._is_allowed(filepath):
+                if self.readiness:
+                    self.readiness.file_modified(filepath)
+                self.dispatcher.schedule(filepath, self.CREATED_DELAY)
+    
+    def on_modified(self, event):
+        """Track writes so readiness waits for the writer to close the file; an edited file is uploaded again"""
+        if not event.is_directory and self._is_allowed(event.src_path):
+            if self.readiness:
+                self.readiness.file_modified(event.src_path)
+            self.dispatcher.schedule(event.src_path, self.CREATED_DELAY)
+    
+    def on_closed(self, event):
+        """Close-after-write (inotify only): the file is complete"""
+        if not event.is_directory and self.readiness and self._is_allowed(event.src_path):
+            self.readiness.file_closed(event.src_path)
     
     def on_moved(self, event):
         """Handle file move/rename events (important for VRCX which renames VRChat screenshots)"""
         if not event.is_directory:
             src_path = event.src_path
             dest_path = event.dest_path
-            filename = os.path.basename(dest_path)
             
-            if any(filename.lower().endswith(ext) for ext in self.allowed_extensions):
-                if src_path in self.pending_uploads:
-                    del self.pending_uploads[src_path]
-                
-                delay = 2.0 if any(filename.lower().endswith(ext) for ext in self.photo_extensions) else 1.0
-                self.pending_uploads[dest_path] = time.time()
-                threading.Timer(delay, lambda: self._process_file(dest_path)).start()
-    
-    def _process_file(self, filepath):
-        """Process file for upload with duplicate checking"""
-        try:
-            if filepath in self.pending_uploads:
-                del self.pending_uploads[filepath]
-                if os.path.exists(filepath):
-                    self.callback(filepath)
-        except Exception as e:
-            print(f"Error processing file {filepath}: {e}")
-            if filepath in self.pending_uploads:
-                del self.pending_uploads[filepath]
-
-class UploadWorker(QThread):
-    """Enhanced upload worker with queue management"""
-    upload_complete = Signal(str, str, str, int)  # filename, service, url, size
-    upload_failed = Signal(str, str)  # filename, error
-    upload_progress = Signal(str, int)  # status, percentage
-    
-    def __init__(self, server_manager):
-        super().__init__()
-        self.server_manager = server_manager
-        self.upload_queue = []
-        self.running = False
-        
-    def add_upload(self, filepath: str):
-        """Add file to upload queue and start worker if not running"""
-        if filepath not in [item['filepath'] for item in self.upload_queue]:
-            self.upload_queue.append({
-                'filepath': filepath,
-                'timestamp': time.time(),
-                'filename': os.path.basename(filepath)
-            })
-            
-            # Start the worker if it's not already running
-            if not self.isRunning():                self.start()
-    
-    def run(self):
-        """Process upload queue"""
-        self.running = True
-        
-        while self.running and self.upload_queue:
-            upload_item = None
-            try:
-                upload_item = self.upload_queue.pop(0)
-                filepath = upload_item['filepath']
-                filename = upload_item['filename']
-                
-                self.upload_progress.emit(f"Preparing {filename}", 10)
-                
-                if not self._wait_for_file_ready(filepath, filename):
-                    continue
-                
-                self.upload_progress.emit(f"Uploading {filename}", 50)
-                file_size = os.path.getsize(filepath)
-                  # Try to upload the file
-                result = self.server_manager.upload_file(filepath)
-                
-                # Check if upload was successful
-                if result and 'url' in result:
-                    self.upload_progress.emit(f"Completed {filename}", 100)
-                    self.upload_complete.emit(filename, "Custom Server", result['url'], file_size)
-                else:
-                    self.upload_failed.emit(filename, "Upload failed - no URL in response")
-                
-                time.sleep(0.5)  # Rate limiting
-                
-            except Exception as e:
-                # Import ServerError to handle server-specific errors
-                try:
-                    from .server_client import ServerError
-                except ImportError:
-                    try:
-                        from server_client import ServerError
-                    except ImportError:
-                        import sys
-                        current_dir = os.path.dirname(os.path.abspath(__file__))
-                        if current_dir not in sys.path:
-                            sys.path.insert(0, current_dir)
-                        from server_client import ServerError
-                
-                if upload_item:
-                    filename = upload_item['filename']
-                else:
-                    filename = "unknown file"
-                
-                if isinstance(e, ServerError):
-                    self.upload_failed.emit(filename, str(e))
-                else:
-                    self.upload_failed.emit(filename, f"Upload error: {str(e)}")
-        
-        self.running = False
-    
-    def _wait_for_file_ready(self, filepath: str, filename: str) -> bool:
-        """Wait for file to be ready for upload with enhanced stability checking"""
-        max_retries = 15
-        last_size = 0
-        stable_count = 0
-        required_stable_checks = 3
-        
-        for retry in range(max_retries):
-            try:
-                if not os.path.exists(filepath):
-                    self.upload_failed.emit(filename, "File not found")
-                    return False
-                
-                current_size = os.path.getsize(filepath)
-                
-                with open(filepath, 'rb') as test_file:
-                    test_file.read(1)
-                    if current_size > 1024 * 1024:
-                        test_file.seek(-1, 2)
-                        test_file.read(1)
-                
-                if current_size == last_size and current_size > 0:
-                    stable_count += 1
-                    if stable_count >= required_stable_checks:
-                        return True
-                else:
-                    stable_count = 0
-                    last_size = current_size
-                
-                if current_size > 5 * 1024 * 1024:
-                    wait_time = min(3 + retry * 0.5, 8)
-                else:
-                    wait_time = min(1 + retry * 0.2, 3)
-                
-                if retry < max_retries - 1:
-                    progress = 20 + retry * 4
-                    size_mb = current_size / (1024 * 1024)
-                    self.upload_progress.emit(
-                        f"Waiting for {filename} to be ready ({size_mb:.1f}MB, {stable_count}/{required_stable_checks} stable)", 
-                        min(progress, 95)
-                    )
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    return stable_count >= required_stable_checks
-                
-            except PermissionError:
-                if retry < max_retries - 1:
-                    wait_time = min(2 + retry * 0.5, 5)
-                    self.upload_progress.emit(f"File {filename} is locked, waiting...", 20 + retry * 3)
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    self.upload_failed.emit(filename, "File is locked or in use by another application")
-                    return False
-            except Exception as e:
-                self.upload_failed.emit(filename, f"File access error: {str(e)}")
-                return False
-        
-        return False
-    
-    def stop(self):
-        """Stop the upload worker gracefully"""
-        self.running = False
+            if self._is_allowed(dest_path):
+                self.dispatcher.discard(src_path)
+                if self.readiness:
+                    self.readiness.file_moved(src_path, dest_path)
+                self.dispatcher.schedule(dest_path, self.MOVED_DELAY)
 
 class ModernCustomClient(QMainWindow):
     """Modern Custom Server File Manager Client"""
     
+    # Batches of monitored files, emitted from the dispatcher and catch-up scan threads
+    auto_upload_batch = Signal(list)
+    catchup_finished = Signal(dict)
+    
     def __init__(self):
         super().__init__()
         
@@ -256,16 +122,25 @@ class ModernCustomClient(QMainWindow):
             'total_size': 0
         }
         
-        # File observer
+        # File observer and the dispatcher that debounces its events
         self.observer = None
+        self.event_dispatcher = CoalescingDispatcher(self.auto_upload_batch.emit)
+        self.auto_upload_batch.connect(self.handle_auto_uploads)
+        self.catchup_finished.connect(self.on_catchup_finished)
+        
+        # Readiness detection, fed by the file monitor and used by the upload worker
+        self.readiness = ReadinessDetector()
         
         # Upload worker
-        self.upload_worker = UploadWorker(self.server_manager)
+        self.upload_worker = UploadWorker(self.server_manager, readiness=self.readiness)
+        self.catchup_scanner = CatchUpScanner(self.upload_worker.queue)
         self.setup_worker_connections()
         
         # UI setup
         self.setup_modern_ui()
         self.load_settings()
+        self.apply_upload_settings()
+        self.upload_worker.transcoder.remove_stale()
           # Welcome
         self.show_welcome_message()
           # Try auto-connection after everything is set up
@@ -279,6 +154,7 @@ class ModernCustomClient(QMainWindow):
         self.upload_worker.upload_complete.connect(self.on_upload_success)
         self.upload_worker.upload_failed.connect(self.on_upload_failed)
         self.upload_worker.upload_progress.connect(self.on_upload_progress)
+        self.upload_worker.upload_timed.connect(self.on_upload_timed)
     
     def setup_modern_ui(self):
         """Setup beautiful modern user interface with proper scaling"""
@@ -817,10 +693,14 @@ class ModernCustomClient(QMainWindow):
         self.avg_speed_card = ModernCard("⚡ Avg Speed", "")
         self.avg_speed_card.set_value("0 MB/s")
         
+        self.time_to_url_card = ModernCard("⏱️ Time to URL", "")
+        self.time_to_url_card.set_value("-")
+        
         stats_grid.addWidget(self.total_uploads_card, 0, 0)
         stats_grid.addWidget(self.total_size_card, 0, 1)
         stats_grid.addWidget(self.success_rate_card, 1, 0)
         stats_grid.addWidget(self.avg_speed_card, 1, 1)
+        stats_grid.addWidget(self.time_to_url_card, 2, 0)
         
         scroll_layout.addLayout(stats_grid)
         scroll_layout.addStretch()
@@ -876,6 +756,7 @@ class ModernCustomClient(QMainWindow):
                 self.manage_folders_btn.setEnabled(bool(self.monitored_directories))
                 
                 self.log_activity("✅ Connected to server successfully")
+                self.resume_pending_uploads()
                 self.statusBar().showMessage(f"Connected to {server_url}")
             else:
                 self.show_connection_dialog()
@@ -935,6 +816,7 @@ class ModernCustomClient(QMainWindow):
                 self.manage_folders_btn.setEnabled(bool(self.monitored_directories))
                 
                 self.log_activity("✅ Connected to server successfully")
+                self.resume_pending_uploads()
                 self.statusBar().showMessage(f"Connected to {settings['server_url']}")
             else:
                 self.log_activity("❌ Connection failed with provided settings")
@@ -961,7 +843,8 @@ class ModernCustomClient(QMainWindow):
         
         try:
             self.observer = Observer()
-            event_handler = FileMonitorHandler(self.handle_auto_upload)
+            self.event_dispatcher.start()
+            event_handler = FileMonitorHandler(self.event_dispatcher, self.readiness)
             
             for directory in self.monitored_directories:
                 self.observer.schedule(event_handler, directory, recursive=True)
@@ -974,15 +857,45 @@ class ModernCustomClient(QMainWindow):
             
             self.log_activity(f"🔍 Started monitoring {len(self.monitored_directories)} folders")
             
+            # Pick up files that arrived while we weren't watching
+            self.start_catchup_scan(event_handler.allowed_extensions)
+            
         except Exception as e:
             self.log_activity(f"❌ Failed to start monitoring: {str(e)}")
     
+    def start_catchup_scan(self, extensions):
+        """Reconcile monitored folders against the manifest on a background thread"""
+        directories = list(self.monitored_directories)
+        
+        def scan():
+            try:
+                summary = self.catchup_scanner.scan(directories, extensions)
+                self.catchup_finished.emit(summary)
+            except Exception as e:
+                self.catchup_finished.emit({'error': str(e)})
+        
+        threading.Thread(target=scan, name="catchup-scan", daemon=True).start()
+    
+    def on_catchup_finished(self, summary: dict):
+        """Report the result of a catch-up scan and start uploading what it queued"""
+        if 'error' in summary:
+            self.log_activity(f"❌ Catch-up scan failed: {summary['error']}")
+        elif summary['queued']:
+            self.log_activity(f"🔎 Found {summary['queued']} new files from while the client was closed "
+                              f"({summary['files']} checked in {summary['seconds']:.2f}s)")
+            # Offline, they stay queued and start with the other unfinished uploads on connect
+            if self.connected:
+                self.resume_pending_uploads()
+        elif summary['baselined']:
+            self.log_activity(f"🔎 Indexed {summary['files']} existing files in {summary['baselined']} new folders")
+    
     def stop_monitoring(self):
         """Stop folder monitoring"""
         if self.observer:
             self.observer.stop()
             self.observer.join()
             self.observer = None
+        self.event_dispatcher.stop()
         
         self.monitoring = False
         self.monitoring_status.update_status("📁 Not Monitoring", "info")
@@ -1171,6 +1084,7 @@ class ModernCustomClient(QMainWindow):
                 if reply == QMessageBox.Yes:
                     self.monitored_directories.remove(folder_path)
                     self.save_setting('monitored_directories', self.monitored_directories)
+                    self.catchup_scanner.forget_root(folder_path)
                     folders_list.takeItem(folders_list.currentRow())
                     self.log_activity(f"🗑️ Removed folder from monitoring: {folder_path}")
                     
@@ -1287,14 +1201,17 @@ class ModernCustomClient(QMainWindow):
         
         self.log_activity(f"📥 Added {len(files)} files to upload queue from drop")
     
-    def handle_auto_upload(self, filepath: str):
-        """Handle automatic upload of newly created/moved files"""
+    def handle_auto_uploads(self, filepaths: list):
+        """Handle a batch of newly created/moved files from the event dispatcher"""
         if not self.connected:
-            self.log_activity("❌ Cannot upload, not connected to server")
+            self.log_activity(f"❌ Cannot upload {len(filepaths)} files, not connected to server")
             return
-          # Add to upload worker
-        self.upload_worker.add_upload(filepath)
-        self.log_activity(f"📤 Auto-uploading file: {filepath}")
+        existing = [path for path in filepaths if os.path.exists(path)]
+        added = self.upload_worker.add_uploads(existing)
+        if added == 1 and len(existing) == 1:
+            self.log_activity(f"📤 Auto-uploading file: {existing[0]}")
+        elif added:
+            self.log_activity(f"📤 Auto-uploading {added} files")
     
     def detect_vrchat_folder(self) -> Optional[str]:
         """Auto-detect VRChat screenshots folder"""
@@ -1452,6 +1369,21 @@ class ModernCustomClient(QMainWindow):
         self._settings[key] = value
         self.save_settings()
     
+    def apply_upload_settings(self):
+        """Push concurrency and image settings to the upload worker"""
+        self.upload_worker.set_max_concurrent(self.get_setting('concurrent_uploads', 3))
+        self.upload_worker.transcoder.configure(
+            self.get_setting('auto_resize', False),
+            self.get_setting('max_resolution', 2048),
+            self.get_setting('jpeg_quality', 85)
+        )
+    
+    def resume_pending_uploads(self):
+        """Restart uploads left unfinished when the client last quit"""
+        pending = self.upload_worker.resume_pending()
+        if pending:
+            self.log_activity(f"🔄 Resuming {pending} unfinished uploads")
+    
     def show_welcome_message(self):
         """Show welcome message in activity log"""
         self.log_activity("🏠 Welcome to Custom Server File Manager!")
@@ -1470,6 +1402,7 @@ class ModernCustomClient(QMainWindow):
             settings = dialog.get_settings()
             for key, value in settings.items():
                 self.save_setting(key, value)
+            self.apply_upload_settings()
             self.log_activity("⚙️ Settings updated")
             
             # Apply theme changes if color settings were modified
@@ -1514,6 +1447,12 @@ class ModernCustomClient(QMainWindow):
         # Show notification
         NotificationCard.show_success(self, f"Uploaded {filename}")
     
+    def on_upload_timed(self, filename, seconds):
+        """Record how long a file took from first seen to URL"""
+        summary = self.upload_worker.time_to_url.summary()
+        self.time_to_url_card.set_value(f"{summary['p50']:.1f}s (p95 {summary['p95']:.1f}s)")
+        self.log_activity(f"⏱️ {filename}: URL ready {seconds:.1f}s after the file appeared")
+    
     def copy_file_url(self, item):
         """Copy file URL to clipboard when item is double-clicked"""
         if item:
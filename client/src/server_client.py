@@ -6,30 +6,81 @@ Handles all server communication and API calls
 
 import requests
 import json
+import time
+import hashlib
+import threading
+from contextlib import ExitStack
 from pathlib import Path
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Iterator, Tuple
 import logging
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Upper bound for concurrent connections to the server
+UPLOAD_POOL_SIZE = 16
+
+# Files at least this big go through resumable upload sessions
+RESUMABLE_THRESHOLD = 4 * 1024 * 1024
+DEFAULT_CHUNK_SIZE = 2 * 1024 * 1024
+# Files below this size can share one /upload/batch request
+BATCH_FILE_THRESHOLD = 2 * 1024 * 1024
+BATCH_MAX_FILES = 20
+BATCH_MAX_BYTES = 16 * 1024 * 1024
+# Open upload sessions by file, so an interrupted upload resumes after a restart too
+UPLOAD_SESSIONS_FILE = Path.home() / ".custom_server_client" / "upload_sessions.json"
+
 
 class ServerError(Exception):
     """Custom exception for server-related errors"""
+
+    def __init__(self, message: str = "", status_code: Optional[int] = None,
+                 retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+    @property
+    def is_throttled(self) -> bool:
+        """True when the server asked us to slow down (429/503)"""
+        return self.status_code in (429, 503)
+
+
+class ResumableUnsupported(Exception):
+    """The server has no upload session endpoints (older version)"""
     pass
 
 
+class BatchUnsupported(Exception):
+    """The server has no batch upload endpoint (older version)"""
+    pass
+
+
+def _retry_after(response: requests.Response) -> Optional[float]:
+    """Retry-After in seconds (only the delay-seconds form is used by our server)"""
+    try:
+        return float(response.headers.get('Retry-After', ''))
+    except ValueError:
+        return None
+
+
 class ServerManager:
     """
     Manages connection and communication with the Custom Server File Manager
     """
     
+    _sessions_lock = threading.Lock()
+    
     def __init__(self):
         self.server_url = ""
         self.api_key = ""
         self.connected = False
         self.session = requests.Session()
+        # Room for parallel uploads on the shared session (default pool keeps 10 connections)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=UPLOAD_POOL_SIZE)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
         self.session.headers.update({
             'User-Agent': 'VRCPhoto2URL-Client/2.0',
             'Accept': 'application/json'
@@ -137,13 +188,14 @@ class ServerManager:
         except requests.exceptions.RequestException as e:
             raise ServerError(f"Failed to get server stats: {str(e)}")
     
-    def upload_file(self, file_path: str, progress_callback=None) -> Dict[str, Any]:
+    def upload_file(self, file_path: str, progress_callback=None, upload_name: Optional[str] = None) -> Dict[str, Any]:
         """
         Upload a file to the server
         
         Args:
             file_path: Path to the file to upload
             progress_callback: Optional callback for upload progress
+            upload_name: Filename to send instead of the file's own (e.g. for a transcoded copy)
             
         Returns:
             dict: Upload result
@@ -156,8 +208,17 @@ class ServerManager:
             if not file_path.exists():
                 raise ServerError(f"File not found: {file_path}")
             
+            # Large files go in resumable chunks so a network blip doesn't restart them from zero
+            if file_path.stat().st_size >= RESUMABLE_THRESHOLD:
+                try:
+                    return self.upload_file_resumable(file_path, progress_callback=progress_callback,
+                                                      upload_name=upload_name)
+                except ResumableUnsupported:
+                    logger.info("Server has no resumable uploads, sending the file in one request")
+            
+            upload_name = upload_name or file_path.name
             with open(file_path, 'rb') as f:
-                files = {'file': (file_path.name, f, 'application/octet-stream')}
+                files = {'file': (upload_name, f, 'application/octet-stream')}
                 
                 response = self.session.post(
                     f"{self.server_url}/upload",
@@ -168,13 +229,15 @@ class ServerManager:
                 # Accept both 200 and 201 as successful responses
                 if response.status_code in [200, 201]:
                     result = response.json()
-                    logger.info(f"Upload successful: {file_path.name} -> {result.get('url', 'no URL')}")
+                    logger.info(f"Upload successful: {upload_name} -> {result.get('url', 'no URL')}")
                     return result
                 else:
                     error_msg = f"Upload failed: {response.status_code} - {response.text}"
                     logger.error(error_msg)
-                    raise ServerError(error_msg)
+                    raise ServerError(error_msg, response.status_code, _retry_after(response))
                     
+        except ServerError:
+            raise
         except requests.exceptions.RequestException as e:
             error_msg = f"Upload failed: {str(e)}"
             logger.error(error_msg)
@@ -184,26 +247,263 @@ class ServerManager:
             logger.error(error_msg)
             raise ServerError(error_msg)
     
-    def list_files(self) -> List[Dict[str, Any]]:
+    def upload_files_batch(self, files: List[Tuple[str, Optional[str]]]) -> List[Dict[str, Any]]:
         """
-        Get list of files from server
+        Upload several small files in one request
         
+        Args:
+            files: (path, upload name or None) pairs
+            
+        Returns:
+            list: One result per file, in order - `success`, and `url` or
+            `error`/`status_code`/`retry_after`
+        """
+        if not self.connected:
+            raise ServerError("Not connected to server")
+        
+        try:
+            with ExitStack() as stack:
+                parts = []
+                for file_path, upload_name in files:
+                    file_path = Path(file_path)
+                    handle = stack.enter_context(open(file_path, 'rb'))
+                    parts.append(('files', (upload_name or file_path.name, handle, 'application/octet-stream')))
+                
+                response = self.session.post(f"{self.server_url}/upload/batch", files=parts, timeout=300)
+            
+            if response.status_code in (404, 405):
+                raise BatchUnsupported()
+            if response.status_code != 200:
+                error_msg = f"Batch upload failed: {response.status_code} - {response.text}"
+                logger.error(error_msg)
+                raise ServerError(error_msg, response.status_code, _retry_after(response))
+            
+            results = response.json()['results']
+            logger.info(f"Batch upload: {sum(1 for r in results if r['success'])}/{len(results)} files stored")
+            return results
+        
+        except (ServerError, BatchUnsupported):
+            raise
+        except requests.exceptions.RequestException as e:
+            error_msg = f"Batch upload failed: {str(e)}"
+            logger.error(error_msg)
+            raise ServerError(error_msg)
+        except Exception as e:
+            error_msg = f"Batch upload error: {str(e)}"
+            logger.error(error_msg)
+            raise ServerError(error_msg)
+    
+    def upload_file_resumable(self, file_path: str, chunk_size: Optional[int] = None,
+                              retry_attempts: int = 5, progress_callback=None,
+                              upload_name: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Upload a file through a resumable upload session
+        
+        The session is remembered per file (path, size and mtime), so a later call -
+        even after a client restart - continues from the server's offset instead of
+        starting over. Network errors are retried with back-off from the last
+        acknowledged offset.
+        
+        Args:
+            file_path: Path to the file to upload
+            chunk_size: Bytes per request (default: the server's suggestion)
+            retry_attempts: Consecutive network failures tolerated
+            progress_callback: Optional callback(bytes_sent, total_bytes)
+            upload_name: Filename to send instead of the file's own
+            
+        Returns:
+            dict: Upload result, as from upload_file
+        """
+        if not self.connected:
+            raise ServerError("Not connected to server")
+        
+        file_path = Path(file_path)
+        stat = file_path.stat()
+        size = stat.st_size
+        key = f"{self.server_url}|{file_path.resolve()}|{size}|{stat.st_mtime_ns}"
+        
+        session_id = self._upload_sessions().get(key)
+        offset = self._upload_session_offset(session_id) if session_id else None
+        if offset is None:
+            session = self._create_upload_session(file_path, size, upload_name)
+            session_id, offset = session['session_id'], 0
+            chunk_size = chunk_size or session.get('chunk_size')
+            self._remember_upload_session(key, session_id)
+        else:
+            logger.info(f"Resuming upload of {file_path.name} at {offset}/{size} bytes")
+        chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+        session_url = f"{self.server_url}/upload/sessions/{session_id}"
+        
+        failures = 0
+        with open(file_path, 'rb') as f:
+            while offset < size:
+                f.seek(offset)
+                data = f.read(chunk_size)
+                try:
+                    response = self.session.put(
+                        session_url, data=data, timeout=120,
+                        headers={'Upload-Offset': str(offset), 'Content-Type': 'application/offset+octet-stream'}
+                    )
+                except requests.exceptions.RequestException as e:
+                    failures += 1
+                    if failures > retry_attempts:
+                        raise ServerError(f"Upload failed after {failures} attempts: {str(e)}")
+                    time.sleep(min(2 ** failures, 30))
+                    # Part of the chunk may have arrived - ask where to continue
+                    try:
+                        offset = self._upload_session_offset(session_id)
+                    except requests.exceptions.RequestException:
+                        pass
+                    if offset is None:
+                        self._forget_upload_session(key)
+                        raise ServerError("Upload session expired", 404)
+                    continue
+                
+                if response.status_code == 409 and 'Upload-Offset' in response.headers:
+                    offset = int(response.headers['Upload-Offset'])
+                    continue
+                if response.status_code == 404:
+                    self._forget_upload_session(key)
+                    raise ServerError("Upload session expired", 404)
+                if response.status_code != 200:
+                    raise ServerError(f"Upload failed: {response.status_code} - {response.text}",
+                                      response.status_code, _retry_after(response))
+                
+                offset = int(response.headers.get('Upload-Offset', offset + len(data)))
+                failures = 0
+                if progress_callback:
+                    progress_callback(offset, size)
+        
+        response = self.session.post(f"{session_url}/finalize", timeout=300)
+        if response.status_code in (200, 201):
+            self._forget_upload_session(key)
+            result = response.json()
+            logger.info(f"Upload successful: {file_path.name} -> {result.get('url', 'no URL')}")
+            return result
+        if response.status_code in (404, 409):
+            # Unknown or inconsistent session - the next attempt starts fresh
+            self._forget_upload_session(key)
+        # On 503 the session is kept: retrying goes straight to finalize
+        raise ServerError(f"Upload failed: {response.status_code} - {response.text}",
+                          response.status_code, _retry_after(response))
+    
+    def _create_upload_session(self, file_path: Path, size: int, upload_name: Optional[str] = None) -> Dict[str, Any]:
+        sha256 = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha256.update(chunk)
+        
+        response = self.session.post(
+            f"{self.server_url}/upload/sessions",
+            json={'filename': upload_name or file_path.name, 'size': size, 'sha256': sha256.hexdigest()},
+            timeout=30
+        )
+        if response.status_code in (404, 405):
+            raise ResumableUnsupported()
+        if response.status_code not in (200, 201):
+            raise ServerError(f"Upload failed: {response.status_code} - {response.text}",
+                              response.status_code, _retry_after(response))
+        return response.json()
+    
+    def _upload_session_offset(self, session_id: str) -> Optional[int]:
+        """Server-side offset of an upload session, or None if it no longer exists"""
+        response = self.session.get(f"{self.server_url}/upload/sessions/{session_id}", timeout=30)
+        if response.status_code == 404:
+            return None
+        if response.status_code != 200:
+            raise ServerError(f"Upload session query failed: {response.status_code}",
+                              response.status_code, _retry_after(response))
+        return int(response.headers.get('Upload-Offset', response.json().get('offset', 0)))
+    
+    def _upload_sessions(self) -> Dict[str, str]:
+        with self._sessions_lock:
+            try:
+                return json.loads(UPLOAD_SESSIONS_FILE.read_text())
+            except (OSError, ValueError):
+                return {}
+    
+    def _update_upload_sessions(self, update):
+        with self._sessions_lock:
+            try:
+                sessions = json.loads(UPLOAD_SESSIONS_FILE.read_text())
+            except (OSError, ValueError):
+                sessions = {}
+            update(sessions)
+            try:
+                UPLOAD_SESSIONS_FILE.parent.mkdir(parents=True, exist_ok=True)
+                temp_file = UPLOAD_SESSIONS_FILE.with_suffix('.tmp')
+                temp_file.write_text(json.dumps(sessions, indent=2))
+                temp_file.replace(UPLOAD_SESSIONS_FILE)
+            except OSError as e:
+                logger.warning(f"Could not save upload sessions: {e}")
+    
+    def _remember_upload_session(self, key: str, session_id: str):
+        self._update_upload_sessions(lambda sessions: sessions.__setitem__(key, session_id))
+    
+    def _forget_upload_session(self, key: str):
+        self._update_upload_sessions(lambda sessions: sessions.pop(key, None))
+    
+    def list_files(self, limit: int = 50, **filters) -> List[Dict[str, Any]]:
+        """
+        Get the newest files from server
+        
+        Args:
+            limit: Maximum number of files to return
+            **filters: Optional file_type, uploaded_after, uploaded_before, name_prefix
+            
         Returns:
             list: List of file information
         """
+        return self.list_files_page(limit=limit, **filters).get('files', [])
+    
+    def list_files_page(self, limit: int = 50, cursor: Optional[str] = None, **filters) -> Dict[str, Any]:
+        """
+        Get one page of files from server
+        
+        Args:
+            limit: Page size (the server caps this at 500)
+            cursor: `next_cursor` from the previous page, None for the first page
+            **filters: Optional file_type, uploaded_after, uploaded_before, name_prefix
+            
+        Returns:
+            dict: files, total_count and next_cursor (None on the last page)
+        """
         if not self.connected:
             raise ServerError("Not connected to server")
+        
+        params = {'limit': limit}
+        if cursor:
+            params['cursor'] = cursor
+        params.update({key: value for key, value in filters.items() if value})
             
         try:
-            response = self.session.get(f"{self.server_url}/files", timeout=30)
+            response = self.session.get(f"{self.server_url}/files", params=params, timeout=30)
             if response.status_code == 200:
-                data = response.json()
-                return data.get('files', [])
+                return response.json()
             else:
                 raise ServerError(f"File list request failed: {response.status_code}")
         except requests.exceptions.RequestException as e:
             raise ServerError(f"Failed to get file list: {str(e)}")
     
+    def iter_files(self, page_size: int = 200, **filters) -> Iterator[Dict[str, Any]]:
+        """
+        Walk the whole library page by page, newest first
+        
+        Args:
+            page_size: Files fetched per request
+            **filters: Optional file_type, uploaded_after, uploaded_before, name_prefix
+            
+        Yields:
+            dict: File information
+        """
+        cursor = None
+        while True:
+            page = self.list_files_page(limit=page_size, cursor=cursor, **filters)
+            yield from page.get('files', [])
+            cursor = page.get('next_cursor')
+            if not cursor:
+                break
+    
     def delete_file(self, file_id: str) -> bool:
         """
         Delete a file from the server
@@ -223,30 +523,79 @@ class ServerManager:
         except requests.exceptions.RequestException as e:
             raise ServerError(f"Failed to delete file: {str(e)}")
     
-    def download_file(self, file_id: str, save_path: str) -> bool:
+    def download_file(self, file_id: str, save_path: str, resume: bool = True,
+                      retry_attempts: int = 3, progress_callback=None) -> bool:
         """
         Download a file from the server
         
+        Data is written to `<save_path>.part` and renamed into place when complete.
+        With `resume`, an existing partial file is continued with a Range request
+        (guarded by If-Range so a changed file restarts from zero), and network
+        errors are retried from wherever the transfer stopped.
+        
         Args:
             file_id: ID of the file to download
             save_path: Path where to save the downloaded file
+            resume: Continue from an existing partial download
+            retry_attempts: Extra attempts after a network error
+            progress_callback: Optional callback(bytes_received, total_bytes)
             
         Returns:
             bool: True if download successful
         """
         if not self.connected:
             raise ServerError("Not connected to server")
-            
-        try:
-            response = self.session.get(f"{self.server_url}/files/{file_id}", timeout=300)
-            if response.status_code == 200:
-                with open(save_path, 'wb') as f:
-                    f.write(response.content)
+        
+        save_path = Path(save_path)
+        part_path = save_path.with_name(save_path.name + ".part")
+        etag_path = save_path.with_name(save_path.name + ".part.etag")
+        if not resume:
+            part_path.unlink(missing_ok=True)
+            etag_path.unlink(missing_ok=True)
+        
+        for attempt in range(retry_attempts + 1):
+            try:
+                self._download_to_part(file_id, part_path, etag_path, progress_callback)
+                part_path.replace(save_path)
+                etag_path.unlink(missing_ok=True)
                 return True
-            else:
+            except requests.exceptions.RequestException as e:
+                if attempt >= retry_attempts:
+                    raise ServerError(f"Failed to download file: {str(e)}")
+                logger.warning(f"Download of {file_id} interrupted ({e}), resuming")
+    
+    def _download_to_part(self, file_id: str, part_path: Path, etag_path: Path, progress_callback=None):
+        """Fetch (the rest of) a file into `part_path`"""
+        offset = part_path.stat().st_size if part_path.exists() else 0
+        etag = etag_path.read_text().strip() if etag_path.exists() else ""
+        
+        headers = {}
+        if offset and etag:
+            headers['Range'] = f"bytes={offset}-"
+            headers['If-Range'] = etag
+        
+        with self.session.get(f"{self.server_url}/files/{file_id}", headers=headers,
+                              stream=True, timeout=300) as response:
+            if response.status_code == 416:
+                # Nothing left to fetch - the partial file is already complete
+                return
+            if response.status_code == 200:
+                # Full body: the server ignored the range or the file changed
+                offset = 0
+            elif response.status_code != 206:
                 raise ServerError(f"Download failed: {response.status_code}")
-        except requests.exceptions.RequestException as e:
-            raise ServerError(f"Failed to download file: {str(e)}")
+            
+            if response.headers.get('ETag'):
+                etag_path.write_text(response.headers['ETag'])
+            
+            total = offset + int(response.headers.get('Content-Length', 0))
+            received = offset
+            with open(part_path, 'ab' if offset else 'wb') as f:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    f.write(chunk)
+                    received += len(chunk)
+                    if progress_callback:
+                        progress_callback(received, total)
     
     def get_file_url(self, file_id: str) -> str:
         """
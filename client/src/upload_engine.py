@@ -0,0 +1,419 @@
+"""
+Parallel upload engine for the desktop client
+Jobs from the persistent upload queue go through readiness checks and uploads concurrently,
+bounded by an adaptive concurrency window
+"""
+
+import os
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Callable, Dict, Any, List
+
+from PySide6.QtCore import QThread, Signal
+
+from server_client import (
+    ServerError, BatchUnsupported, UPLOAD_POOL_SIZE, BATCH_FILE_THRESHOLD, BATCH_MAX_FILES, BATCH_MAX_BYTES
+)
+from file_readiness import ReadinessDetector
+from upload_queue import UploadQueue
+from image_transcoder import ImageTranscoder
+
+# Files waiting for their writer to finish are checked this many at a time
+READINESS_WORKERS = 8
+# Time-to-URL samples kept for the statistics percentiles
+TIME_TO_URL_SAMPLES = 200
+# Jobs taken from the persistent queue at a time (the rest stay pending on disk)
+MAX_CLAIMED = 64
+# Back-off used when a 429/503 carries no Retry-After
+DEFAULT_BACKOFF = 5.0
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD window for in-flight uploads
+
+    The window grows by one after `increase_after` consecutive successes (up to
+    `max_limit`) and halves when the server answers 429/503, which also pauses new
+    uploads for the Retry-After delay.
+    """
+
+    def __init__(self, max_limit: int, initial: Optional[int] = None, increase_after: int = 4):
+        self.max_limit = max(1, max_limit)
+        self.limit = max(1, min(initial or self.max_limit, self.max_limit))
+        self.increase_after = increase_after
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self._successes = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, keep_waiting: Callable[[], bool]) -> bool:
+        """Block until an upload may start; False if `keep_waiting()` turns false first"""
+        with self._cond:
+            while keep_waiting():
+                pause = self.paused_until - time.monotonic()
+                if pause <= 0 and self.in_flight < self.limit:
+                    self.in_flight += 1
+                    return True
+                self._cond.wait(timeout=min(pause, 0.5) if pause > 0 else 0.5)
+            return False
+
+    def release(self):
+        with self._cond:
+            self.in_flight = max(self.in_flight - 1, 0)
+            self._cond.notify_all()
+
+    def on_success(self):
+        with self._cond:
+            self._successes += 1
+            if self._successes >= self.increase_after and self.limit < self.max_limit:
+                self.limit += 1
+                self._successes = 0
+                self._cond.notify_all()
+
+    def on_throttled(self, retry_after: Optional[float] = None):
+        with self._cond:
+            self._successes = 0
+            self.limit = max(1, self.limit // 2)
+            delay = retry_after if retry_after is not None else DEFAULT_BACKOFF
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+    def set_max_limit(self, max_limit: int):
+        with self._cond:
+            self.max_limit = max(1, max_limit)
+            self.limit = min(self.limit, self.max_limit)
+            self._cond.notify_all()
+
+
+class TimeToUrlStats:
+    """Recent time-to-URL samples: seconds from a file being first seen to its URL being known"""
+
+    def __init__(self, max_samples: int = TIME_TO_URL_SAMPLES):
+        self._samples = deque(maxlen=max_samples)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(max(seconds, 0.0))
+
+    def percentile(self, pct: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        index = min(int(round(pct / 100 * (len(samples) - 1))), len(samples) - 1)
+        return samples[index]
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            count = len(self._samples)
+            last = self._samples[-1] if count else None
+        return {
+            'count': count,
+            'last': last,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+        }
+
+
+class UploadWorker(QThread):
+    """Upload engine: parallel readiness checks and uploads over the shared server session"""
+    upload_complete = Signal(str, str, str, int)  # filename, service, url, size
+    upload_failed = Signal(str, str)  # filename, error
+    upload_progress = Signal(str, int)  # status, percentage
+    file_progress = Signal(str, str, int)  # filepath, status, percentage
+    upload_timed = Signal(str, float)  # filename, seconds from first seen to URL
+
+    def __init__(self, server_manager, max_concurrent: int = 3,
+                 readiness: Optional[ReadinessDetector] = None,
+                 upload_queue: Optional[UploadQueue] = None,
+                 transcoder: Optional[ImageTranscoder] = None):
+        super().__init__()
+        self.server_manager = server_manager
+        # Shared with the file monitor, which feeds it write/close events
+        self.readiness = readiness or ReadinessDetector()
+        self.queue = upload_queue or UploadQueue()
+        # Disabled until configured from the auto_resize setting
+        self.transcoder = transcoder or ImageTranscoder()
+        self.batch_uploads = True  # cleared if the server has no /upload/batch
+        self.time_to_url = TimeToUrlStats()
+        self.limiter = AdaptiveConcurrencyLimiter(max_concurrent)
+        self.running = False
+        self._stop_event = threading.Event()
+        # Set when jobs are added; the idle dispatch loop sleeps on it
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._claimed = 0  # jobs being checked, waiting for a slot or uploading
+        self._ready: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+
+    @property
+    def pending_count(self) -> int:
+        return self.queue.unfinished_count()
+
+    def set_max_concurrent(self, max_concurrent: int):
+        """Change the upper bound of the concurrency window (settings change)"""
+        self.limiter.set_max_limit(max_concurrent)
+
+    def add_upload(self, filepath: str):
+        """Add file to upload queue and start worker if not running"""
+        if self.queue.enqueue(filepath, self.readiness.first_seen(filepath)) is None:
+            return  # already queued
+        self._ensure_running()
+
+    def add_uploads(self, filepaths: List[str]) -> int:
+        """Queue a batch of files in one transaction; returns how many were new"""
+        added = self.queue.enqueue_many([(path, self.readiness.first_seen(path)) for path in filepaths])
+        if added:
+            self._ensure_running()
+        return added
+
+    def resume_pending(self) -> int:
+        """
+        Pick up jobs left over from a previous run
+
+        Returns the number of unfinished jobs (0 if the worker is already running them).
+        """
+        if self.isRunning():
+            # Jobs may have been queued directly (catch-up scan)
+            self._wake.set()
+            return 0
+        self.queue.recover()
+        self.queue.prune()
+        count = self.queue.unfinished_count()
+        if count:
+            self._ensure_running()
+        return count
+
+    def _ensure_running(self):
+        self._wake.set()
+        if not self.isRunning():
+            self._stop_event.clear()
+            self.start()
+
+    def run(self):
+        """Dispatch loop: due jobs go through a readiness pool, then wait for an upload slot"""
+        self.running = True
+        with ThreadPoolExecutor(max_workers=READINESS_WORKERS, thread_name_prefix="upload-ready") as ready_pool, \
+                ThreadPoolExecutor(max_workers=UPLOAD_POOL_SIZE, thread_name_prefix="upload") as upload_pool:
+            while self.running:
+                self._wake.clear()
+                # New and retried jobs start their readiness checks alongside running uploads
+                with self._lock:
+                    room = MAX_CLAIMED - self._claimed
+                for job in self.queue.claim(room):
+                    with self._lock:
+                        self._claimed += 1
+                    ready_pool.submit(self._prepare, self._job_item(job))
+
+                try:
+                    item = self._ready.get(timeout=0.2)
+                except queue.Empty:
+                    self._sleep_while_idle()
+                    continue
+
+                # The limiter, not the pool size, bounds how many uploads run at once
+                if not self.limiter.acquire(lambda: self.running):
+                    break
+                # Small files waiting together share one request and one slot
+                batch = self._take_batch(item)
+                if len(batch) > 1:
+                    upload_pool.submit(self._upload_batch, batch)
+                else:
+                    upload_pool.submit(self._upload, item)
+
+            self._stop_event.set()
+
+        # Jobs claimed but not uploaded go back to pending; they resume on the next run
+        while not self._ready.empty():
+            self._ready.get_nowait()
+        self.queue.recover()
+        with self._lock:
+            self._claimed = 0
+        self.running = False
+
+    def _sleep_while_idle(self):
+        """With nothing claimed, sleep until a job is added or the next retry is due"""
+        with self._lock:
+            if self._claimed or not self._ready.empty():
+                return
+        due = self.queue.next_due()
+        self._wake.wait(None if due is None else max(due - time.time(), 0))
+
+    @staticmethod
+    def _job_item(job: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            'job_id': job['job_id'],
+            'filepath': job['path'],
+            'filename': os.path.basename(job['path']),
+            'first_seen': job['first_seen'],
+            'attempts': job['attempts'],
+        }
+
+    def _finish(self, item: Dict[str, Any]):
+        self.readiness.forget(item['filepath'])
+        with self._lock:
+            self._claimed = max(self._claimed - 1, 0)
+
+    def _fail(self, item: Dict[str, Any], error: str):
+        """Permanent failure: retrying would not help"""
+        self.queue.fail(item['job_id'], error)
+        self.transcoder.discard(item.get('upload_path'))
+        self.upload_failed.emit(item['filename'], error)
+        self._finish(item)
+
+    def _retry(self, item: Dict[str, Any], error: str, delay: Optional[float] = None):
+        """Reschedule with backoff; reported as failed once the attempts run out"""
+        if self.queue.retry(item['job_id'], error, delay):
+            self._emit_progress(item['filepath'], f"Will retry {item['filename']}: {error}", 40)
+        else:
+            self.upload_failed.emit(item['filename'], error)
+        self._finish(item)
+
+    def _prepare(self, item: Dict[str, Any]):
+        filepath = item['filepath']
+        filename = item['filename']
+        try:
+            self._emit_progress(filepath, f"Preparing {filename}", 10)
+            if not self.readiness.wait_until_ready(filepath, self._stop_event):
+                if not self._stop_event.is_set():
+                    self._retry(item, "Timed out waiting for file to be ready")
+                # On stop the job stays in flight and is recovered when the worker exits
+                return
+
+            item['size'], item['mtime_ns'] = UploadQueue.file_version(filepath)
+            url = self.queue.uploaded_url(filepath, item['size'], item['mtime_ns'])
+            if url:
+                self.queue.complete(item['job_id'], url, item['size'], item['mtime_ns'])
+                self._emit_progress(filepath, f"Already uploaded {filename}", 100)
+                self._finish(item)
+                return
+
+            item['upload_path'], item['upload_name'] = filepath, None
+            if self.transcoder.wants(filepath):
+                self._emit_progress(filepath, f"Optimizing {filename}", 30)
+                prepared = self.transcoder.prepare(filepath)
+                if prepared:
+                    item['upload_path'], item['upload_name'] = prepared
+            item['upload_size'] = os.path.getsize(item['upload_path'])
+            self._ready.put(item)
+        except FileNotFoundError:
+            self._fail(item, "File not found")
+        except PermissionError:
+            self._retry(item, "File is locked or in use by another application")
+        except Exception as e:
+            self._fail(item, f"File access error: {str(e)}")
+
+    def _upload(self, item: Dict[str, Any]):
+        filepath = item['filepath']
+        filename = item['filename']
+        try:
+            self._emit_progress(filepath, f"Uploading {filename}", 50)
+            result = self.server_manager.upload_file(item['upload_path'], upload_name=item['upload_name'])
+            self.limiter.on_success()
+            self._uploaded(item, result)
+        except ServerError as e:
+            if e.is_throttled:
+                self.limiter.on_throttled(e.retry_after)
+            self._upload_error(item, e)
+        except Exception as e:
+            self._retry(item, f"Upload error: {str(e)}")
+        finally:
+            self.limiter.release()
+
+    def _upload_batch(self, items: List[Dict[str, Any]]):
+        """Several small files in one request; each gets its own result"""
+        try:
+            for item in items:
+                self._emit_progress(item['filepath'], f"Uploading {item['filename']}", 50)
+            results = self.server_manager.upload_files_batch(
+                [(item['upload_path'], item['upload_name']) for item in items]
+            )
+        except BatchUnsupported:
+            # Older server: go back to one request per file
+            self.batch_uploads = False
+            for item in items:
+                self._ready.put(item)
+            return
+        except ServerError as e:
+            if e.is_throttled:
+                self.limiter.on_throttled(e.retry_after)
+            for item in items:
+                self._upload_error(item, e)
+            return
+        except Exception as e:
+            for item in items:
+                self._retry(item, f"Upload error: {str(e)}")
+            return
+        finally:
+            self.limiter.release()
+
+        throttled = None
+        for item, result in zip(items, results):
+            if result.get('success'):
+                self._uploaded(item, result)
+                continue
+            error = ServerError(result.get('error') or "Upload failed", result.get('status_code'), result.get('retry_after'))
+            if error.is_throttled:
+                throttled = error
+            self._upload_error(item, error)
+        if throttled is not None:
+            self.limiter.on_throttled(throttled.retry_after)
+        else:
+            self.limiter.on_success()
+
+    def _uploaded(self, item: Dict[str, Any], result: Optional[Dict[str, Any]]):
+        filepath = item['filepath']
+        filename = item['filename']
+        # Check if upload was successful
+        if result and 'url' in result:
+            self.queue.complete(item['job_id'], result['url'], item['size'], item['mtime_ns'])
+            self.transcoder.discard(item['upload_path'])
+            elapsed = time.time() - item['first_seen']
+            self.time_to_url.record(elapsed)
+            self._emit_progress(filepath, f"Completed {filename}", 100)
+            self.upload_complete.emit(filename, "Custom Server", result['url'], item['upload_size'])
+            self.upload_timed.emit(filename, elapsed)
+            self._finish(item)
+        else:
+            self._fail(item, "Upload failed - no URL in response")
+
+    def _upload_error(self, item: Dict[str, Any], error: ServerError):
+        if error.is_throttled:
+            self._retry(item, str(error), error.retry_after if error.retry_after is not None else DEFAULT_BACKOFF)
+        elif error.status_code is not None and 400 <= error.status_code < 500:
+            # Rejected (too large, type not allowed, ...) - the same request would fail again
+            self._fail(item, str(error))
+        else:
+            self._retry(item, str(error))
+
+    def _take_batch(self, first: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """`first` plus other small files already waiting, up to the batch limits"""
+        if not self.batch_uploads or first['upload_size'] >= BATCH_FILE_THRESHOLD:
+            return [first]
+        batch, total, deferred = [first], first['upload_size'], []
+        while len(batch) < BATCH_MAX_FILES:
+            try:
+                item = self._ready.get_nowait()
+            except queue.Empty:
+                break
+            if item['upload_size'] < BATCH_FILE_THRESHOLD and total + item['upload_size'] <= BATCH_MAX_BYTES:
+                batch.append(item)
+                total += item['upload_size']
+            else:
+                deferred.append(item)
+        for item in deferred:
+            self._ready.put(item)
+        return batch
+
+    def _emit_progress(self, filepath: str, status: str, percentage: int):
+        self.file_progress.emit(filepath, status, percentage)
+        self.upload_progress.emit(status, percentage)
+
+    def stop(self):
+        """Stop the upload worker gracefully (in-flight uploads finish, queued jobs stay in the queue)"""
+        self.running = False
+        self._stop_event.set()
+        self._wake.set()
+        self.transcoder.shutdown()
@@ -0,0 +1,230 @@
+"""
+Persistent upload queue
+Crash-safe SQLite job queue for the upload engine, stored in ~/.custom_server_client/file_manager.db
+"""
+
+import os
+import time
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Optional, List, Dict, Any, Tuple
+
+FILE_MANAGER_DB = Path.home() / ".custom_server_client" / "file_manager.db"
+
+PENDING = "pending"
+IN_FLIGHT = "in_flight"
+DONE = "done"
+FAILED = "failed"
+
+# Attempts before a job is marked failed for good
+MAX_ATTEMPTS = 6
+# Exponential backoff: BASE_BACKOFF * 2**(attempts-1), capped
+BASE_BACKOFF = 2.0
+MAX_BACKOFF = 300.0
+# Finished jobs older than this are pruned on startup
+KEEP_FINISHED_DAYS = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS upload_jobs (
+    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    path TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    size INTEGER,
+    mtime_ns INTEGER,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL DEFAULT 0,
+    first_seen REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    last_error TEXT,
+    url TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_upload_jobs_active_version
+    ON upload_jobs(path, IFNULL(size, -1), IFNULL(mtime_ns, -1)) WHERE state IN ('pending', 'in_flight');
+CREATE INDEX IF NOT EXISTS idx_upload_jobs_due ON upload_jobs(state, next_attempt_at);
+CREATE INDEX IF NOT EXISTS idx_upload_jobs_version ON upload_jobs(path, size, mtime_ns);
+"""
+
+
+def backoff_delay(attempts: int) -> float:
+    """Delay before retry number `attempts` (1-based)"""
+    return min(BASE_BACKOFF * (2 ** max(attempts - 1, 0)), MAX_BACKOFF)
+
+
+class UploadQueue:
+    """
+    Durable upload jobs
+
+    Each version (size, mtime) of a path has at most one unfinished (pending or
+    in-flight) job, enforced by a partial unique index, so enqueueing is an indexed
+    insert rather than a scan - and a file rewritten while its upload is running
+    gets a job of its own. Jobs that were in flight when the client quit or crashed
+    go back to pending on `recover()`. A finished job remembers the (size, mtime) it
+    uploaded, so the same version of a file is not uploaded twice.
+    """
+
+    def __init__(self, db_path: Path = FILE_MANAGER_DB):
+        self.db_path = Path(db_path)
+        self._local = threading.local()
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        """Per-thread connection (sqlite3 connections must not be shared across threads)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.db_path), timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def enqueue(self, path: str, first_seen: Optional[float] = None) -> Optional[int]:
+        """Add a pending job; None if this version of the file already has an unfinished one"""
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO upload_jobs (path, state, size, mtime_ns, first_seen, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (path, PENDING, *self._current_version(path), first_seen or now, now)
+            )
+        return cursor.lastrowid if cursor.rowcount else None
+
+    def enqueue_many(self, jobs: List[Tuple[str, Optional[float]]]) -> int:
+        """Add pending jobs for (path, first_seen) pairs in one transaction; returns how many were new"""
+        now = time.time()
+        rows = [(path, PENDING, *self._current_version(path), first_seen or now, now) for path, first_seen in jobs]
+        conn = self._connect()
+        with conn:
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO upload_jobs (path, state, size, mtime_ns, first_seen, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            return conn.total_changes - before
+
+    def claim(self, limit: int, now: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Mark up to `limit` due pending jobs in flight and return them, oldest first"""
+        if limit <= 0:
+            return []
+        now = time.time() if now is None else now
+        conn = self._connect()
+        with conn:
+            rows = conn.execute(
+                "SELECT * FROM upload_jobs WHERE state = ? AND next_attempt_at <= ? "
+                "ORDER BY next_attempt_at, job_id LIMIT ?",
+                (PENDING, now, limit)
+            ).fetchall()
+            conn.executemany(
+                "UPDATE upload_jobs SET state = ?, updated_at = ? WHERE job_id = ?",
+                [(IN_FLIGHT, now, row["job_id"]) for row in rows]
+            )
+        return [dict(row) for row in rows]
+
+    def uploaded_url(self, path: str, size: int, mtime_ns: int) -> Optional[str]:
+        """URL of an earlier upload of this exact version of the file, if any"""
+        row = self._connect().execute(
+            "SELECT url FROM upload_jobs WHERE path = ? AND size = ? AND mtime_ns = ? AND state = ? LIMIT 1",
+            (path, size, mtime_ns, DONE)
+        ).fetchone()
+        return row["url"] if row else None
+
+    def complete(self, job_id: int, url: str, size: Optional[int] = None, mtime_ns: Optional[int] = None):
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "UPDATE upload_jobs SET state = ?, url = ?, size = ?, mtime_ns = ?, "
+                "last_error = NULL, updated_at = ? WHERE job_id = ?",
+                (DONE, url, size, mtime_ns, time.time(), job_id)
+            )
+
+    def retry(self, job_id: int, error: str, delay: Optional[float] = None) -> bool:
+        """
+        Count a failed attempt and reschedule with backoff
+
+        Returns False (and marks the job failed) once MAX_ATTEMPTS is reached.
+        `delay` overrides the backoff, e.g. with the server's Retry-After.
+        """
+        conn = self._connect()
+        with conn:
+            row = conn.execute("SELECT attempts FROM upload_jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row is None:
+                return False
+            attempts = row["attempts"] + 1
+            if attempts >= MAX_ATTEMPTS:
+                conn.execute(
+                    "UPDATE upload_jobs SET state = ?, attempts = ?, last_error = ?, updated_at = ? "
+                    "WHERE job_id = ?",
+                    (FAILED, attempts, error, time.time(), job_id)
+                )
+                return False
+            now = time.time()
+            wait = backoff_delay(attempts) if delay is None else max(delay, backoff_delay(attempts))
+            conn.execute(
+                "UPDATE upload_jobs SET state = ?, attempts = ?, next_attempt_at = ?, "
+                "last_error = ?, updated_at = ? WHERE job_id = ?",
+                (PENDING, attempts, now + wait, error, now, job_id)
+            )
+            return True
+
+    def fail(self, job_id: int, error: str):
+        """Give up on a job (the file is gone, or the server rejected it)"""
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "UPDATE upload_jobs SET state = ?, last_error = ?, updated_at = ? WHERE job_id = ?",
+                (FAILED, error, time.time(), job_id)
+            )
+
+    def recover(self) -> int:
+        """Return jobs left in flight (crash, quit mid-upload) to pending"""
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute(
+                "UPDATE upload_jobs SET state = ?, next_attempt_at = 0, updated_at = ? WHERE state = ?",
+                (PENDING, time.time(), IN_FLIGHT)
+            )
+        return cursor.rowcount
+
+    def next_due(self) -> Optional[float]:
+        """When the earliest pending job may be claimed (None if nothing is pending)"""
+        row = self._connect().execute(
+            "SELECT MIN(next_attempt_at) FROM upload_jobs WHERE state = ?", (PENDING,)
+        ).fetchone()
+        return row[0]
+
+    def unfinished_count(self) -> int:
+        row = self._connect().execute(
+            "SELECT COUNT(*) FROM upload_jobs WHERE state IN (?, ?)", (PENDING, IN_FLIGHT)
+        ).fetchone()
+        return row[0]
+
+    def prune(self, older_than_days: float = KEEP_FINISHED_DAYS) -> int:
+        """Delete finished jobs older than the cutoff"""
+        cutoff = time.time() - older_than_days * 86400
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute(
+                "DELETE FROM upload_jobs WHERE state IN (?, ?) AND updated_at < ?",
+                (DONE, FAILED, cutoff)
+            )
+        return cursor.rowcount
+
+    @staticmethod
+    def file_version(path: str):
+        """(size, mtime_ns) identifying the current content of a file"""
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+
+    @classmethod
+    def _current_version(cls, path: str) -> Tuple[Optional[int], Optional[int]]:
+        """file_version(), or (None, None) for a file that can't be read (the job fails when it runs)"""
+        try:
+            return cls.file_version(path)
+        except OSError:
+            return None, None
@@ -0,0 +1,14 @@
+"""
+Shared setup for the client tests
+
+Run from the client directory: python -m pytest tests
+Only the modules that don't need Qt are tested; they import each other by module name
+the way the app does, so src/ goes on the path.
+"""
+
+import sys
+from pathlib import Path
+
+SRC_DIR = Path(__file__).resolve().parent.parent / "src"
+if str(SRC_DIR) not in sys.path:
+    sys.path.insert(0, str(SRC_DIR))
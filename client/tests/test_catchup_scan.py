@@ -0,0 +1,76 @@
+"""Catch-up scan: files found while nothing uploads them end up in the persistent queue"""
+
+import pytest
+
+from catchup_scan import CatchUpScanner
+from upload_queue import UploadQueue
+
+EXTENSIONS = {".png"}
+
+
+@pytest.fixture
+def jobs(tmp_path):
+    return UploadQueue(tmp_path / "file_manager.db")
+
+
+@pytest.fixture
+def scanner(jobs):
+    return CatchUpScanner(jobs, jobs.db_path)
+
+
+@pytest.fixture
+def root(tmp_path):
+    folder = tmp_path / "VRChat"
+    folder.mkdir()
+    (folder / "existing.png").write_bytes(b"old")
+    return folder
+
+
+def queued_paths(jobs):
+    return [job["path"] for job in jobs.claim(100)]
+
+
+def test_first_scan_only_records_what_is_there(scanner, jobs, root):
+    summary = scanner.scan([str(root)], EXTENSIONS)
+    assert (summary["baselined"], summary["files"], summary["queued"]) == (1, 1, 0)
+    assert jobs.unfinished_count() == 0
+
+
+def test_files_found_offline_stay_queued(scanner, jobs, root):
+    scanner.scan([str(root)], EXTENSIONS)
+    (root / "new.png").write_bytes(b"new")
+    (root / "notes.txt").write_bytes(b"ignored")
+
+    # Nothing is uploading (the client is offline): the job waits in the database
+    assert scanner.scan([str(root)], EXTENSIONS)["queued"] == 1
+    assert scanner.scan([str(root)], EXTENSIONS)["queued"] == 0
+
+    restarted = UploadQueue(jobs.db_path)
+    assert queued_paths(restarted) == [str(root / "new.png")]
+
+
+def test_manifest_waits_for_the_queue(scanner, jobs, root, monkeypatch):
+    scanner.scan([str(root)], EXTENSIONS)
+    (root / "new.png").write_bytes(b"new")
+
+    def crash(jobs):
+        raise RuntimeError("quit mid-scan")
+    monkeypatch.setattr(jobs, "enqueue_many", crash)
+    with pytest.raises(RuntimeError):
+        scanner.scan([str(root)], EXTENSIONS)
+    monkeypatch.undo()
+
+    assert scanner.scan([str(root)], EXTENSIONS)["queued"] == 1
+    assert queued_paths(jobs) == [str(root / "new.png")]
+
+
+def test_uploaded_version_is_not_queued_again(scanner, jobs, root):
+    scanner.scan([str(root)], EXTENSIONS)
+    path = str(root / "new.png")
+    (root / "new.png").write_bytes(b"new")
+    jobs.enqueue(path)
+    [job] = jobs.claim(1)
+    jobs.complete(job["job_id"], "http://server/new", *UploadQueue.file_version(path))
+
+    assert scanner.scan([str(root)], EXTENSIONS)["queued"] == 0
+    assert jobs.unfinished_count() == 0
@@ -0,0 +1,88 @@
+"""Persistent upload queue: one unfinished job per file version, retries, recovery"""
+
+import os
+import time
+
+import pytest
+
+from upload_queue import UploadQueue, PENDING, IN_FLIGHT, DONE, FAILED, MAX_ATTEMPTS
+
+
+@pytest.fixture
+def jobs(tmp_path):
+    return UploadQueue(tmp_path / "file_manager.db")
+
+
+def write(path, data, mtime_ns):
+    path.write_bytes(data)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+    return str(path)
+
+
+def states(jobs):
+    rows = jobs._connect().execute("SELECT path, state, size FROM upload_jobs ORDER BY job_id").fetchall()
+    return [(os.path.basename(row["path"]), row["state"], row["size"]) for row in rows]
+
+
+def test_same_version_is_queued_once(jobs, tmp_path):
+    path = write(tmp_path / "a.png", b"one", 1_000_000_000)
+    assert jobs.enqueue(path) is not None
+    assert jobs.enqueue(path) is None
+    assert jobs.enqueue_many([(path, None)]) == 0
+    assert jobs.unfinished_count() == 1
+
+
+def test_file_rewritten_during_upload_is_queued_again(jobs, tmp_path):
+    path = write(tmp_path / "a.png", b"one", 1_000_000_000)
+    jobs.enqueue(path)
+    [job] = jobs.claim(10)
+    version = UploadQueue.file_version(path)
+
+    write(tmp_path / "a.png", b"edited", 2_000_000_000)
+    assert jobs.enqueue_many([(path, None)]) == 1
+
+    jobs.complete(job["job_id"], "http://server/a", *version)
+    assert states(jobs) == [("a.png", DONE, 3), ("a.png", PENDING, 6)]
+    # The upload of the first version does not count for the edited one
+    assert jobs.uploaded_url(path, *version) == "http://server/a"
+    assert jobs.uploaded_url(path, *UploadQueue.file_version(path)) is None
+
+
+def test_missing_file_is_still_queued_once(jobs, tmp_path):
+    path = str(tmp_path / "gone.png")
+    assert jobs.enqueue(path) is not None
+    assert jobs.enqueue(path) is None
+
+
+def test_retry_backs_off_then_fails(jobs, tmp_path):
+    path = write(tmp_path / "a.png", b"one", 1_000_000_000)
+    jobs.enqueue(path)
+    for attempt in range(1, MAX_ATTEMPTS):
+        [job] = jobs.claim(1, now=float("inf"))
+        assert jobs.retry(job["job_id"], "timeout")
+        assert jobs.claim(1) == []
+    [job] = jobs.claim(1, now=float("inf"))
+    assert not jobs.retry(job["job_id"], "timeout")
+    assert states(jobs) == [("a.png", FAILED, 3)]
+
+
+def test_recover_returns_in_flight_jobs(jobs, tmp_path):
+    path = write(tmp_path / "a.png", b"one", 1_000_000_000)
+    jobs.enqueue(path)
+    jobs.claim(1)
+    assert states(jobs) == [("a.png", IN_FLIGHT, 3)]
+
+    assert UploadQueue(jobs.db_path).recover() == 1
+    assert [job["path"] for job in jobs.claim(1)] == [path]
+
+
+def test_next_due_is_the_earliest_pending_retry(jobs, tmp_path):
+    assert jobs.next_due() is None
+    path = write(tmp_path / "a.png", b"one", 1_000_000_000)
+    jobs.enqueue(path)
+    assert jobs.next_due() == 0
+
+    [job] = jobs.claim(1)
+    assert jobs.next_due() is None
+    jobs.retry(job["job_id"], "timeout", delay=60)
+    assert jobs.next_due() == pytest.approx(time.time() + 60, abs=5)
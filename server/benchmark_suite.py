@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+"""
+Benchmark Suite for VRCPhoto2URL Server
+Seeds a throwaway library and measures the server's hot paths, in-process or against a spawned server
+
+Usage (from the server directory; needs httpx: pip install httpx):
+    python benchmark_suite.py --files 10000
+    python benchmark_suite.py --files 100000 --mode spawn --output results/v2.json
+    python benchmark_suite.py --files 10000 --compare results/v1.json
+
+Every run starts from an empty temporary UPLOAD_DIR, so runs are comparable across versions.
+"""
+
+import os
+import sys
+import io
+import json
+import time
+import uuid
+import random
+import logging
+import socket
+import asyncio
+import hashlib
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+try:
+    import httpx
+except ImportError:
+    sys.exit("benchmark_suite.py needs httpx: pip install httpx")
+
+from PIL import Image
+
+SERVER_DIR = Path(__file__).resolve().parent
+API_KEY = "benchmark-api-key"
+# Distinct stored images; seeded records share them the way deduplicated uploads do
+SEED_IMAGES = 200
+SEED_IMAGE_SIZE = (1600, 1200)
+SEED_DAYS = 365
+
+
+def summarize(durations: List[float], wall: float, items: int = 0) -> Dict[str, Any]:
+    """Latency percentiles (ms) and throughput for one benchmark"""
+    ordered = sorted(durations)
+
+    def percentile(p: float) -> float:
+        if not ordered:
+            return 0.0
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))] * 1000
+
+    result = {
+        "requests": len(ordered),
+        "wall_seconds": round(wall, 4),
+        "requests_per_second": round(len(ordered) / wall, 2) if wall > 0 else None,
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 3) if ordered else 0.0,
+        "p50_ms": round(percentile(50), 3),
+        "p95_ms": round(percentile(95), 3),
+        "p99_ms": round(percentile(99), 3),
+        "max_ms": round(ordered[-1] * 1000, 3) if ordered else 0.0,
+    }
+    if items:
+        result["items"] = items
+    return result
+
+
+_noise: Optional[Image.Image] = None
+
+
+def image_bytes(size=SEED_IMAGE_SIZE, seed: int = 0) -> bytes:
+    """Distinct noisy JPEG per seed (compresses like a photo, unlike a flat color)"""
+    global _noise
+    if _noise is None:
+        # Rendering noise is slow; crop every image out of one larger field instead
+        _noise = Image.effect_noise((2560, 1920), 60).convert("RGB")
+    x = seed * 7 % (_noise.width - size[0] + 1)
+    y = seed * 13 % (_noise.height - size[1] + 1)
+    buffer = io.BytesIO()
+    _noise.crop((x, y, x + size[0], y + size[1])).save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def seed_library(upload_dir: Path, count: int) -> List[str]:
+    """Write `count` metadata records (plus their stored images) straight into the store"""
+    sys.path.insert(0, str(SERVER_DIR / "src"))
+    from services.metadata_store import MetadataStore
+
+    files_dir = upload_dir / "files"
+    files_dir.mkdir(parents=True, exist_ok=True)
+    blobs = []
+    for i in range(min(SEED_IMAGES, count)):
+        data = image_bytes(seed=i)
+        sha256 = hashlib.sha256(data).hexdigest()
+        filename = f"{uuid.uuid4()}.jpg"
+        (files_dir / filename).write_bytes(data)
+        blobs.append({"sha256": sha256, "filename": filename, "file_size": len(data), "was_resized": False})
+
+    store = MetadataStore(upload_dir / "metadata.db")
+    now = datetime.now()
+    file_ids = []
+    entries = []
+    for i in range(count):
+        file_id = str(uuid.uuid4())
+        blob = blobs[i % len(blobs)]
+        entries.append((file_id, {
+            "file_id": file_id,
+            "original_filename": f"VRChat_{i:07d}.jpg",
+            "url": f"http://localhost/files/{file_id}.jpg",
+            # Spread evenly over the last year so delete_old_files has something to do
+            "upload_time": (now - timedelta(days=SEED_DAYS * i / max(count, 1))).isoformat(),
+            "file_type": "images",
+            "content_type": "image/jpeg",
+            "has_thumbnail": True,
+            "sha256": blob["sha256"],
+            "etag": f'"{blob["sha256"][:32]}"',
+        }, blob, False))
+        file_ids.append(file_id)
+        if len(entries) >= 1000:
+            store.save_many_with_blobs(entries)
+            entries = []
+    if entries:
+        store.save_many_with_blobs(entries)
+    return file_ids
+
+
+async def measure(requests: int, concurrency: int,
+                  request: Callable[[int], Awaitable[Any]]) -> Dict[str, Any]:
+    """Run `request(i)` for i in range(requests) with at most `concurrency` in flight"""
+    durations: List[float] = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                response = await request(i)
+                if response is not None and response.status_code >= 400:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            durations.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    result = summarize(durations, time.perf_counter() - start)
+    result["errors"] = errors
+    return result
+
+
+class BenchmarkSuite:
+    """The benchmarks, run in order against one seeded server"""
+
+    def __init__(self, client: httpx.AsyncClient, file_ids: List[str], args: argparse.Namespace):
+        self.client = client
+        self.file_ids = file_ids
+        self.args = args
+        self.results: Dict[str, Any] = {}
+
+    async def run(self) -> Dict[str, Any]:
+        for name, benchmark in (
+            ("upload", self.bench_upload),
+            ("list_pages", self.bench_list_pages),
+            ("serve_file", self.bench_serve_file),
+            ("stats", self.bench_stats),
+            ("thumbnail_cold", self.bench_thumbnail_cold),
+            ("thumbnail_warm", self.bench_thumbnail_warm),
+            ("delete_old_files", self.bench_delete_old_files),
+        ):
+            print(f"  {name:<18}", end="", flush=True)
+            self.results[name] = await benchmark()
+            result = self.results[name]
+            print(f"{result['p50_ms']:>9.2f} ms p50 {result['p95_ms']:>9.2f} ms p95 "
+                  f"{result.get('requests_per_second') or 0:>9.1f} req/s")
+        return self.results
+
+    async def bench_upload(self) -> Dict[str, Any]:
+        # A mix like the desktop client sends: mostly photos, some small files
+        photos = [image_bytes(size=(1920, 1080), seed=10_000 + i) for i in range(4)]
+        payloads = []
+        for i in range(self.args.uploads):
+            if i % 5 == 4:
+                payloads.append((f"notes_{i}.txt", os.urandom(4096) + str(i).encode(), "text/plain"))
+            else:
+                # Unique bytes per upload so nothing is deduplicated
+                payloads.append((f"photo_{i}.jpg", photos[i % len(photos)] + str(i).encode(), "image/jpeg"))
+
+        uploaded = []
+
+        async def request(i: int):
+            response = await self.client.post("/upload", files={"file": payloads[i]})
+            if response.status_code == 200:
+                uploaded.append(response.json()["file_id"])
+            return response
+
+        result = await measure(len(payloads), self.args.concurrency, request)
+        total = sum(len(data) for _, data, _ in payloads)
+        result["megabytes_per_second"] = round(total / (1024 * 1024) / result["wall_seconds"], 2)
+        self.file_ids.extend(uploaded)
+        return result
+
+    async def bench_list_pages(self) -> Dict[str, Any]:
+        """Walk /files newest-first with cursors, one page after another"""
+        durations = []
+        cursor = None
+        items = 0
+        start = time.perf_counter()
+        for _ in range(self.args.pages):
+            params = {"limit": self.args.page_size}
+            if cursor:
+                params["cursor"] = cursor
+            page_start = time.perf_counter()
+            response = await self.client.get("/files", params=params)
+            durations.append(time.perf_counter() - page_start)
+            body = response.json()
+            items += len(body["files"])
+            cursor = body.get("next_cursor")
+            if not cursor:
+                break
+        return summarize(durations, time.perf_counter() - start, items=items)
+
+    async def bench_serve_file(self) -> Dict[str, Any]:
+        rng = random.Random(1)
+        targets = [rng.choice(self.file_ids) for _ in range(self.args.requests)]
+        return await measure(len(targets), self.args.concurrency,
+                             lambda i: self.client.get(f"/files/{targets[i]}.jpg"))
+
+    async def bench_stats(self) -> Dict[str, Any]:
+        return await measure(self.args.requests, self.args.concurrency, lambda i: self.client.get("/stats"))
+
+    def _thumbnail_targets(self) -> List[str]:
+        # One file per distinct stored image, so every first request really renders
+        return self.file_ids[:min(self.args.thumbnails, SEED_IMAGES, len(self.file_ids))]
+
+    async def bench_thumbnail_cold(self) -> Dict[str, Any]:
+        targets = self._thumbnail_targets()
+        return await measure(len(targets), self.args.concurrency,
+                             lambda i: self.client.get(f"/files/{targets[i]}/thumbnail"))
+
+    async def bench_thumbnail_warm(self) -> Dict[str, Any]:
+        targets = self._thumbnail_targets()
+        return await measure(len(targets), self.args.concurrency,
+                             lambda i: self.client.get(f"/files/{targets[i]}/thumbnail"))
+
+    async def bench_delete_old_files(self) -> Dict[str, Any]:
+        """One DELETE /files?days= call removing the oldest quarter of the seeded records"""
+        before = (await self.client.get("/stats")).json()["total_files"]
+        start = time.perf_counter()
+        response = await self.client.delete("/files", params={"days": int(SEED_DAYS * 0.75)})
+        wall = time.perf_counter() - start
+        after = (await self.client.get("/stats")).json()["total_files"]
+        result = summarize([wall], wall, items=before - after)
+        result["errors"] = int(response.status_code >= 400)
+        result["files_per_second"] = round((before - after) / wall, 1) if wall > 0 else None
+        return result
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def run_in_process(args: argparse.Namespace, file_ids: List[str]) -> Dict[str, Any]:
+    """Drive the ASGI app directly through httpx's ASGITransport (no sockets)"""
+    sys.path.insert(0, str(SERVER_DIR))
+    from src.app import app
+    # Per-request INFO logging would be part of every measurement
+    logging.getLogger().setLevel(logging.WARNING)
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://localhost",
+                                     headers={"Authorization": f"Bearer {API_KEY}"}, timeout=120) as client:
+            return await BenchmarkSuite(client, file_ids, args).run()
+
+
+async def run_spawned(args: argparse.Namespace, file_ids: List[str], env: Dict[str, str]) -> Dict[str, Any]:
+    """Start uvicorn in a subprocess and benchmark it over loopback HTTP"""
+    port = free_port()
+    command = [sys.executable, "-m", "uvicorn", "src.app:app", "--host", "127.0.0.1", "--port", str(port),
+               "--log-level", "warning", "--workers", str(args.workers)]
+    log_path = Path(env["UPLOAD_DIR"]) / "server.log"
+    log = open(log_path, "w")
+    server = subprocess.Popen(command, cwd=SERVER_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        async with httpx.AsyncClient(base_url=base_url, headers={"Authorization": f"Bearer {API_KEY}"},
+                                     timeout=120) as client:
+            deadline = time.monotonic() + 60
+            while True:
+                try:
+                    if (await client.get("/health")).status_code == 200:
+                        break
+                except httpx.TransportError:
+                    pass
+                if server.poll() is not None or time.monotonic() > deadline:
+                    log.flush()
+                    raise RuntimeError(f"Server did not start:\n{log_path.read_text()[-2000:]}")
+                await asyncio.sleep(0.2)
+            return await BenchmarkSuite(client, file_ids, args).run()
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+        log.close()
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SERVER_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_comparison(results: Dict[str, Any], baseline_path: Path):
+    baseline = json.loads(baseline_path.read_text())
+    print(f"\nCompared with {baseline_path} ({baseline['run'].get('git_revision')}):")
+    for name, result in results.items():
+        previous = baseline["results"].get(name)
+        if not previous or not previous.get("p50_ms"):
+            continue
+        change = (result["p50_ms"] - previous["p50_ms"]) / previous["p50_ms"] * 100
+        print(f"  {name:<18}{previous['p50_ms']:>9.2f} -> {result['p50_ms']:>9.2f} ms p50 ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the file server's hot paths")
+    parser.add_argument("--files", type=int, default=1000, help="Metadata records to seed (e.g. 1000, 10000, 100000)")
+    parser.add_argument("--mode", choices=("inprocess", "spawn"), default="inprocess")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers in spawn mode")
+    parser.add_argument("--uploads", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=500, help="Requests for /files/{id} and /stats")
+    parser.add_argument("--pages", type=int, default=50)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--thumbnails", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--output", type=Path, help="JSON results file (default: benchmark_results/<time>.json)")
+    parser.add_argument("--compare", type=Path, help="Earlier results file to compare against")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="vrcphoto2url-bench-") as upload_dir:
+        env = dict(os.environ, UPLOAD_DIR=upload_dir, API_KEY=API_KEY, WEB_CONCURRENCY=str(args.workers),
+                   RETENTION_MAX_AGE_DAYS="0", RETENTION_MAX_TOTAL_MB="0", RETENTION_TYPE_QUOTAS_MB="")
+        # The in-process app reads its configuration from the environment at import
+        os.environ.update(env)
+
+        print(f"Seeding {args.files} records in {upload_dir}...")
+        start = time.perf_counter()
+        file_ids = seed_library(Path(upload_dir), args.files)
+        seed_seconds = time.perf_counter() - start
+
+        print(f"Running benchmarks ({args.mode})")
+        if args.mode == "spawn":
+            results = asyncio.run(run_spawned(args, file_ids, env))
+        else:
+            results = asyncio.run(run_in_process(args, file_ids))
+
+    report = {
+        "run": {
+            "timestamp": datetime.now().isoformat(),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "seed_seconds": round(seed_seconds, 2),
+            **{key: (str(value) if isinstance(value, Path) else value) for key, value in vars(args).items()},
+        },
+        "results": results,
+    }
+    output = args.output or SERVER_DIR / "benchmark_results" / f"{datetime.now():%Y%m%d-%H%M%S}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    print(f"\nResults written to {output}")
+
+    if args.compare:
+        print_comparison(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,23 +6,81 @@ A FastAPI-based file server designed for Railway deployment
 
 import os
 import uuid
-import json
 import time
-from datetime import datetime, timedelta
+from datetime import datetime
 from pathlib import Path
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Union
 import logging
+import asyncio
+from contextlib import asynccontextmanager, suppress
 
-from fastapi import FastAPI, File, UploadFile, HTTPException, Depends, status, Request
+from fastapi import FastAPI, HTTPException, Depends, status, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse, HTMLResponse
+from fastapi.responses import JSONResponse, HTMLResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 import uvicorn
-from PIL import Image
-import hashlib
+
+# Local imports - package-relative when run as `src.app`, flat when src/ is on sys.path
+try:
+    from .services.upload_pipeline import (
+        MultipartUploadParser, MultipartError, TooManyFiles, ReceivedFile, cleanup_stale_temp_files,
+        SpooledUpload, UploadTooLarge, UploadSizeLimitMiddleware
+    )
+    from .services.image_processing import (
+        ImageProcessor, ImageProcessorBusy, VARIANT_FORMATS, render_variant, resize_image_if_needed
+    )
+    from .services.variants import (
+        VariantCache, TranscodeCache, NEGOTIATED_FORMATS, TRANSCODABLE_EXTENSIONS,
+        negotiate_format, normalize_variant_size, variant_name, variant_etag
+    )
+    from .services.upload_sessions import (
+        UploadSessionManager, SessionNotFound, OffsetMismatch, SessionOverflow, SessionIncomplete,
+        SessionBusy, SESSION_CHUNK_SIZE
+    )
+    from .services.metadata_store import MetadataStore, BlobEntry, encode_cursor, decode_cursor
+    from .services.stats_engine import StatsEngine
+    from .services.file_index import FileIndex, thumbnail_filename
+    from .services.retention import RetentionPolicy, plan_retention, parse_type_quotas
+    from .services.change_feed import ChangeFeed, new_origin
+    from .services.file_list import FileListCache
+    from .services.metrics import (
+        MetricsRegistry, CallbackCounter, RequestMetricsMiddleware, open_file_descriptors
+    )
+    from .services.file_serving import (
+        content_etag, serve_file, OpenFilePool
+    )
+except ImportError:
+    from services.upload_pipeline import (
+        MultipartUploadParser, MultipartError, TooManyFiles, ReceivedFile, cleanup_stale_temp_files,
+        SpooledUpload, UploadTooLarge, UploadSizeLimitMiddleware
+    )
+    from services.image_processing import (
+        ImageProcessor, ImageProcessorBusy, VARIANT_FORMATS, render_variant, resize_image_if_needed
+    )
+    from services.variants import (
+        VariantCache, TranscodeCache, NEGOTIATED_FORMATS, TRANSCODABLE_EXTENSIONS,
+        negotiate_format, normalize_variant_size, variant_name, variant_etag
+    )
+    from services.upload_sessions import (
+        UploadSessionManager, SessionNotFound, OffsetMismatch, SessionOverflow, SessionIncomplete,
+        SessionBusy, SESSION_CHUNK_SIZE
+    )
+    from services.metadata_store import MetadataStore, BlobEntry, encode_cursor, decode_cursor
+    from services.stats_engine import StatsEngine
+    from services.file_index import FileIndex, thumbnail_filename
+    from services.retention import RetentionPolicy, plan_retention, parse_type_quotas
+    from services.change_feed import ChangeFeed, new_origin
+    from services.file_list import FileListCache
+    from services.metrics import (
+        MetricsRegistry, CallbackCounter, RequestMetricsMiddleware, open_file_descriptors
+    )
+    from services.file_serving import (
+        content_etag, serve_file, OpenFilePool
+    )
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -48,25 +106,103 @@ class UploadResponse(BaseModel):
     original_filename: str
     file_size: int
     message: str
+    deduplicated: bool = False
+
+class BatchUploadItem(BaseModel):
+    original_filename: str
+    success: bool
+    status_code: int = 200
+    error: Optional[str] = None
+    retry_after: Optional[int] = None
+    file_id: Optional[str] = None
+    url: Optional[str] = None
+    file_size: Optional[int] = None
+    deduplicated: bool = False
+
+class BatchUploadResponse(BaseModel):
+    success: bool
+    uploaded: int
+    failed: int
+    results: List[BatchUploadItem]
 
 class DeleteResponse(BaseModel):
     success: bool
     message: str
 
+class RetentionReport(BaseModel):
+    dry_run: bool
+    policy: Dict[str, Any]
+    files: int
+    bytes: int
+    by_reason: Dict[str, Dict[str, int]]
+    file_ids: List[str]
+    deleted: int = 0
+
+class CreateUploadSessionRequest(BaseModel):
+    filename: str
+    size: int
+    content_type: Optional[str] = None
+    sha256: Optional[str] = None
+
+class UploadSessionInfo(BaseModel):
+    session_id: str
+    filename: str
+    size: int
+    offset: int
+    chunk_size: int
+    expires_at: str
+
 class ListFilesResponse(BaseModel):
     files: List[FileInfo]
-    total_count: int
+    # None on cursor pages of a date/name-filtered listing (counted on the first page only)
+    total_count: Optional[int] = None
+    next_cursor: Optional[str] = None
 
 # Configuration
 class Config:
     # Server settings
     HOST = os.getenv("HOST", "0.0.0.0")
     PORT = int(os.getenv("PORT", 8000))
+    # Worker processes (start.py); with more than one they follow each other's writes
+    # through the metadata database every CLUSTER_SYNC_INTERVAL seconds
+    WORKERS = max(1, int(os.getenv("WEB_CONCURRENCY", 1)))
+    CLUSTER_SYNC_INTERVAL = float(os.getenv("CLUSTER_SYNC_INTERVAL", 0.25))
     
     # Storage settings
     UPLOAD_DIR = Path(os.getenv("UPLOAD_DIR", str(project_root / "uploads")))
+    FILES_DIR = UPLOAD_DIR / "files"
     THUMBNAILS_DIR = UPLOAD_DIR / "thumbnails"
-    MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
+    VARIANTS_DIR = THUMBNAILS_DIR / "variants"
+    METADATA_DB = Path(os.getenv("METADATA_DB", str(UPLOAD_DIR / "metadata.db")))
+    MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE", 50 * 1024 * 1024))  # 50MB
+    # Resumable uploads: unfinished sessions idle this long are removed
+    UPLOAD_SESSIONS_DIR = FILES_DIR / "sessions"
+    UPLOAD_SESSION_TTL_HOURS = float(os.getenv("UPLOAD_SESSION_TTL_HOURS", 24))
+    # Batch uploads: files per request, total request size and files processed at once
+    MAX_BATCH_FILES = int(os.getenv("MAX_BATCH_FILES", 50))
+    MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", 200 * 1024 * 1024))  # 200MB
+    BATCH_PARALLELISM = int(os.getenv("BATCH_PARALLELISM", 4))
+    
+    # Image processing pool (resize/thumbnail run here instead of on the event loop)
+    IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", min(2, os.cpu_count() or 1)))
+    IMAGE_QUEUE_DEPTH = int(os.getenv("IMAGE_QUEUE_DEPTH", 8))
+    IMAGE_RETRY_AFTER = int(os.getenv("IMAGE_RETRY_AFTER", 5))
+    # Disk budget for generated thumbnails/variants (least recently served are evicted)
+    VARIANT_CACHE_MB = int(os.getenv("VARIANT_CACHE_MB", 512))
+    # Descriptors kept open for the most recently served files (0 = open per request)
+    OPEN_FILE_POOL_SIZE = int(os.getenv("OPEN_FILE_POOL_SIZE", 256))
+    # Formats images are re-encoded to when the client's Accept header allows, in order of preference
+    IMAGE_FORMATS = [f.strip().lower() for f in os.getenv("IMAGE_FORMATS", ",".join(NEGOTIATED_FORMATS)).split(",") if f.strip()]
+    # Separate pool for those re-encodings, so they never take capacity from uploads
+    TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", 1 if IMAGE_WORKERS > 0 else 0))
+    TRANSCODE_QUEUE_DEPTH = int(os.getenv("TRANSCODE_QUEUE_DEPTH", 4))
+    
+    # Retention, enforced in the background when any limit is set (0 = no limit)
+    RETENTION_MAX_AGE_DAYS = float(os.getenv("RETENTION_MAX_AGE_DAYS", 0))
+    RETENTION_MAX_TOTAL_MB = float(os.getenv("RETENTION_MAX_TOTAL_MB", 0))
+    # Per file type, e.g. "images=2048,others=512"
+    RETENTION_TYPE_QUOTAS_MB = os.getenv("RETENTION_TYPE_QUOTAS_MB", "")
+    RETENTION_INTERVAL_MINUTES = float(os.getenv("RETENTION_INTERVAL_MINUTES", 60))
     
     # Security
     API_KEY = os.getenv("API_KEY", "your-secret-api-key-change-this")
@@ -105,11 +241,45 @@ class Config:
         logger.info(f"BASE_URL configuration: PORT={current_port}, RAW={raw_base_url}, FINAL={final_url}")
         return final_url
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Application startup/shutdown"""
+    # Import legacy per-file JSON sidecars once; no-op after the first run
+    metadata_store.migrate_json_sidecars(Config.UPLOAD_DIR)
+    # One consistent read; other workers' writes after it are applied by the change feed
+    snapshot = metadata_store.snapshot()
+    if change_feed:
+        change_feed.mark(snapshot.last_change)
+    # Seed the running stats counters; uploads and deletes keep them current from here on
+    stats_engine.rebuild(snapshot.type_aggregates, snapshot.daily_upload_counts)
+    # Resolve every stored file's path once so /files/{file_id} never touches metadata or probes disk
+    file_index.build(snapshot.files)
+    # Loaded once; uploads and deletes are applied to it as they happen
+    file_list.load(snapshot.files)
+    variant_cache.load()
+    gc_task = asyncio.create_task(collect_upload_sessions_periodically())
+    retention_task = None
+    if retention_policy.enabled and Config.RETENTION_INTERVAL_MINUTES > 0:
+        retention_task = asyncio.create_task(enforce_retention_periodically())
+    sync_task = asyncio.create_task(change_feed.run(Config.CLUSTER_SYNC_INTERVAL)) if change_feed else None
+    yield
+    for task in (gc_task, retention_task, sync_task):
+        if task is None:
+            continue
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+    image_processor.shutdown()
+    transcode_processor.shutdown()
+    if file_pool:
+        file_pool.close()
+
 # Initialize FastAPI
 app = FastAPI(
     title="Custom Server File Manager",
     description="A file management server for Railway deployment",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # Get the project root directory (one level up from src)
@@ -128,6 +298,29 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Reject oversized uploads from Content-Length before the multipart body is parsed
+app.add_middleware(
+    UploadSizeLimitMiddleware,
+    max_body_size=Config.MAX_FILE_SIZE,
+    path_limits={"/upload/batch": Config.MAX_BATCH_SIZE}
+)
+
+# Metrics for /metrics; per process, so with several workers each scrape sees one of them
+metrics = MetricsRegistry()
+request_duration = metrics.histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template, method and status"
+)
+upload_bytes = metrics.counter("upload_bytes_total", "Bytes received in stored uploads")
+upload_files = metrics.counter("upload_files_total", "Uploads stored, by whether the content was new")
+upload_duration = metrics.histogram(
+    "upload_processing_seconds", "Time from a fully received upload to its content being in place"
+)
+image_job_duration = metrics.histogram(
+    "image_job_seconds", "Image pool jobs (resize, thumbnail, transcode) including queue wait"
+)
+# Outermost, so rejected and failed requests are timed too
+app.add_middleware(RequestMetricsMiddleware, histogram=request_duration)
+
 # Security
 security = HTTPBearer(auto_error=False)
 
@@ -154,162 +347,199 @@ def verify_api_key(credentials: HTTPAuthorizationCredentials = Depends(security)
 
 # Ensure upload directories exist
 Config.UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+Config.FILES_DIR.mkdir(parents=True, exist_ok=True)
 Config.THUMBNAILS_DIR.mkdir(parents=True, exist_ok=True)
+cleanup_stale_temp_files(Config.FILES_DIR)
+
+# Shared image processing pool
+image_processor = ImageProcessor(
+    max_workers=Config.IMAGE_WORKERS,
+    max_queue=Config.IMAGE_QUEUE_DEPTH,
+    retry_after=Config.IMAGE_RETRY_AFTER
+)
+
+# Accept-negotiated re-encodings are made in the background, on their own capacity
+transcode_processor = ImageProcessor(
+    max_workers=Config.TRANSCODE_WORKERS,
+    max_queue=Config.TRANSCODE_QUEUE_DEPTH,
+    retry_after=Config.IMAGE_RETRY_AFTER
+)
+
+async def run_image_job(job: str, func, *args, processor: ImageProcessor = image_processor):
+    """processor.run, timed into image_job_seconds under `job`"""
+    with image_job_duration.time(job=job):
+        return await processor.run(func, *args)
+
+def image_processor_busy(retry_after: int) -> HTTPException:
+    """503 telling the client when to retry"""
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Image processing is busy, please retry",
+        headers={"Retry-After": str(retry_after)}
+    )
+
+# Thumbnails and other resized variants, generated on first request; workers split the budget
+variant_cache = VariantCache(Config.VARIANTS_DIR, Config.VARIANT_CACHE_MB * 1024 * 1024, Config.WORKERS)
+# Accept-negotiated full-size re-encodings (WebP/AVIF), kept next to the original
+NEGOTIABLE_FORMATS = [fmt for fmt in Config.IMAGE_FORMATS if fmt in VARIANT_FORMATS]
+transcode_cache = TranscodeCache(
+    {fmt: VARIANT_FORMATS[fmt][2] for fmt in NEGOTIABLE_FORMATS}, transient_errors=(ImageProcessorBusy,)
+)
+TRANSCODE_QUALITY = 80
+
+metrics.gauge("image_queue_depth", "Image jobs running or waiting for a pool worker",
+              lambda: image_processor.pending)
+metrics.gauge("transcode_queue_depth", "Background re-encodes running or waiting for a transcode worker",
+              lambda: transcode_processor.pending)
+metrics.gauge("process_open_fds", "Open file handles of this worker process", open_file_descriptors)
 
 # File storage functions
-def save_file_metadata(file_id: str, metadata: Dict[str, Any]):
-    """Save file metadata to JSON"""
-    metadata_file = Config.UPLOAD_DIR / f"{file_id}.json"
-    with open(metadata_file, 'w') as f:
-        json.dump(metadata, f, indent=2)
+metadata_store = MetadataStore(Config.METADATA_DB, origin=new_origin() if Config.WORKERS > 1 else None)
+stats_engine = StatsEngine()
+# New files live in uploads/files/, older ones in the upload root
+file_index = FileIndex([Config.FILES_DIR, Config.UPLOAD_DIR])
+# Hot files are served from open descriptors (no open/stat/close per request)
+file_pool = OpenFilePool(Config.OPEN_FILE_POOL_SIZE) if Config.OPEN_FILE_POOL_SIZE > 0 else None
+if file_pool:
+    metrics.register(CallbackCounter(
+        "open_file_pool_requests_total", "Full-file responses served from a pooled descriptor (hit) or after opening one (miss)",
+        lambda: {(("result", "hit"),): file_pool.hits, (("result", "miss"),): file_pool.misses}
+    ))
+    metrics.gauge("open_file_pool_size", "Descriptors held open by the file pool", lambda: len(file_pool))
+
+# Every file's metadata, newest first, for the unpaged admin listing
+file_list = FileListCache()
+metrics.register(CallbackCounter(
+    "file_list_reads_total", "get_all_files() reads served from the current snapshot (hit) or rebuilding it (miss)",
+    lambda: {(("result", "hit"),): file_list.hits, (("result", "miss"),): file_list.misses}
+))
+
+upload_sessions = UploadSessionManager(
+    metadata_store, Config.UPLOAD_SESSIONS_DIR, Config.UPLOAD_SESSION_TTL_HOURS * 3600, Config.MAX_FILE_SIZE
+)
+UPLOAD_SESSION_GC_INTERVAL = 3600
+
+retention_policy = RetentionPolicy(
+    max_age_days=Config.RETENTION_MAX_AGE_DAYS or None,
+    max_total_bytes=int(Config.RETENTION_MAX_TOTAL_MB * 1024 * 1024) or None,
+    type_quotas=parse_type_quotas(Config.RETENTION_TYPE_QUOTAS_MB)
+)
+# Files deleted per metadata transaction
+DELETE_BATCH_SIZE = 200
+
+async def collect_upload_sessions_periodically():
+    """Remove abandoned resumable uploads at startup and then hourly"""
+    while True:
+        try:
+            await run_in_threadpool(upload_sessions.collect_garbage)
+        except Exception as e:
+            logger.error(f"Upload session cleanup error: {e}")
+        await asyncio.sleep(UPLOAD_SESSION_GC_INTERVAL)
+
+async def enforce_retention_periodically():
+    """Apply the configured retention policy at startup and then every RETENTION_INTERVAL_MINUTES"""
+    while True:
+        try:
+            report = await enforce_retention(retention_policy, dry_run=False)
+            if report.deleted:
+                logger.info(f"Retention removed {report.deleted} files ({report.bytes} bytes)")
+        except Exception as e:
+            logger.error(f"Retention error: {e}")
+        await asyncio.sleep(Config.RETENTION_INTERVAL_MINUTES * 60)
 
 def load_file_metadata(file_id: str) -> Optional[Dict[str, Any]]:
-    """Load file metadata from JSON"""
-    metadata_file = Config.UPLOAD_DIR / f"{file_id}.json"
-    if metadata_file.exists():
-        with open(metadata_file, 'r') as f:
-            return json.load(f)
-    return None
-
-# Performance optimization: Add caching
-_file_cache = {}
-_cache_timestamp = 0
-_stats_cache = {}
-_stats_cache_timestamp = 0
-CACHE_TTL = 30  # Cache for 30 seconds
-STATS_CACHE_TTL = 15  # Stats cache for 15 seconds (faster refresh for UI)
+    """Load file metadata from the metadata store"""
+    return metadata_store.load(file_id)
 
 def get_all_files() -> List[Dict[str, Any]]:
-    """Get all file metadata with caching and performance optimizations"""
-    global _file_cache, _cache_timestamp
-    current_time = time.time()
-    
-    # Check if cache is still valid
-    if current_time - _cache_timestamp < CACHE_TTL and _file_cache:
-        return _file_cache.get('files', [])
-    
-    files = []
-    try:
-        # Use pathlib for faster file operations
-        json_files = list(Config.UPLOAD_DIR.glob("*.json"))
-        
-        # Early return if no files
-        if not json_files:
-            _file_cache = {'files': []}
-            _cache_timestamp = current_time
-            return []
-        
-        # Process files with better error handling and performance
-        for json_file in json_files:
-            try:
-                # Check file size before reading (skip very large metadata files)
-                if json_file.stat().st_size > 10240:  # Skip files > 10KB (unusual for metadata)
-                    logger.warning(f"Skipping unusually large metadata file: {json_file}")
-                    continue
-                    
-                with open(json_file, 'r', encoding='utf-8') as f:
-                    metadata = json.load(f)
-                    
-                    # Validate metadata structure
-                    if 'file_id' in metadata and 'upload_time' in metadata:
-                        files.append(metadata)
-                    else:
-                        logger.warning(f"Invalid metadata structure in {json_file}")
-                        
-            except (json.JSONDecodeError, UnicodeDecodeError) as e:
-                logger.error(f"Error reading metadata file {json_file}: {e}")
-                continue
-            except Exception as e:
-                logger.error(f"Unexpected error reading metadata file {json_file}: {e}")
-                continue
-                
-    except Exception as e:
-        logger.error(f"Error scanning files directory: {e}")
-        return []
-    
-    # Sort by upload time (newest first) - optimized key function
-    try:
-        files.sort(key=lambda x: x.get('upload_time', '1970-01-01T00:00:00'), reverse=True)
-    except Exception as e:
-        logger.error(f"Error sorting files: {e}")
-        # Fallback to unsorted list
-    
-    # Update cache
-    _file_cache = {'files': files}
-    _cache_timestamp = current_time
-    
-    logger.debug(f"Loaded {len(files)} files in {time.time() - current_time:.3f}s")
+    """All file metadata, newest first, from the resident file list"""
+    return file_list.newest_first()
+
+def stored_content_paths(metadata: Dict[str, Any], entry) -> List[Path]:
+    """Original, transcoded copies and legacy thumbnail of a file whose content is being released"""
+    paths = [Config.THUMBNAILS_DIR / thumbnail_filename(metadata)]
+    # Handle both old and new metadata formats
+    filename = metadata.get("filename", metadata.get("stored_filename"))
+    if filename:
+        # Older files live in the root upload directory
+        candidates = [entry.path] if entry else [Config.FILES_DIR / filename, Config.UPLOAD_DIR / filename]
+        for file_path in candidates:
+            transcoded = [transcode_cache.path_for(file_path, fmt) for fmt in transcode_cache.extensions]
+            paths.append(file_path)
+            paths.extend(transcoded)
+            if file_pool:
+                for path in (file_path, *transcoded):
+                    file_pool.discard(path)
+            transcode_cache.forget(file_path)
+        variant_cache.discard_source(Path(filename).stem)
+    return paths
+
+def unlink_paths(paths: List[Path]):
+    for path in paths:
+        try:
+            path.unlink(missing_ok=True)
+        except OSError as e:
+            logger.warning(f"Could not delete {path}: {e}")
+
+async def purge_files(file_ids: List[str]) -> int:
+    """
+    Delete files in batches of DELETE_BATCH_SIZE
     
-    return files
+    Each batch is one metadata transaction and one pass over the disk, both off the
+    event loop. Returns how many of `file_ids` existed and were deleted.
+    """
+    deleted = 0
+    for start in range(0, len(file_ids), DELETE_BATCH_SIZE):
+        # Drop the metadata first: it decides whether other files still share the content
+        results = await run_in_threadpool(metadata_store.delete_many, file_ids[start:start + DELETE_BATCH_SIZE])
+        paths = []
+        for file_id, metadata, release_blob in results:
+            entry = file_index.remove(file_id)
+            file_list.remove(file_id)
+            stats_engine.record_delete(metadata)
+            # Remove the legacy JSON sidecar, if one is still around
+            paths.append(Config.UPLOAD_DIR / f"{file_id}.json")
+            if release_blob:
+                paths.extend(stored_content_paths(metadata, entry))
+        await run_in_threadpool(unlink_paths, paths)
+        deleted += len(results)
+    return deleted
 
-def invalidate_file_cache():
-    """Invalidate the file cache to force refresh"""
-    global _file_cache, _cache_timestamp, _stats_cache, _stats_cache_timestamp
-    _file_cache = {}
-    _cache_timestamp = 0
-    _stats_cache = {}
-    _stats_cache_timestamp = 0
+async def enforce_retention(policy: RetentionPolicy, dry_run: bool) -> RetentionReport:
+    """Plan (and unless `dry_run`, carry out) the deletions `policy` calls for"""
+    plan = await run_in_threadpool(plan_retention, metadata_store, policy)
+    report = RetentionReport(dry_run=dry_run, **plan.report())
+    if not dry_run and len(plan):
+        report.deleted = await purge_files(plan.file_ids)
+    return report
 
-def create_thumbnail(image_path: Path, thumbnail_path: Path, size: tuple = (200, 200)):
-    """Create thumbnail for image"""
-    try:
-        with Image.open(image_path) as img:
-            img.thumbnail(size, Image.Resampling.LANCZOS)
-            img.save(thumbnail_path, optimize=True, quality=85)
-        return True
-    except Exception as e:
-        logger.error(f"Error creating thumbnail: {e}")
-        return False
+def apply_remote_changes(changes: List[Dict[str, Any]]):
+    """Bring this worker's index, stats and caches up to date with other workers' writes"""
+    for change in changes:
+        file_id, metadata = change["file_id"], change["metadata"]
+        if change["op"] == "delete":
+            entry = file_index.remove(file_id)
+            file_list.remove(file_id)
+            stats_engine.record_delete(metadata)
+            filename = metadata.get("filename", metadata.get("stored_filename"))
+            if change["release_blob"] and filename:
+                # The deleting worker only knows about the variants it generated itself
+                variant_cache.discard_source(Path(filename).stem)
+                if entry:
+                    transcode_cache.forget(entry.path)
+                    if file_pool:
+                        file_pool.discard(entry.path)
+                        for fmt in transcode_cache.extensions:
+                            file_pool.discard(transcode_cache.path_for(entry.path, fmt))
+        else:
+            if change["previous"]:
+                stats_engine.record_delete(change["previous"])
+            stats_engine.record_upload(metadata)
+            file_index.add(metadata)
+            file_list.add(metadata)
 
-def resize_image_if_needed(image_path: Path, max_resolution: int = 2048, quality: int = 85):
-    """Resize image if it exceeds maximum resolution while maintaining aspect ratio"""
-    try:
-        with Image.open(image_path) as img:
-            # Get original dimensions
-            original_width, original_height = img.size
-            
-            # Check if resizing is needed
-            if original_width <= max_resolution and original_height <= max_resolution:
-                logger.info(f"Image {image_path.name} ({original_width}x{original_height}) is within size limits, no resize needed")
-                return False  # No resize needed
-            
-            # Calculate new dimensions maintaining aspect ratio
-            if original_width > original_height:
-                # Landscape or square
-                new_width = max_resolution
-                new_height = int((original_height * max_resolution) / original_width)
-            else:
-                # Portrait
-                new_height = max_resolution
-                new_width = int((original_width * max_resolution) / original_height)
-            
-            # Resize the image
-            resized_img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            
-            # Save with optimization
-            # Preserve original format if possible, fallback to JPEG for better compression
-            if img.format in ['JPEG', 'JPG']:
-                resized_img.save(image_path, format='JPEG', optimize=True, quality=quality)
-            elif img.format == 'PNG':
-                # For PNG, check if it has transparency
-                if resized_img.mode in ('RGBA', 'LA') or (resized_img.mode == 'P' and 'transparency' in resized_img.info):
-                    resized_img.save(image_path, format='PNG', optimize=True)
-                else:
-                    # Convert to JPEG for better compression if no transparency
-                    rgb_img = Image.new('RGB', resized_img.size, (255, 255, 255))
-                    rgb_img.paste(resized_img, mask=resized_img.split()[-1] if resized_img.mode == 'RGBA' else None)
-                    rgb_img.save(image_path, format='JPEG', optimize=True, quality=quality)
-            else:
-                # For other formats, convert to JPEG
-                rgb_img = resized_img.convert('RGB')
-                rgb_img.save(image_path, format='JPEG', optimize=True, quality=quality)
-            
-            logger.info(f"Image {image_path.name} resized from {original_width}x{original_height} to {new_width}x{new_height}")
-            return True  # Resize was performed
-            
-    except Exception as e:
-        logger.error(f"Error resizing image {image_path}: {e}")
-        return False
+# Only needed when other processes write to the same metadata database
+change_feed = ChangeFeed(metadata_store, apply_remote_changes) if metadata_store.origin else None
 
 def get_file_type(filename: str) -> str:
     """Determine file type category"""
@@ -343,106 +573,459 @@ async def health_check():
     """Health check endpoint"""
     return {"status": "healthy", "timestamp": datetime.now().isoformat()}
 
-@app.post("/upload", response_model=UploadResponse)
+async def store_own_copy(spooled: SpooledUpload, file_id: str, filename: str) -> Dict[str, Any]:
+    """Move an upload's content into uploads/files (resizing large images) and describe it as a blob"""
+    stored_filename = f"{file_id}{Path(filename).suffix}"
+    file_path = Config.FILES_DIR / stored_filename
+    file_size = spooled.size
+    
+    # Atomically move the spooled upload into place
+    spooled.commit(file_path)
+    
+    # Auto-resize large images in the processing pool; thumbnails are made on first request
+    resized = False
+    if get_file_type(filename) == 'images':
+        try:
+            resized = await run_image_job("resize", resize_image_if_needed, file_path, 2048, 85)
+        except ImageProcessorBusy as e:
+            file_path.unlink(missing_ok=True)
+            raise image_processor_busy(e.retry_after)
+        
+        # Update file size if image was resized
+        if resized:
+            file_size = file_path.stat().st_size
+    
+    return {
+        "sha256": spooled.sha256,
+        "filename": stored_filename,
+        "file_size": file_size,
+        "was_resized": resized
+    }
+
+async def prepare_spooled_upload(spooled: SpooledUpload, filename: str,
+                                 content_type: Optional[str]) -> Dict[str, Any]:
+    """Put a received upload's content in place (dedup, resize) and build its metadata, without registering it"""
+    is_image = get_file_type(filename) == 'images'
+    started = time.perf_counter()
+    
+    # Generate unique file ID; identical content shares one stored blob
+    file_id = str(uuid.uuid4())
+    blob = await run_in_threadpool(metadata_store.find_blob, spooled.sha256)
+    blob_missing = blob is not None and not (Config.FILES_DIR / blob["filename"]).exists()
+    if blob_missing:
+        logger.warning(f"Blob {blob['filename']} for {spooled.sha256} missing on disk, storing a fresh copy")
+    deduplicated = blob is not None and not blob_missing
+    
+    if not deduplicated:
+        blob = await store_own_copy(spooled, file_id, filename)
+    # A duplicate skips all image work, but its spool is kept until the reference to the
+    # shared copy is taken: if that copy is deleted in between, this one is stored instead
+    
+    # Generate file URL with proper extension for direct image viewing
+    file_extension = Path(filename).suffix.lower()
+    if is_image:
+        # For images, use direct file serving with extension
+        file_url = f"{Config.get_base_url()}/files/{file_id}{file_extension}"
+    else:
+        # For other files, use standard endpoint
+        file_url = f"{Config.get_base_url()}/files/{file_id}"
+    
+    # Filename, size and thumbnail are filled in from the blob record when registered
+    metadata = {
+        "file_id": file_id,
+        "original_filename": filename,
+        "url": file_url,
+        "upload_time": datetime.now().isoformat(),
+        "file_type": get_file_type(filename),
+        "content_type": content_type,
+        "has_thumbnail": is_image,
+        "sha256": spooled.sha256,
+        # Content never changes after upload, so the upload hash doubles as a strong validator
+        "etag": content_etag(spooled.sha256, None)
+    }
+    upload_duration.observe(time.perf_counter() - started)
+    upload_bytes.inc(spooled.size)
+    upload_files.inc(result="deduplicated" if deduplicated else "stored")
+    return {
+        "metadata": metadata,
+        "blob": blob,
+        "blob_missing": blob_missing,
+        "deduplicated": deduplicated,
+        "spooled": spooled if deduplicated else None
+    }
+
+def discard_prepared(prepared: List[Dict[str, Any]]):
+    """Remove the files of prepared uploads that were not registered"""
+    for item in prepared:
+        if item["spooled"] is not None:
+            item["spooled"].discard()
+            item["spooled"] = None
+        if not item["deduplicated"]:
+            (Config.FILES_DIR / item["blob"]["filename"]).unlink(missing_ok=True)
+
+def blob_entry(item: Dict[str, Any]) -> BlobEntry:
+    metadata = item["metadata"]
+    return BlobEntry(metadata["file_id"], metadata, item["blob"], item["blob_missing"], item["deduplicated"])
+
+async def register_uploads(prepared: List[Dict[str, Any]]) -> List[Union[UploadResponse, HTTPException]]:
+    """
+    Save prepared uploads in one transaction, then update stats, index and cache once
+    
+    Results are in `prepared` order; an upload that could not be stored after all is
+    returned as the HTTPException describing why. If the transaction fails, the
+    prepared files are removed before the error propagates.
+    """
+    try:
+        canonicals = await run_in_threadpool(
+            metadata_store.save_many_with_blobs, [blob_entry(item) for item in prepared]
+        )
+    except Exception:
+        discard_prepared(prepared)
+        raise
+    failures: Dict[int, HTTPException] = {}
+    
+    lost = [i for i, canonical in enumerate(canonicals) if canonical is None]
+    if lost:
+        # The shared copy was deleted after the dedup check - store these uploads' own content
+        for i in lost:
+            item = prepared[i]
+            metadata = item["metadata"]
+            logger.warning(f"Blob for {metadata['sha256']} was deleted during upload, storing a fresh copy")
+            spooled, item["spooled"] = item["spooled"], None
+            try:
+                item["blob"] = await store_own_copy(spooled, metadata["file_id"], metadata["original_filename"])
+            except HTTPException as e:
+                failures[i] = e
+            item["deduplicated"] = False
+        retry = [i for i in lost if i not in failures]
+        try:
+            retried = await run_in_threadpool(
+                metadata_store.save_many_with_blobs, [blob_entry(prepared[i]) for i in retry]
+            )
+        except Exception as e:
+            # The rest of the batch is already registered; only these uploads fail
+            logger.error(f"Registering uploads failed: {e}")
+            discard_prepared([prepared[i] for i in retry])
+            failures.update((i, HTTPException(status_code=500, detail="Internal server error")) for i in retry)
+            retry, retried = [], []
+        for i, canonical in zip(retry, retried):
+            canonicals[i] = canonical
+    
+    responses = []
+    for i, (item, canonical) in enumerate(zip(prepared, canonicals)):
+        if i in failures:
+            responses.append(failures[i])
+            continue
+        metadata, blob = item["metadata"], item["blob"]
+        deduplicated = item["deduplicated"]
+        if item["spooled"] is not None:
+            # Now referencing the shared copy; the duplicate bytes are not needed
+            item["spooled"].discard()
+            item["spooled"] = None
+        if not deduplicated and canonical["filename"] != blob["filename"]:
+            # A concurrent upload of the same content registered first; keep its copy
+            (Config.FILES_DIR / blob["filename"]).unlink(missing_ok=True)
+            deduplicated = True
+        resized = metadata["was_resized"] and not deduplicated
+        
+        stats_engine.record_upload(metadata)
+        file_index.add(metadata)
+        file_list.add(metadata)
+        
+        # Log upload with resize information
+        resize_info = " (auto-resized)" if resized else ""
+        dedup_info = f" (duplicate of {canonical['filename']})" if deduplicated else ""
+        logger.info(f"File uploaded: {metadata['original_filename']} -> {metadata['file_id']}{resize_info}{dedup_info}")
+        
+        responses.append(UploadResponse(
+            success=True,
+            file_id=metadata["file_id"],
+            url=metadata["url"],
+            original_filename=metadata["original_filename"],
+            file_size=metadata["file_size"],
+            message="File uploaded successfully",
+            deduplicated=deduplicated
+        ))
+    return responses
+
+async def store_spooled_upload(spooled: SpooledUpload, filename: str,
+                               content_type: Optional[str]) -> UploadResponse:
+    """Turn a fully received upload into a stored file (dedup, resize, metadata, index)"""
+    prepared = await prepare_spooled_upload(spooled, filename, content_type)
+    result = (await register_uploads([prepared]))[0]
+    if isinstance(result, HTTPException):
+        raise result
+    return result
+
+def multipart_upload_body(field: str, many: bool = False) -> Dict[str, Any]:
+    """OpenAPI request body for endpoints that parse their multipart upload themselves"""
+    file_schema = {"type": "string", "format": "binary"}
+    return {"requestBody": {"required": True, "content": {"multipart/form-data": {"schema": {
+        "type": "object",
+        "required": [field],
+        "properties": {field: {"type": "array", "items": file_schema} if many else file_schema}
+    }}}}}
+
+async def receive_uploads(request: Request, field: str, max_files: int, strict: bool) -> List[ReceivedFile]:
+    """Stream the request's `field` file parts into uploads/files; disallowed types are not stored"""
+    parser = MultipartUploadParser(
+        Config.FILES_DIR, Config.MAX_FILE_SIZE, field, max_files, accept=is_allowed_file, strict=strict
+    )
+    try:
+        return await parser.parse(request.headers, request.stream())
+    except MultipartError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except UploadTooLarge:
+        raise HTTPException(status_code=413, detail="File too large")
+    except TooManyFiles as e:
+        raise HTTPException(status_code=413, detail=str(e))
+
+@app.post("/upload", response_model=UploadResponse, openapi_extra=multipart_upload_body("file"))
 async def upload_file(
-    file: UploadFile = File(...),
+    request: Request,
     auth: bool = Depends(verify_api_key)
 ):
-    """Upload a file"""
+    """Upload a file (multipart field `file`)"""
+    received = []
     try:
+        # Stream the body to a temp file in uploads/files, hashing and size-checking per chunk
+        received = await receive_uploads(request, "file", max_files=1, strict=True)
+        if not received:
+            raise HTTPException(status_code=400, detail="No file provided")
+        file = received[0]
+        
         # Validate file
         if not file.filename:
             raise HTTPException(status_code=400, detail="No filename provided")
         
-        if not is_allowed_file(file.filename):
+        if not file.accepted:
             raise HTTPException(status_code=400, detail="File type not allowed")
         
-        # Read file content
-        content = await file.read()
-        file_size = len(content)
-        
-        if file_size > Config.MAX_FILE_SIZE:
-            raise HTTPException(status_code=400, detail="File too large")
-        
-        # Generate unique file ID and filename
-        file_id = str(uuid.uuid4())
-        file_extension = Path(file.filename).suffix
-        stored_filename = f"{file_id}{file_extension}"
-        
-        # Ensure files subdirectory exists
-        files_dir = Config.UPLOAD_DIR / "files"
-        files_dir.mkdir(parents=True, exist_ok=True)
-        
-        file_path = files_dir / stored_filename
-        
-        # Save file
-        with open(file_path, "wb") as f:
-            f.write(content)
-        
-        # Auto-resize images if they're too large (before creating thumbnail)
-        resized = False
-        if get_file_type(file.filename) == 'images':
-            resized = resize_image_if_needed(file_path, max_resolution=2048, quality=85)
-            # Update file size if image was resized
-            if resized:
-                file_size = file_path.stat().st_size
-        
-        # Create thumbnail for images
-        thumbnail_path = None
-        if get_file_type(file.filename) == 'images':
-            thumbnail_filename = f"{file_id}_thumb.jpg"
-            thumbnail_path = Config.THUMBNAILS_DIR / thumbnail_filename
-            create_thumbnail(file_path, thumbnail_path)
-        
-        # Generate file URL with proper extension for direct image viewing
-        file_extension = Path(file.filename).suffix.lower()
-        if get_file_type(file.filename) == 'images':
-            # For images, use direct file serving with extension
-            file_url = f"{Config.get_base_url()}/files/{file_id}{file_extension}"
-        else:
-            # For other files, use standard endpoint
-            file_url = f"{Config.get_base_url()}/files/{file_id}"
-        
-        # Save metadata
-        metadata = {
-            "file_id": file_id,
-            "original_filename": file.filename,
-            "filename": stored_filename,
-            "url": file_url,
-            "file_size": file_size,
-            "upload_time": datetime.now().isoformat(),
-            "file_type": get_file_type(file.filename),
-            "content_type": file.content_type,
-            "has_thumbnail": thumbnail_path is not None,
-            "was_resized": resized
-        }
+        is_image = get_file_type(file.filename) == 'images'
         
-        save_file_metadata(file_id, metadata)
+        # Refuse image uploads before any processing while the pool is saturated
+        if is_image and image_processor.saturated:
+            raise image_processor_busy(image_processor.retry_after)
         
-        # Invalidate file cache to ensure fresh data on next request
-        invalidate_file_cache()
+        spooled, file.spooled = file.spooled, None
+        return await store_spooled_upload(spooled, file.filename, file.content_type)
         
-        # Log upload with resize information
-        resize_info = " (auto-resized)" if resized else ""
-        logger.info(f"File uploaded: {file.filename} -> {file_id}{resize_info}")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Upload error: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+    finally:
+        for file in received:
+            file.discard()
+
+def batch_failure(filename: str, error: HTTPException) -> BatchUploadItem:
+    retry_after = (error.headers or {}).get("Retry-After")
+    return BatchUploadItem(
+        original_filename=filename, success=False, status_code=error.status_code, error=str(error.detail),
+        retry_after=int(retry_after) if retry_after else None
+    )
+
+@app.post("/upload/batch", response_model=BatchUploadResponse, openapi_extra=multipart_upload_body("files", many=True))
+async def upload_batch(
+    request: Request,
+    auth: bool = Depends(verify_api_key)
+):
+    """Upload several files in one request (multipart field `files`); results are per file, in request order"""
+    # Parts arrive one after another; oversized or disallowed ones are flagged, not stored
+    received = await receive_uploads(request, "files", max_files=Config.MAX_BATCH_FILES, strict=False)
+    
+    # Refuse the batch before any processing while the pool is saturated, as /upload does
+    if image_processor.saturated and any(
+        file.accepted and not file.too_large and get_file_type(file.filename) == 'images' for file in received
+    ):
+        for file in received:
+            file.discard()
+        raise image_processor_busy(image_processor.retry_after)
+    
+    semaphore = asyncio.Semaphore(Config.BATCH_PARALLELISM)
+    
+    async def prepare(file: ReceivedFile):
+        filename = file.filename
+        if not filename:
+            return BatchUploadItem(original_filename="", success=False, status_code=400, error="No filename provided")
+        if not file.accepted:
+            return BatchUploadItem(original_filename=filename, success=False, status_code=400, error="File type not allowed")
+        if file.too_large:
+            return BatchUploadItem(original_filename=filename, success=False, status_code=413, error="File too large")
         
-        return UploadResponse(
-            success=True,
-            file_id=file_id,
-            url=file_url,
-            original_filename=file.filename,
-            file_size=file_size,
-            message="File uploaded successfully"
-        )
+        async with semaphore:
+            try:
+                spooled, file.spooled = file.spooled, None
+                return await prepare_spooled_upload(spooled, filename, file.content_type)
+            except HTTPException as e:
+                return batch_failure(filename, e)
+            except Exception as e:
+                logger.error(f"Batch upload error for {filename}: {e}")
+                return BatchUploadItem(original_filename=filename, success=False, status_code=500, error="Internal server error")
+    
+    try:
+        outcomes = await asyncio.gather(*(prepare(file) for file in received))
+    finally:
+        for file in received:
+            file.discard()
+    
+    # One metadata transaction and one cache invalidation for everything that made it
+    prepared = [outcome for outcome in outcomes if isinstance(outcome, dict)]
+    try:
+        registered = iter(await register_uploads(prepared))
+    except Exception as e:
+        logger.error(f"Batch upload registration error: {e}")
+        registered = iter([HTTPException(status_code=500, detail="Internal server error")] * len(prepared))
+    results = []
+    for outcome in outcomes:
+        if isinstance(outcome, dict):
+            response = next(registered)
+            if isinstance(response, HTTPException):
+                results.append(batch_failure(outcome["metadata"]["original_filename"], response))
+                continue
+            outcome = BatchUploadItem(
+                original_filename=response.original_filename,
+                success=True,
+                file_id=response.file_id,
+                url=response.url,
+                file_size=response.file_size,
+                deduplicated=response.deduplicated
+            )
+        results.append(outcome)
+    
+    uploaded = sum(1 for result in results if result.success)
+    return BatchUploadResponse(
+        success=uploaded == len(results),
+        uploaded=uploaded,
+        failed=len(results) - uploaded,
+        results=results
+    )
+
+def session_info(session: Dict[str, Any]) -> UploadSessionInfo:
+    return UploadSessionInfo(
+        session_id=session["session_id"],
+        filename=session["filename"],
+        size=session["size"],
+        offset=session["offset"],
+        chunk_size=SESSION_CHUNK_SIZE,
+        expires_at=datetime.fromtimestamp(session["expires_at"]).isoformat()
+    )
+
+def get_upload_session(session_id: str) -> Dict[str, Any]:
+    try:
+        return upload_sessions.get(session_id)
+    except SessionNotFound:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+
+@app.post("/upload/sessions", response_model=UploadSessionInfo, status_code=201)
+async def create_upload_session(
+    body: CreateUploadSessionRequest,
+    response: Response,
+    auth: bool = Depends(verify_api_key)
+):
+    """Start a resumable upload - send chunks with PUT, then POST .../finalize"""
+    if not body.filename:
+        raise HTTPException(status_code=400, detail="No filename provided")
+    if not is_allowed_file(body.filename):
+        raise HTTPException(status_code=400, detail="File type not allowed")
+    try:
+        session = upload_sessions.create(body.filename, body.size, body.content_type, body.sha256)
+    except SessionOverflow:
+        raise HTTPException(status_code=413, detail="File too large")
+    
+    response.headers["Location"] = f"/upload/sessions/{session['session_id']}"
+    response.headers["Upload-Offset"] = "0"
+    return session_info(session)
+
+@app.get("/upload/sessions/{session_id}", response_model=UploadSessionInfo)
+async def get_upload_session_status(session_id: str, response: Response, auth: bool = Depends(verify_api_key)):
+    """Current offset of a resumable upload - resume by sending data from here"""
+    session = get_upload_session(session_id)
+    response.headers["Upload-Offset"] = str(session["offset"])
+    return session_info(session)
+
+@app.put("/upload/sessions/{session_id}", response_model=UploadSessionInfo)
+async def upload_session_chunk(session_id: str, request: Request, response: Response,
+                               auth: bool = Depends(verify_api_key)):
+    """Append the raw request body at the `Upload-Offset` header's position"""
+    try:
+        offset = int(request.headers["upload-offset"])
+    except (KeyError, ValueError):
+        raise HTTPException(status_code=400, detail="Upload-Offset header required")
+    
+    try:
+        session = await upload_sessions.append(session_id, offset, request.stream())
+    except SessionNotFound:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    except OffsetMismatch as e:
+        raise HTTPException(status_code=409, detail="Offset mismatch",
+                            headers={"Upload-Offset": str(e.offset)})
+    except SessionOverflow:
+        raise HTTPException(status_code=413, detail="Chunk exceeds declared upload size")
+    
+    response.headers["Upload-Offset"] = str(session["offset"])
+    return session_info(session)
+
+@app.post("/upload/sessions/{session_id}/finalize", response_model=UploadResponse)
+async def finalize_upload_session(session_id: str, auth: bool = Depends(verify_api_key)):
+    """Store a fully received resumable upload, exactly like POST /upload"""
+    try:
+        async with upload_sessions.lock(session_id):
+            try:
+                spooled = await upload_sessions.finalize(session_id)
+            except SessionIncomplete as e:
+                raise HTTPException(status_code=409, detail=str(e))
+            
+            session = upload_sessions.get(session_id)
+            # Refuse early while the pool is saturated. If it fills up later, or storing fails
+            # otherwise, the part file is still with the session and finalize can be retried
+            if get_file_type(session["filename"]) == 'images' and image_processor.saturated:
+                raise image_processor_busy(image_processor.retry_after)
+            
+            result = await store_spooled_upload(spooled, session["filename"], session["content_type"])
+            upload_sessions.complete(session_id)
+            return result
         
+    except SessionNotFound:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    except SessionBusy:
+        raise HTTPException(status_code=503, detail="Upload session is busy", headers={"Retry-After": "1"})
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Upload error: {e}")
+        logger.error(f"Finalize upload session error: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
+@app.delete("/upload/sessions/{session_id}", response_model=DeleteResponse)
+async def abort_upload_session(session_id: str, auth: bool = Depends(verify_api_key)):
+    """Cancel a resumable upload and discard its data"""
+    try:
+        aborted = await upload_sessions.abort(session_id)
+    except SessionBusy:
+        raise HTTPException(status_code=503, detail="Upload session is busy", headers={"Retry-After": "1"})
+    if not aborted:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    return DeleteResponse(success=True, message="Upload session cancelled")
+
+def transcoded_response(request: Request, entry, fmt: str, headers: dict):
+    """Serve the `fmt` re-encoding of an image when one smaller than the original exists, otherwise start making it"""
+    path, stat = transcode_cache.lookup(entry.path, fmt, entry.size)
+    if path is None:
+        # Encoding a 4K screenshot takes a while: this request gets the original, later ones the transcode
+        if transcode_cache.wanted(entry.path, fmt) and not transcode_processor.saturated:
+            source_path = entry.path
+            transcode_cache.schedule(
+                source_path, fmt, entry.size,
+                lambda dest: run_image_job("transcode", render_variant, source_path, dest, None, fmt,
+                                           TRANSCODE_QUALITY, processor=transcode_processor)
+            )
+        return None
+    etag = variant_etag(entry.etag, None, fmt)
+    return serve_file(request.headers, path, stat, etag, VARIANT_FORMATS[fmt][1], headers, pool=file_pool)
+
 @app.get("/files/{file_id}")
-async def get_file(file_id: str):
+async def get_file(file_id: str, request: Request):
     """Get a file by ID - handles both with and without extensions"""
     try:
         # Parse file_id and extension if present
@@ -454,59 +1037,46 @@ async def get_file(file_id: str):
             actual_file_id, ext = file_id.rsplit('.', 1)
             extension = f".{ext}"
         
-        # Load metadata
-        metadata = load_file_metadata(actual_file_id)
-        if not metadata:
-            raise HTTPException(status_code=404, detail=f"File metadata not found for ID: {actual_file_id}")
-        
-        # Get filename from metadata
-        filename = metadata.get("filename")
-        if not filename:
-            raise HTTPException(status_code=404, detail="File metadata incomplete - no filename")
+        # Resident index lookup - no metadata I/O or stat probes on the hot path
+        entry = file_index.get(actual_file_id)
+        if entry is None:
+            # Not indexed yet (e.g. written by another process) - fall back to the store once
+            metadata = load_file_metadata(actual_file_id)
+            if not metadata:
+                raise HTTPException(status_code=404, detail=f"File metadata not found for ID: {actual_file_id}")
             
-        # Try to find the file in the correct location
-        # New files are stored in uploads/files/
-        file_path = Config.UPLOAD_DIR / "files" / filename
+            entry = file_index.add(metadata)
+            if entry is None:
+                filename = metadata.get("filename")
+                if not filename:
+                    raise HTTPException(status_code=404, detail="File metadata incomplete - no filename")
+                raise HTTPException(status_code=404, detail=f"File not found on disk: {filename}")
         
-        if not file_path.exists():
-            # Fallback: try the root upload directory for older files
-            file_path = Config.UPLOAD_DIR / filename
-            
-        if not file_path.exists():
-            # Debug logging to understand what's happening
-            logger.error(f"File not found: {filename}")
-            logger.error(f"Checked paths:")
-            logger.error(f"  - {Config.UPLOAD_DIR / 'files' / filename}")
-            logger.error(f"  - {Config.UPLOAD_DIR / filename}")
-            logger.error(f"Upload dir contents: {list(Config.UPLOAD_DIR.iterdir()) if Config.UPLOAD_DIR.exists() else 'Directory does not exist'}")
-            files_dir = Config.UPLOAD_DIR / "files"
-            logger.error(f"Files dir contents: {list(files_dir.iterdir()) if files_dir.exists() else 'Directory does not exist'}")
-            raise HTTPException(status_code=404, detail=f"File not found on disk: {filename}")
-        
-        # Determine content type and display behavior
-        content_type = metadata.get("content_type", "application/octet-stream")
-        original_filename = metadata.get("original_filename", filename)
-        
-        # Enhanced image serving logic for better browser compatibility
+        file_path = entry.path
+        content_type = entry.content_type
+        original_filename = entry.original_filename
+        
+        # Conditional and Range requests are answered from the index's validators and stat
         if extension and get_file_type(original_filename) == 'images':
             # For images accessed with extension, serve inline with proper headers
             headers = {
                 "Content-Disposition": "inline",
-                "Cache-Control": "public, max-age=3600",  # Cache for 1 hour
                 "Cross-Origin-Resource-Policy": "cross-origin"  # Allow cross-origin access
             }
-            return FileResponse(
-                path=file_path,
-                media_type=content_type,
-                headers=headers
-            )
+            if NEGOTIABLE_FORMATS and file_path.suffix.lower() in TRANSCODABLE_EXTENSIONS:
+                # Same URL, different bytes depending on Accept - shared caches must key on it
+                headers["Vary"] = "Accept"
+                fmt = negotiate_format(request.headers.get("accept"), NEGOTIABLE_FORMATS)
+                if fmt is not None:
+                    response = transcoded_response(request, entry, fmt, headers)
+                    if response is not None:
+                        return response
+            return serve_file(request.headers, file_path, entry.stat, entry.etag, content_type, headers,
+                              pool=file_pool)
         else:
             # Standard download behavior for non-images or access without extension
-            return FileResponse(
-                path=file_path,
-                filename=original_filename,
-                media_type=content_type
-            )
+            return serve_file(request.headers, file_path, entry.stat, entry.etag, content_type, {},
+                              filename=original_filename, pool=file_pool)
         
     except HTTPException:
         raise
@@ -524,17 +1094,46 @@ async def get_file_info(file_id: str, auth: bool = Depends(verify_api_key)):
     return FileInfo(**metadata)
 
 @app.get("/files/{file_id}/thumbnail")
-async def get_thumbnail(file_id: str):
-    """Get file thumbnail"""
+async def get_thumbnail(
+    file_id: str,
+    request: Request,
+    w: Optional[int] = None,
+    h: Optional[int] = None,
+    fmt: Optional[str] = None
+):
+    """Get file thumbnail - `w`/`h`/`fmt` select any other size (generated once, then cached)"""
     try:
-        thumbnail_path = Config.THUMBNAILS_DIR / f"{file_id}_thumb.jpg"
-        if not thumbnail_path.exists():
+        headers = {"Cross-Origin-Resource-Policy": "cross-origin"}
+        if fmt is None:
+            # No explicit format: WebP/AVIF if the client accepts them, JPEG otherwise
+            fmt = negotiate_format(request.headers.get("accept"), NEGOTIABLE_FORMATS) or "jpeg"
+            headers["Vary"] = "Accept"
+        fmt = "jpeg" if fmt.lower() == "jpg" else fmt.lower()
+        if fmt not in VARIANT_FORMATS:
+            raise HTTPException(status_code=400, detail=f"Unsupported format, use one of: {', '.join(VARIANT_FORMATS)}")
+        
+        entry = file_index.get(file_id)
+        if entry is None:
+            metadata = load_file_metadata(file_id)
+            entry = file_index.add(metadata) if metadata else None
+        if entry is None or get_file_type(entry.original_filename) != 'images':
             raise HTTPException(status_code=404, detail="Thumbnail not found")
         
-        return FileResponse(
-            path=thumbnail_path,
-            media_type="image/jpeg"
-        )
+        size = normalize_variant_size(w, h)
+        media_type, extension = VARIANT_FORMATS[fmt][1:]
+        # Named after the stored blob, so deduplicated uploads share their variants
+        name = variant_name(entry.path.stem, size, extension)
+        source_path = entry.path
+        try:
+            variant_path = await variant_cache.get_or_create(
+                name, lambda path: run_image_job("thumbnail", render_variant, source_path, path, size, fmt, 85)
+            )
+        except ImageProcessorBusy as e:
+            raise image_processor_busy(e.retry_after)
+        
+        variant_stat = os.stat(variant_path)
+        etag = variant_etag(entry.etag, size, fmt)
+        return serve_file(request.headers, variant_path, variant_stat, etag, media_type, headers, pool=file_pool)
         
     except HTTPException:
         raise
@@ -542,21 +1141,56 @@ async def get_thumbnail(file_id: str):
         logger.error(f"Get thumbnail error: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
+MAX_PAGE_SIZE = 500
+
+async def query_file_page(limit: int, cursor: Optional[str], offset: int, **filters):
+    """
+    Fetch one keyset page from the store; returns (page, next_cursor, total_count)
+    
+    With no filter but the file type, total_count comes from the running stats. Date
+    and name filters are counted once, on the first page; later pages return None.
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    try:
+        cursor_key = decode_cursor(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    
+    page, next_key = await run_in_threadpool(
+        metadata_store.query_page, limit, cursor=cursor_key, offset=offset, **filters
+    )
+    next_cursor = encode_cursor(*next_key) if next_key else None
+    
+    if not any(value for key, value in filters.items() if key != "file_type"):
+        total_count = stats_engine.file_count(filters.get("file_type"))
+    elif cursor_key is None:
+        total_count = await run_in_threadpool(metadata_store.count_matching, **filters)
+    else:
+        total_count = None
+    return page, next_cursor, total_count
+
 @app.get("/files", response_model=ListFilesResponse)
 async def list_files(
     limit: int = 50,
     offset: int = 0,
+    cursor: Optional[str] = None,
+    file_type: Optional[str] = None,
+    uploaded_after: Optional[str] = None,
+    uploaded_before: Optional[str] = None,
+    name_prefix: Optional[str] = None,
     auth: bool = Depends(verify_api_key)
 ):
-    """List all files"""
+    """List files newest first - pass `next_cursor` back as `cursor` to walk pages"""
     try:
-        all_files = get_all_files()
-        
-        # Pagination
-        total_count = len(all_files)
-        files = all_files[offset:offset + limit]
+        files, next_cursor, total_count = await query_file_page(
+            limit, cursor, offset,
+            file_type=file_type,
+            uploaded_after=uploaded_after,
+            uploaded_before=uploaded_before,
+            name_prefix=name_prefix
+        )
         
-        # Convert to FileInfo objects
+        # Only the requested page is converted to FileInfo objects
         file_infos = []
         for file_data in files:
             try:
@@ -567,9 +1201,12 @@ async def list_files(
         
         return ListFilesResponse(
             files=file_infos,
-            total_count=total_count
+            total_count=total_count,
+            next_cursor=next_cursor
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"List files error: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
@@ -578,34 +1215,9 @@ async def list_files(
 async def delete_file(file_id: str, auth: bool = Depends(verify_api_key)):
     """Delete a file"""
     try:
-        # Load metadata
-        metadata = load_file_metadata(file_id)
-        if not metadata:
+        if not await purge_files([file_id]):
             raise HTTPException(status_code=404, detail="File not found")
         
-        # Delete actual file - handle both old and new metadata formats
-        filename = metadata.get("filename", metadata.get("stored_filename"))
-        if filename:
-            file_path = Config.UPLOAD_DIR / "files" / filename
-            if not file_path.exists():
-                # Try in the root upload directory for older files
-                file_path = Config.UPLOAD_DIR / filename
-            if file_path.exists():
-                file_path.unlink()
-        
-        # Delete thumbnail if exists
-        thumbnail_path = Config.THUMBNAILS_DIR / f"{file_id}_thumb.jpg"
-        if thumbnail_path.exists():
-            thumbnail_path.unlink()
-        
-        # Delete metadata
-        metadata_path = Config.UPLOAD_DIR / f"{file_id}.json"
-        if metadata_path.exists():
-            metadata_path.unlink()
-        
-        # Invalidate file cache to ensure fresh data on next request
-        invalidate_file_cache()
-        
         logger.info(f"File deleted: {file_id}")
         
         return DeleteResponse(
@@ -626,89 +1238,69 @@ async def delete_old_files(
 ):
     """Delete files older than specified days"""
     try:
-        cutoff_date = datetime.now() - timedelta(days=days)
-        deleted_count = 0
-        
-        all_files = get_all_files()
-        
-        for file_data in all_files:
-            try:
-                upload_time = datetime.fromisoformat(file_data["upload_time"])
-                
-                if upload_time < cutoff_date:
-                    # Delete the file
-                    await delete_file(file_data["file_id"])
-                    deleted_count += 1
-                    
-            except Exception as e:
-                logger.error(f"Error processing file for deletion: {e}")
-                continue
-        
-        # Invalidate file cache once after all deletions
-        if deleted_count > 0:
-            invalidate_file_cache()
+        report = await enforce_retention(RetentionPolicy(max_age_days=days), dry_run=False)
         
         return DeleteResponse(
             success=True,
-            message=f"Deleted {deleted_count} old files"
+            message=f"Deleted {report.deleted} old files"
         )
         
     except Exception as e:
         logger.error(f"Delete old files error: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
+@app.get("/retention", response_model=RetentionReport)
+async def preview_retention(
+    max_age_days: Optional[float] = None,
+    max_total_mb: Optional[float] = None,
+    type_quotas_mb: Optional[str] = None,
+    auth: bool = Depends(verify_api_key)
+):
+    """What the retention policy (the configured one, or the one given) would delete"""
+    return await enforce_retention(retention_policy_for(max_age_days, max_total_mb, type_quotas_mb), dry_run=True)
+
+@app.post("/retention", response_model=RetentionReport)
+async def apply_retention(
+    max_age_days: Optional[float] = None,
+    max_total_mb: Optional[float] = None,
+    type_quotas_mb: Optional[str] = None,
+    dry_run: bool = False,
+    auth: bool = Depends(verify_api_key)
+):
+    """Delete what the retention policy (the configured one, or the one given) selects"""
+    policy = retention_policy_for(max_age_days, max_total_mb, type_quotas_mb)
+    if not policy.enabled:
+        raise HTTPException(status_code=400, detail="No retention limits configured or given")
+    try:
+        report = await enforce_retention(policy, dry_run=dry_run)
+    except Exception as e:
+        logger.error(f"Retention error: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+    if report.deleted:
+        logger.info(f"Retention removed {report.deleted} files ({report.bytes} bytes)")
+    return report
+
+def retention_policy_for(max_age_days: Optional[float], max_total_mb: Optional[float],
+                         type_quotas_mb: Optional[str]) -> RetentionPolicy:
+    """The configured policy, or one built from request parameters when any are given"""
+    if max_age_days is None and max_total_mb is None and type_quotas_mb is None:
+        return retention_policy
+    return RetentionPolicy(
+        max_age_days=max_age_days,
+        max_total_bytes=int(max_total_mb * 1024 * 1024) if max_total_mb is not None else None,
+        type_quotas=parse_type_quotas(type_quotas_mb)
+    )
+
+@app.get("/metrics")
+async def get_metrics(auth: bool = Depends(verify_api_key)):
+    """Prometheus text exposition of this worker's metrics"""
+    return Response(content=metrics.render(), media_type=metrics.content_type)
+
 @app.get("/stats")
 async def get_stats(auth: bool = Depends(verify_api_key)):
-    """Get server statistics with caching for better performance"""
-    global _stats_cache, _stats_cache_timestamp
-    current_time = time.time()
-    
-    # Check if stats cache is still valid
-    if current_time - _stats_cache_timestamp < STATS_CACHE_TTL and _stats_cache:
-        return _stats_cache
-    
+    """Get server statistics from the running counters"""
     try:
-        all_files = get_all_files()
-        
-        if not all_files:
-            # Handle empty file list case
-            stats = {
-                "total_files": 0,
-                "total_size_bytes": 0,
-                "total_size_mb": 0.0,
-                "file_types": {},
-                "server_uptime": "Server running"
-            }
-        else:
-            # Optimized single-pass calculation
-            total_files = len(all_files)
-            total_size = 0
-            type_counts = {}
-            
-            for file_data in all_files:
-                # Size calculation
-                file_size = file_data.get("file_size", 0)
-                if isinstance(file_size, (int, float)):
-                    total_size += file_size
-                
-                # Type counting
-                file_type = file_data.get("file_type", "unknown")
-                type_counts[file_type] = type_counts.get(file_type, 0) + 1
-            
-            stats = {
-                "total_files": total_files,
-                "total_size_bytes": total_size,
-                "total_size_mb": round(total_size / (1024 * 1024), 2) if total_size > 0 else 0.0,
-                "file_types": type_counts,
-                "server_uptime": "Server running"
-            }
-        
-        # Update stats cache
-        _stats_cache = stats
-        _stats_cache_timestamp = current_time
-        
-        return stats
-        
+        return stats_engine.snapshot()
     except Exception as e:
         logger.error(f"Get stats error: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
@@ -771,27 +1363,46 @@ async def admin_comparison(request: Request):
     return templates.TemplateResponse("admin_comparison.html", {"request": request})
 
 @app.get("/admin/files")
-async def admin_get_files():
-    """Get all files for admin dashboard"""
+async def admin_get_files(
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    file_type: Optional[str] = None,
+    uploaded_after: Optional[str] = None,
+    uploaded_before: Optional[str] = None,
+    name_prefix: Optional[str] = None
+):
+    """Get files for admin dashboard - all of them, or one cursor page when `limit` is given"""
     try:
-        all_files = get_all_files()
+        filters = {
+            "file_type": file_type,
+            "uploaded_after": uploaded_after,
+            "uploaded_before": uploaded_before,
+            "name_prefix": name_prefix
+        }
+        next_cursor = None
+        if limit is None and cursor is None and not any(filters.values()):
+            page = get_all_files()
+            total_count = len(page)
+        else:
+            page, next_cursor, total_count = await query_file_page(limit or 50, cursor, 0, **filters)
+        
+        base_url = Config.get_base_url()
         
         # Convert to FileInfo format with proper URLs
         files = []
-        for file_data in all_files:
+        for file_data in page:
             # Generate proper URL with extension for images
             file_id = file_data["file_id"]
             file_extension = Path(file_data["original_filename"]).suffix
             
             if get_file_type(file_data["original_filename"]) == 'images':
-                url = f"{Config.get_base_url()}/files/{file_id}{file_extension}"
+                url = f"{base_url}/files/{file_id}{file_extension}"
             else:
-                url = f"{Config.get_base_url()}/files/{file_id}"
+                url = f"{base_url}/files/{file_id}"
             
-            # Check if thumbnail exists
-            thumbnail_path = Config.THUMBNAILS_DIR / f"{file_id}_thumb.jpg"
-            has_thumbnail = thumbnail_path.exists()
-            thumbnail_url = f"{Config.get_base_url()}/files/{file_id}/thumbnail" if has_thumbnail else None
+            # Every image has a thumbnail, generated on first request
+            has_thumbnail = get_file_type(file_data["original_filename"]) == 'images'
+            thumbnail_url = f"{base_url}/files/{file_id}/thumbnail" if has_thumbnail else None
             
             file_info = FileInfo(
                 file_id=file_data["file_id"],
@@ -809,8 +1420,10 @@ async def admin_get_files():
             file_dict["has_thumbnail"] = has_thumbnail
             files.append(file_dict)
         
-        return {"files": files, "total_count": len(files)}
+        return {"files": files, "total_count": total_count, "next_cursor": next_cursor}
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Admin get files error: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
@@ -825,87 +1438,25 @@ async def admin_delete_file(file_id: str):
         logger.error(f"Admin delete file error: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
+def admin_file_category(file_type: Any) -> str:
+    """Bucket a stored file_type into the admin dashboard categories"""
+    category = "other"
+    if isinstance(file_type, str):
+        if file_type.startswith("image/"):
+            category = "images"
+        elif file_type.startswith("video/"):
+            category = "videos"
+        elif file_type.startswith("audio/"):
+            category = "audio"
+        elif "pdf" in file_type or "document" in file_type:
+            category = "documents"
+    return category
+
 @app.get("/admin/stats")
 async def admin_get_stats():
-    """Get detailed statistics for admin dashboard with caching"""
-    global _stats_cache, _stats_cache_timestamp
-    current_time = time.time()
-    
-    # Check if detailed stats cache exists and is valid
-    admin_cache_key = 'admin_stats'
-    if (current_time - _stats_cache_timestamp < STATS_CACHE_TTL and 
-        _stats_cache and admin_cache_key in _stats_cache):
-        return _stats_cache[admin_cache_key]
-    
+    """Get detailed statistics for admin dashboard from the running counters"""
     try:
-        all_files = get_all_files()
-        
-        if not all_files:
-            # Handle empty file list case
-            admin_stats = {
-                "total_files": 0,
-                "total_size_bytes": 0,
-                "total_size_mb": 0.0,
-                "uploads_today": 0,
-                "file_types": {},
-                "server_uptime": "Online"
-            }
-        else:
-            total_files = len(all_files)
-            total_size = 0
-            uploads_today = 0
-            type_counts = {}
-            today = datetime.now().date()
-            
-            # Single-pass optimization
-            for file_data in all_files:
-                # Size calculation
-                file_size = file_data.get("file_size", 0)
-                if isinstance(file_size, (int, float)):
-                    total_size += file_size
-                
-                # Uploads today calculation
-                try:
-                    upload_time = file_data.get("upload_time")
-                    if upload_time:
-                        upload_date = datetime.fromisoformat(upload_time).date()
-                        if upload_date == today:
-                            uploads_today += 1
-                except Exception:
-                    pass  # Skip invalid dates
-                
-                # File type categorization
-                file_type = file_data.get("file_type", "unknown")
-                category = "other"
-                if isinstance(file_type, str):
-                    if file_type.startswith("image/"):
-                        category = "images"
-                    elif file_type.startswith("video/"):
-                        category = "videos"
-                    elif file_type.startswith("audio/"):
-                        category = "audio"
-                    elif "pdf" in file_type or "document" in file_type:
-                        category = "documents"
-                
-                type_counts[category] = type_counts.get(category, 0) + 1
-            
-            admin_stats = {
-                "total_files": total_files,
-                "total_size_bytes": total_size,
-                "total_size_mb": round(total_size / (1024 * 1024), 2) if total_size > 0 else 0.0,
-                "uploads_today": uploads_today,
-                "file_types": type_counts,
-                "server_uptime": "Online"
-            }
-        
-        # Update admin stats cache
-        if not _stats_cache:
-            _stats_cache = {}
-        _stats_cache[admin_cache_key] = admin_stats
-        _stats_cache_timestamp = current_time
-        
-        return admin_stats
-        
+        return stats_engine.admin_snapshot(admin_file_category)
     except Exception as e:
         logger.error(f"Admin get stats error: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
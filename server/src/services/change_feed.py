@@ -0,0 +1,76 @@
+"""
+Change feed
+Keeps one server process's in-memory state in step with writes made by the other worker processes
+"""
+
+import os
+import time
+import uuid
+import asyncio
+import logging
+from typing import Callable, Dict, Any, List, Optional
+
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+# Entries read per poll
+POLL_BATCH = 1000
+# Entries are kept this long; workers poll every fraction of a second
+CHANGE_LOG_TTL = 3600
+PRUNE_INTERVAL = 300
+
+
+def new_origin() -> str:
+    """Identifies this process's entries in the change log"""
+    return f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+class ChangeFeed:
+    """
+    Follows the metadata store's change log
+
+    Each worker writes its own changes to the log as part of the metadata transaction
+    and applies them to its own state directly; the feed hands every other worker's
+    entries to `apply(changes)` on the event loop. Build in-memory state from a
+    store snapshot and `mark()` its position, so every change is either in the
+    snapshot or applied by the feed - never missed, never counted twice.
+    """
+
+    def __init__(self, store, apply: Callable[[List[Dict[str, Any]]], None]):
+        self.store = store
+        self.apply = apply
+        self.position = 0
+        self._last_prune = 0.0
+
+    def mark(self, position: Optional[int] = None):
+        """Follow the log from `position` (default: its current end)"""
+        self.position = self.store.last_change() if position is None else position
+
+    async def poll(self) -> int:
+        """Apply everything other workers wrote since the last poll; returns the entry count"""
+        applied = 0
+        while True:
+            changes = await run_in_threadpool(self.store.changes_since, self.position, POLL_BATCH)
+            if not changes:
+                return applied
+            self.position = changes[-1]["seq"]
+            remote = [change for change in changes if change["origin"] != self.store.origin]
+            if remote:
+                self.apply(remote)
+                applied += len(remote)
+            if len(changes) < POLL_BATCH:
+                return applied
+
+    async def run(self, interval: float):
+        """Poll every `interval` seconds until cancelled"""
+        while True:
+            try:
+                await self.poll()
+                now = time.time()
+                if now - self._last_prune > PRUNE_INTERVAL:
+                    self._last_prune = now
+                    await run_in_threadpool(self.store.prune_changes, now - CHANGE_LOG_TTL)
+            except Exception as e:
+                logger.error(f"Change feed error: {e}")
+            await asyncio.sleep(interval)
@@ -0,0 +1,103 @@
+"""
+Resident file index
+file_id -> resolved on-disk path, content type and stat, so serving a file needs no metadata I/O
+"""
+
+import os
+import logging
+import threading
+from pathlib import Path
+from typing import Optional, Dict, Any, Iterable, Sequence
+
+from .file_serving import content_etag
+
+logger = logging.getLogger(__name__)
+
+
+def thumbnail_filename(metadata: Dict[str, Any]) -> str:
+    """Stored thumbnail file for a record (written at upload time by older servers)"""
+    return metadata.get("thumbnail") or f"{metadata.get('file_id')}_thumb.jpg"
+
+
+class IndexEntry:
+    """Everything the /files/{file_id} hot path needs about one stored file"""
+
+    __slots__ = ("file_id", "path", "content_type", "original_filename", "stat", "etag")
+
+    def __init__(self, file_id: str, path: Path, content_type: Optional[str], original_filename: str,
+                 stat: os.stat_result, etag: str):
+        self.file_id = file_id
+        self.path = path
+        self.content_type = content_type
+        self.original_filename = original_filename
+        self.stat = stat
+        self.etag = etag
+
+    @property
+    def size(self) -> int:
+        return self.stat.st_size
+
+
+class FileIndex:
+    """
+    In-memory index of stored files keyed by file_id
+
+    Populated once at startup and kept current by upload/delete. Paths are resolved
+    against `search_dirs` in order (uploads/files first, then the legacy upload root).
+    """
+
+    def __init__(self, search_dirs: Sequence[Path]):
+        self.search_dirs = list(search_dirs)
+        self._entries: Dict[str, IndexEntry] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _resolve(self, filename: str):
+        for directory in self.search_dirs:
+            path = directory / filename
+            try:
+                return path, os.stat(path)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+        return None, None
+
+    def add(self, metadata: Dict[str, Any]) -> Optional[IndexEntry]:
+        """Index (or re-index) one file from its metadata; None if it is missing on disk"""
+        file_id = metadata.get("file_id")
+        filename = metadata.get("filename", metadata.get("stored_filename"))
+        if not file_id or not filename:
+            return None
+
+        path, stat = self._resolve(filename)
+        if path is None:
+            logger.warning(f"File not found on disk for {file_id}: {filename}")
+            return None
+
+        entry = IndexEntry(
+            file_id=file_id,
+            path=path,
+            content_type=metadata.get("content_type", "application/octet-stream"),
+            original_filename=metadata.get("original_filename", filename),
+            stat=stat,
+            etag=metadata.get("etag") or content_etag(None, stat)
+        )
+        with self._lock:
+            self._entries[file_id] = entry
+        return entry
+
+    def build(self, records: Iterable[Dict[str, Any]]) -> int:
+        """Replace the index contents from a full set of metadata records"""
+        with self._lock:
+            self._entries = {}
+        indexed = sum(1 for metadata in records if self.add(metadata) is not None)
+        logger.info(f"File index built with {indexed} entries")
+        return indexed
+
+    def get(self, file_id: str) -> Optional[IndexEntry]:
+        return self._entries.get(file_id)
+
+    def remove(self, file_id: str) -> Optional[IndexEntry]:
+        with self._lock:
+            return self._entries.pop(file_id, None)
@@ -0,0 +1,89 @@
+"""
+File list cache
+Resident, always-warm list of all file metadata kept in upload order by applying each write as a delta
+"""
+
+import bisect
+import threading
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+
+
+class FileListCache:
+    """
+    All metadata, sorted by (upload_time, file_id)
+
+    Uploads are inserted with bisect.insort and deletes removed by id, so a write costs
+    a binary search plus a list shift instead of reloading every row from the store.
+    Every write bumps `generation`; the newest-first list readers get is built at most
+    once per generation and shared until the next write.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys: List[Tuple[str, str]] = []
+        self._entries: Dict[str, Tuple[Tuple[str, str], Dict[str, Any]]] = {}
+        self.generation = 0
+        self._snapshot: Optional[List[Dict[str, Any]]] = None
+        self._snapshot_generation = -1
+        # Reads served from the current snapshot / that had to rebuild it
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(metadata: Dict[str, Any]) -> Tuple[str, str]:
+        upload_time = metadata.get("upload_time")
+        return upload_time if isinstance(upload_time, str) else "", metadata.get("file_id", "")
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def load(self, files: Iterable[Dict[str, Any]]):
+        """Replace the contents (startup)"""
+        entries = {}
+        for metadata in files:
+            if metadata.get("file_id"):
+                entries[metadata["file_id"]] = (self._key(metadata), metadata)
+        with self._lock:
+            self._entries = entries
+            self._keys = sorted(key for key, _ in entries.values())
+            self.generation += 1
+
+    def _discard(self, file_id: str) -> bool:
+        entry = self._entries.pop(file_id, None)
+        if entry is None:
+            return False
+        index = bisect.bisect_left(self._keys, entry[0])
+        if index < len(self._keys) and self._keys[index] == entry[0]:
+            del self._keys[index]
+        return True
+
+    def add(self, metadata: Dict[str, Any]):
+        """Insert a file, or move it if it was already listed"""
+        file_id = metadata.get("file_id")
+        if not file_id:
+            return
+        key = self._key(metadata)
+        with self._lock:
+            self._discard(file_id)
+            self._entries[file_id] = (key, metadata)
+            bisect.insort(self._keys, key)
+            self.generation += 1
+
+    def remove(self, file_id: str) -> bool:
+        with self._lock:
+            if not self._discard(file_id):
+                return False
+            self.generation += 1
+            return True
+
+    def newest_first(self) -> List[Dict[str, Any]]:
+        """Every file's metadata, newest first; callers must not modify the list"""
+        with self._lock:
+            if self._snapshot_generation == self.generation:
+                self.hits += 1
+                return self._snapshot
+            self.misses += 1
+            entries = self._entries
+            self._snapshot = [entries[file_id][1] for _, file_id in reversed(self._keys)]
+            self._snapshot_generation = self.generation
+            return self._snapshot
@@ -0,0 +1,466 @@
+"""
+File serving helpers
+Validators (ETag / Last-Modified), conditional request handling and cache headers for stored files
+"""
+
+import os
+import uuid
+import hashlib
+import mimetypes
+import threading
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Optional, Mapping, List, Tuple
+from urllib.parse import quote
+
+import anyio
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response, FileResponse
+
+# Stored files never change after upload (file_id is a fresh UUID), so caches may keep them forever
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def content_etag(content_hash: Optional[str], stat: Optional[os.stat_result]) -> str:
+    """Strong ETag from the upload hash, or from mtime/size for files stored before hashing existed"""
+    if content_hash:
+        return f'"{content_hash}"'
+    etag_base = f"{stat.st_mtime}-{stat.st_size}"
+    return f'"{hashlib.md5(etag_base.encode(), usedforsecurity=False).hexdigest()}"'
+
+
+def http_date(timestamp: float) -> str:
+    """RFC 7231 date for Last-Modified"""
+    return formatdate(timestamp, usegmt=True)
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison, as required for If-None-Match
+    opaque = etag.removeprefix("W/")
+    for candidate in if_none_match.split(","):
+        if candidate.strip().removeprefix("W/") == opaque:
+            return True
+    return False
+
+
+def is_not_modified(request_headers: Mapping[str, str], etag: str, last_modified: float) -> bool:
+    """True when the client's cached copy is still valid (If-None-Match wins over If-Modified-Since)"""
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match is not None:
+        return _etag_matches(if_none_match, etag)
+
+    if_modified_since = request_headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            return False
+        # HTTP dates have one second resolution
+        return int(last_modified) <= int(since.timestamp())
+
+    return False
+
+
+def validator_headers(etag: str, last_modified: float,
+                      cache_control: str = IMMUTABLE_CACHE_CONTROL) -> dict:
+    """Headers shared by 200 and 304 responses"""
+    return {
+        "ETag": etag,
+        "Last-Modified": http_date(last_modified),
+        "Cache-Control": cache_control,
+    }
+
+
+def content_disposition(filename: str, disposition_type: str = "attachment") -> str:
+    """Content-Disposition value, RFC 5987-encoded for non-ASCII names (same as FileResponse)"""
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"{disposition_type}; filename*=utf-8''{quoted}"
+    return f'{disposition_type}; filename="{filename}"'
+
+
+def not_modified_response(headers: dict) -> Response:
+    """Bodyless 304 carrying the same validators and cache headers as the full response"""
+    return Response(status_code=304, headers=headers)
+
+
+# Ranges per request before we give up and send the whole file (multi-range abuse guard)
+MAX_RANGES = 16
+RANGE_CHUNK_SIZE = 64 * 1024
+
+
+class RangeNotSatisfiable(Exception):
+    """No requested range overlaps the file"""
+    pass
+
+
+def parse_range_header(range_header: str, size: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    Parse a `Range: bytes=...` header into sorted, merged, inclusive (start, end) pairs
+
+    Returns None when the header should be ignored (other units, malformed, too many
+    ranges), which means "send the full file". Raises RangeNotSatisfiable when it is
+    well-formed but nothing overlaps the file.
+    """
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or not spec.strip():
+        return None
+
+    ranges = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        start_text, sep, end_text = part.partition("-")
+        if not sep:
+            return None
+        try:
+            if start_text == "":
+                # Suffix range: last N bytes
+                length = int(end_text)
+                if length <= 0:
+                    continue
+                start, end = max(size - length, 0), size - 1
+            else:
+                start = int(start_text)
+                end = int(end_text) if end_text else None
+                if start < 0 or (end is not None and end < start):
+                    return None
+                end = size - 1 if end is None else min(end, size - 1)
+        except ValueError:
+            return None
+
+        if start < size:
+            ranges.append((start, end))
+
+    if len(ranges) > MAX_RANGES:
+        return None
+    if not ranges:
+        raise RangeNotSatisfiable()
+
+    # Merge overlapping/adjacent ranges so a client can't make us send bytes twice
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end + 1:
+            merged[-1] = (last_start, max(last_end, end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def if_range_allows(if_range: Optional[str], etag: str, last_modified: float) -> bool:
+    """True when a Range request may be honoured given its If-Range precondition"""
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        # Strong comparison only; weak validators never match If-Range
+        return not if_range.startswith("W/") and if_range == etag
+    try:
+        since = parsedate_to_datetime(if_range)
+    except (TypeError, ValueError):
+        return False
+    return since.tzinfo is not None and int(since.timestamp()) == int(last_modified)
+
+
+class RangeFileResponse(Response):
+    """206 Partial Content for one range, or multipart/byteranges for several"""
+
+    def __init__(self, path, ranges: List[Tuple[int, int]], size: int,
+                 media_type: Optional[str], headers: dict):
+        self.path = path
+        self.ranges = ranges
+        self.size = size
+        self.part_media_type = media_type or mimetypes.guess_type(str(path))[0] or "application/octet-stream"
+        self.background = None
+        self.status_code = 206
+        self.media_type = None
+
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            self.boundary = None
+            self.media_type = self.part_media_type
+            headers = dict(headers)
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+            content_length = end - start + 1
+        else:
+            self.boundary = uuid.uuid4().hex
+            self.media_type = f"multipart/byteranges; boundary={self.boundary}"
+            content_length = sum(
+                len(self._part_header(start, end)) + (end - start + 1) + 2 for start, end in ranges
+            ) + len(self._closing())
+
+        self.init_headers(headers)
+        self.headers["content-length"] = str(content_length)
+
+    def _part_header(self, start: int, end: int) -> bytes:
+        return (
+            f"--{self.boundary}\r\n"
+            f"Content-Type: {self.part_media_type}\r\n"
+            f"Content-Range: bytes {start}-{end}/{self.size}\r\n\r\n"
+        ).encode("latin-1")
+
+    def _closing(self) -> bytes:
+        return f"--{self.boundary}--\r\n".encode("latin-1")
+
+    async def __call__(self, scope, receive, send):
+        try:
+            file = await anyio.open_file(self.path, mode="rb")
+        except FileNotFoundError:
+            # Deleted since the index lookup
+            await Response(status_code=404)(scope, receive, send)
+            return
+
+        async with file:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            if scope.get("method", "GET").upper() == "HEAD":
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+                return
+
+            for start, end in self.ranges:
+                if self.boundary:
+                    await send({"type": "http.response.body", "body": self._part_header(start, end), "more_body": True})
+
+                await file.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    chunk = await file.read(min(RANGE_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+
+                if self.boundary:
+                    await send({"type": "http.response.body", "body": b"\r\n", "more_body": True})
+
+            closing = self._closing() if self.boundary else b""
+            await send({"type": "http.response.body", "body": closing, "more_body": False})
+
+
+class FullFileResponse(FileResponse):
+    """FileResponse that never re-interprets Range headers (newer Starlette versions would)"""
+
+    async def __call__(self, scope, receive, send):
+        scope = dict(scope)
+        scope["headers"] = [
+            (name, value) for name, value in scope.get("headers", [])
+            if name not in (b"range", b"if-range")
+        ]
+        await super().__call__(scope, receive, send)
+
+
+# ASGI extension letting the app hand the server a file descriptor to sendfile() from
+ZEROCOPY_EXTENSION = "http.response.zerocopysend"
+# Bodies read with one pread per chunk; chunks this small are read on the event loop
+POOLED_CHUNK_SIZE = 256 * 1024
+INLINE_READ_LIMIT = 64 * 1024
+POOL_AVAILABLE = hasattr(os, "pread")
+
+
+class _PooledFile:
+    __slots__ = ("path", "file", "fd", "version", "users", "retired")
+
+    def __init__(self, path: str, file, version: Tuple[int, int, int]):
+        self.path = path
+        self.file = file
+        self.fd = file.fileno()
+        self.version = version
+        self.users = 0
+        self.retired = False
+
+
+def _version(stat: os.stat_result) -> Tuple[int, int, int]:
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class OpenFilePool:
+    """
+    LRU of open, read-only descriptors for the most recently served files
+
+    A hit costs no open()/close() and never leaves the event loop; a miss opens the
+    file on the threadpool. The body is read with pread() at explicit offsets, so
+    concurrent requests can share one descriptor. Entries remember the inode, size
+    and mtime they were opened at and are reopened when the caller's (cached) stat no
+    longer matches, e.g. a regenerated variant. Descriptors still in use when evicted
+    or discarded are closed by their last user.
+    """
+
+    def __init__(self, max_open: int = 256):
+        self.max_open = max_open
+        self._entries: "OrderedDict[str, _PooledFile]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _hit(self, key: str, version) -> Optional[_PooledFile]:
+        # Called with the lock held
+        entry = self._entries.get(key)
+        if entry is None or entry.version != version:
+            return None
+        self._entries.move_to_end(key)
+        entry.users += 1
+        self.hits += 1
+        return entry
+
+    def acquire_pooled(self, path, stat: os.stat_result) -> Optional[_PooledFile]:
+        """acquire() if the descriptor is already pooled, else None; never blocks on the filesystem"""
+        with self._lock:
+            return self._hit(str(path), _version(stat))
+
+    def acquire(self, path, stat: os.stat_result) -> _PooledFile:
+        """
+        Open descriptor for `path` as of `stat`; raises FileNotFoundError. Pair with release()
+
+        A miss opens the file, so call this from a worker thread.
+        """
+        key = str(path)
+        version = _version(stat)
+        with self._lock:
+            entry = self._hit(key, version)
+            if entry is not None:
+                return entry
+            self.misses += 1
+
+        file = open(key, "rb", buffering=0)
+        if _version(os.fstat(file.fileno())) != version:
+            # The caller's stat is older than the file; serve what is there, but don't pool it
+            entry = _PooledFile(key, file, version)
+            entry.users, entry.retired = 1, True
+            return entry
+
+        entry = _PooledFile(key, file, version)
+        entry.users = 1
+        with self._lock:
+            self._retire(self._entries.pop(key, None))
+            self._entries[key] = entry
+            while len(self._entries) > self.max_open:
+                self._retire(self._entries.popitem(last=False)[1])
+        return entry
+
+    def release(self, entry: _PooledFile):
+        with self._lock:
+            entry.users -= 1
+            close = entry.retired and entry.users == 0
+        if close:
+            entry.file.close()
+
+    def discard(self, path):
+        """Forget (and close when idle) the descriptor for a path that was deleted"""
+        with self._lock:
+            self._retire(self._entries.pop(str(path), None))
+
+    def close(self):
+        with self._lock:
+            while self._entries:
+                self._retire(self._entries.popitem()[1])
+
+    @staticmethod
+    def _retire(entry: Optional[_PooledFile]):
+        # Called with the lock held
+        if entry is None:
+            return
+        entry.retired = True
+        if entry.users == 0:
+            entry.file.close()
+
+
+class PooledFileResponse(Response):
+    """
+    Full-file 200 sent from an OpenFilePool descriptor
+
+    Servers offering the zerocopysend extension sendfile() straight from the
+    descriptor; otherwise the body is pread() in POOLED_CHUNK_SIZE pieces.
+    """
+
+    def __init__(self, pool: OpenFilePool, path, stat: os.stat_result, media_type: Optional[str],
+                 headers: dict, filename: Optional[str] = None):
+        self.pool = pool
+        self.path = path
+        self.stat = stat
+        self.status_code = 200
+        self.background = None
+        self.media_type = media_type or mimetypes.guess_type(str(path))[0] or "application/octet-stream"
+        headers = dict(headers)
+        if filename is not None:
+            headers.setdefault("Content-Disposition", content_disposition(filename))
+        self.init_headers(headers)
+        self.headers["content-length"] = str(stat.st_size)
+
+    async def __call__(self, scope, receive, send):
+        try:
+            entry = self.pool.acquire_pooled(self.path, self.stat)
+            if entry is None:
+                entry = await run_in_threadpool(self.pool.acquire, self.path, self.stat)
+        except FileNotFoundError:
+            # Deleted since the index lookup
+            await Response(status_code=404)(scope, receive, send)
+            return
+
+        try:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            size = self.stat.st_size
+            if scope.get("method", "GET").upper() == "HEAD" or size == 0:
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+                return
+
+            if ZEROCOPY_EXTENSION in scope.get("extensions", {}):
+                await send({"type": ZEROCOPY_EXTENSION, "file": entry.file, "offset": 0, "count": size})
+                return
+
+            offset = 0
+            while offset < size:
+                count = min(POOLED_CHUNK_SIZE, size - offset)
+                if count <= INLINE_READ_LIMIT:
+                    chunk = os.pread(entry.fd, count, offset)
+                else:
+                    chunk = await run_in_threadpool(os.pread, entry.fd, count, offset)
+                if not chunk:
+                    break
+                offset += len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": offset < size})
+            if offset < size:
+                # Truncated underneath us; end the body rather than hang the client
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            self.pool.release(entry)
+
+
+def serve_file(request_headers: Mapping[str, str], path, stat: os.stat_result, etag: str,
+               media_type: Optional[str], headers: dict, filename: Optional[str] = None,
+               pool: Optional[OpenFilePool] = None) -> Response:
+    """
+    Full, partial or not-modified response for a stored file
+
+    Handles If-None-Match/If-Modified-Since (304), Range/If-Range (206/416) and
+    falls back to a full response, from `pool` when given.
+    """
+    headers = dict(headers)
+    headers.update(validator_headers(etag, stat.st_mtime, headers.get("Cache-Control", IMMUTABLE_CACHE_CONTROL)))
+    headers["Accept-Ranges"] = "bytes"
+
+    if is_not_modified(request_headers, etag, stat.st_mtime):
+        return not_modified_response(headers)
+
+    range_header = request_headers.get("range")
+    if range_header and if_range_allows(request_headers.get("if-range"), etag, stat.st_mtime):
+        try:
+            ranges = parse_range_header(range_header, stat.st_size)
+        except RangeNotSatisfiable:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{stat.st_size}", **headers})
+        if ranges is not None:
+            if filename is not None:
+                headers.setdefault("Content-Disposition", content_disposition(filename))
+            return RangeFileResponse(path, ranges, stat.st_size, media_type, headers)
+
+    if pool is not None and POOL_AVAILABLE:
+        return PooledFileResponse(pool, path, stat, media_type, headers, filename)
+    return FullFileResponse(path=path, filename=filename, media_type=media_type, headers=headers, stat_result=stat)
@@ -0,0 +1,184 @@
+"""
+Image processing
+Pillow resize/thumbnail helpers and a bounded process pool that keeps them off the event loop
+"""
+
+import os
+import asyncio
+import logging
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Optional, Tuple
+
+from PIL import Image, features
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+
+# Output formats for generated variants: name -> (Pillow format, media type, file extension)
+VARIANT_FORMATS = {
+    "jpeg": ("JPEG", "image/jpeg", ".jpg"),
+    "png": ("PNG", "image/png", ".png"),
+}
+if features.check("webp"):
+    VARIANT_FORMATS["webp"] = ("WEBP", "image/webp", ".webp")
+if features.check("avif"):
+    VARIANT_FORMATS["avif"] = ("AVIF", "image/avif", ".avif")
+
+
+def render_variant(image_path: Path, variant_path: Path, size: Optional[Tuple[int, int]],
+                   fmt: str = "jpeg", quality: int = 85) -> int:
+    """
+    Write `image_path` as `fmt`, scaled to fit within `size` (never upscaled; None keeps
+    the original dimensions); returns bytes written
+    """
+    pil_format = VARIANT_FORMATS[fmt][0]
+    # Unique per render: another worker process may be writing the same variant
+    fd, temp_name = tempfile.mkstemp(dir=str(variant_path.parent), prefix=f".{variant_path.name}.", suffix=".tmp")
+    os.close(fd)
+    temp_path = Path(temp_name)
+    try:
+        with Image.open(image_path) as img:
+            if size is not None:
+                img.thumbnail(size, Image.Resampling.LANCZOS)
+            if pil_format == 'JPEG' and img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+            elif img.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+                img = img.convert('RGBA')
+            img.save(temp_path, format=pil_format, optimize=True, quality=quality)
+        # Readers only ever see complete files
+        temp_path.replace(variant_path)
+        return variant_path.stat().st_size
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+
+def resize_image_if_needed(image_path: Path, max_resolution: int = 2048, quality: int = 85):
+    """Resize image if it exceeds maximum resolution while maintaining aspect ratio"""
+    try:
+        with Image.open(image_path) as img:
+            # Get original dimensions
+            original_width, original_height = img.size
+
+            # Check if resizing is needed
+            if original_width <= max_resolution and original_height <= max_resolution:
+                logger.info(f"Image {image_path.name} ({original_width}x{original_height}) is within size limits, no resize needed")
+                return False  # No resize needed
+
+            # Calculate new dimensions maintaining aspect ratio
+            if original_width > original_height:
+                # Landscape or square
+                new_width = max_resolution
+                new_height = int((original_height * max_resolution) / original_width)
+            else:
+                # Portrait
+                new_height = max_resolution
+                new_width = int((original_width * max_resolution) / original_height)
+
+            # Resize the image
+            resized_img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+
+            # Written beside the file and swapped in: the stored copy may share its inode
+            # with a resumable upload's part file, which has to stay intact
+            fd, temp_name = tempfile.mkstemp(dir=str(image_path.parent), prefix=f".{image_path.name}.", suffix=".tmp")
+            os.close(fd)
+            temp_path = Path(temp_name)
+            try:
+                # Save with optimization
+                # Preserve original format if possible, fallback to JPEG for better compression
+                if img.format in ['JPEG', 'JPG']:
+                    resized_img.save(temp_path, format='JPEG', optimize=True, quality=quality)
+                elif img.format == 'PNG':
+                    # For PNG, check if it has transparency
+                    if resized_img.mode in ('RGBA', 'LA') or (resized_img.mode == 'P' and 'transparency' in resized_img.info):
+                        resized_img.save(temp_path, format='PNG', optimize=True)
+                    else:
+                        # Convert to JPEG for better compression if no transparency
+                        rgb_img = Image.new('RGB', resized_img.size, (255, 255, 255))
+                        rgb_img.paste(resized_img, mask=resized_img.split()[-1] if resized_img.mode == 'RGBA' else None)
+                        rgb_img.save(temp_path, format='JPEG', optimize=True, quality=quality)
+                else:
+                    # For other formats, convert to JPEG
+                    rgb_img = resized_img.convert('RGB')
+                    rgb_img.save(temp_path, format='JPEG', optimize=True, quality=quality)
+                temp_path.replace(image_path)
+            finally:
+                temp_path.unlink(missing_ok=True)
+
+            logger.info(f"Image {image_path.name} resized from {original_width}x{original_height} to {new_width}x{new_height}")
+            return True  # Resize was performed
+
+    except Exception as e:
+        logger.error(f"Error resizing image {image_path}: {e}")
+        return False
+
+
+class ImageProcessorBusy(Exception):
+    """Raised when the image processing queue is full"""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Image processing queue is full")
+        self.retry_after = retry_after
+
+
+class ImageProcessor:
+    """
+    Bounded process pool for CPU-heavy Pillow work
+
+    At most `max_workers` jobs run at once and at most `max_queue` more wait for a
+    worker; anything beyond that is refused with ImageProcessorBusy so callers can
+    answer 503 instead of piling work up behind the event loop.
+    """
+
+    def __init__(self, max_workers: int = 2, max_queue: int = 8, retry_after: int = 5):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._pending = 0
+
+    @property
+    def pending(self) -> int:
+        """Jobs currently running or waiting for a worker"""
+        return self._pending
+
+    @property
+    def saturated(self) -> bool:
+        """True when no more jobs will be accepted"""
+        return self._pending >= max(self.max_workers, 1) + self.max_queue
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            logger.info(f"Started image processing pool with {self.max_workers} workers")
+        return self._executor
+
+    async def run(self, func, *args):
+        """Run `func(*args)` in the pool, raising ImageProcessorBusy when saturated"""
+        if self.saturated:
+            raise ImageProcessorBusy(self.retry_after)
+
+        self._pending += 1
+        try:
+            # max_workers=0 keeps the work in-process on the threadpool (e.g. constrained hosts)
+            if self.max_workers <= 0:
+                return await run_in_threadpool(func, *args)
+
+            loop = asyncio.get_running_loop()
+            try:
+                return await loop.run_in_executor(self._get_executor(), func, *args)
+            except BrokenProcessPool:
+                logger.error("Image processing pool broke, restarting it")
+                self._executor = None
+                raise
+        finally:
+            self._pending -= 1
+
+    def shutdown(self):
+        """Stop worker processes"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,540 @@
+"""
+File metadata store
+SQLite (WAL mode) backend for upload metadata with indexed listing, stats and cleanup queries
+"""
+
+import json
+import time
+import base64
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+from typing import Optional, List, Dict, Any, Tuple, Iterable, Iterator, NamedTuple
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    file_id TEXT PRIMARY KEY,
+    original_filename TEXT NOT NULL DEFAULT '',
+    filename TEXT,
+    file_size INTEGER NOT NULL DEFAULT 0,
+    upload_time TEXT NOT NULL,
+    file_type TEXT NOT NULL DEFAULT 'other',
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_files_upload_time ON files(upload_time);
+CREATE INDEX IF NOT EXISTS idx_files_file_type ON files(file_type);
+CREATE INDEX IF NOT EXISTS idx_files_time_id ON files(upload_time, file_id);
+CREATE INDEX IF NOT EXISTS idx_files_type_time ON files(file_type, upload_time, file_id);
+CREATE INDEX IF NOT EXISTS idx_files_original_filename ON files(original_filename COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS blobs (
+    sha256 TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    thumbnail TEXT,
+    file_size INTEGER NOT NULL DEFAULT 0,
+    was_resized INTEGER NOT NULL DEFAULT 0,
+    refcount INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS upload_sessions (
+    session_id TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    content_type TEXT,
+    size INTEGER NOT NULL,
+    sha256 TEXT,
+    created_at REAL NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_upload_sessions_expires ON upload_sessions(expires_at);
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    origin TEXT NOT NULL,
+    op TEXT NOT NULL,
+    file_id TEXT NOT NULL,
+    data TEXT NOT NULL,
+    previous TEXT,
+    release_blob INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS store_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Sidecar metadata is tiny; anything bigger is not ours
+MAX_SIDECAR_SIZE = 10240
+
+# Change log operations
+SAVED = "save"
+DELETED = "delete"
+
+
+class BlobEntry(NamedTuple):
+    """One file for save_many_with_blobs (plain 4-tuples work too)"""
+    file_id: str
+    metadata: Dict[str, Any]
+    blob: Dict[str, Any]
+    # Repoint an existing blob row at this (fresh) copy
+    replace_blob: bool = False
+    # Only reference a blob found by find_blob(); this upload stored no copy of its own
+    reuse: bool = False
+
+
+class StoreSnapshot(NamedTuple):
+    """Everything a worker builds its in-memory state from, read at one moment"""
+    last_change: int
+    type_aggregates: List[Tuple[str, int, int]]
+    daily_upload_counts: List[Tuple[str, int]]
+    files: List[Dict[str, Any]]
+
+
+def encode_cursor(upload_time: str, file_id: str) -> str:
+    """Opaque page cursor for the (upload_time, file_id) keyset"""
+    raw = json.dumps([upload_time, file_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[str, str]:
+    """Inverse of encode_cursor; raises ValueError on malformed input"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        upload_time, file_id = json.loads(base64.urlsafe_b64decode(padded))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(upload_time, str) or not isinstance(file_id, str):
+        raise ValueError("Invalid cursor")
+    return upload_time, file_id
+
+
+class MetadataStore:
+    """
+    SQLite-backed metadata for uploaded files, one row per file_id
+
+    With an `origin` (one per server process), every write to `files` also appends
+    to the `changes` log in the same transaction, so other processes sharing the
+    database can follow along with changes_since().
+    """
+
+    def __init__(self, db_path: Path, origin: Optional[str] = None):
+        self.db_path = Path(db_path)
+        self.origin = origin
+        self._local = threading.local()
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        """Per-thread connection (sqlite3 connections must not be shared across threads)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.db_path), timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _row_values(file_id: str, metadata: Dict[str, Any]) -> tuple:
+        file_size = metadata.get("file_size", 0)
+        return (
+            file_id,
+            metadata.get("original_filename", ""),
+            metadata.get("filename", metadata.get("stored_filename")),
+            file_size if isinstance(file_size, (int, float)) else 0,
+            metadata.get("upload_time", "1970-01-01T00:00:00"),
+            metadata.get("file_type", "other"),
+            json.dumps(metadata),
+        )
+
+    def _previous(self, conn: sqlite3.Connection, file_id: str) -> Optional[str]:
+        """Metadata a write is about to replace, when the change log needs it"""
+        if self.origin is None:
+            return None
+        row = conn.execute("SELECT data FROM files WHERE file_id = ?", (file_id,)).fetchone()
+        return row["data"] if row else None
+
+    def _log_change(self, conn: sqlite3.Connection, op: str, file_id: str, metadata: Dict[str, Any],
+                    previous: Optional[str] = None, release_blob: bool = False):
+        if self.origin is None:
+            return
+        conn.execute(
+            "INSERT INTO changes (origin, op, file_id, data, previous, release_blob, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (self.origin, op, file_id, json.dumps(metadata), previous, int(release_blob), time.time())
+        )
+
+    def save(self, file_id: str, metadata: Dict[str, Any]):
+        """Insert or replace the metadata for a file"""
+        conn = self._connect()
+        with conn:
+            previous = self._previous(conn, file_id)
+            conn.execute(
+                "INSERT OR REPLACE INTO files "
+                "(file_id, original_filename, filename, file_size, upload_time, file_type, data) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                self._row_values(file_id, metadata)
+            )
+            self._log_change(conn, SAVED, file_id, metadata, previous)
+
+    def load(self, file_id: str) -> Optional[Dict[str, Any]]:
+        """Metadata for one file, or None"""
+        row = self._connect().execute(
+            "SELECT data FROM files WHERE file_id = ?", (file_id,)
+        ).fetchone()
+        return json.loads(row["data"]) if row else None
+
+    def delete_many(self, file_ids: Iterable[str]) -> List[Tuple[str, Dict[str, Any], bool]]:
+        """
+        Remove files' metadata and drop their blob references in one transaction
+
+        Returns (file_id, metadata, release_blob) per file found: release_blob is True
+        when no other file shares the stored content any more, i.e. the caller should
+        unlink it from disk. Files stored before deduplication have no blob row and
+        always own their content.
+        """
+        results = []
+        conn = self._connect()
+        with conn:
+            for file_id in file_ids:
+                row = conn.execute("SELECT data FROM files WHERE file_id = ?", (file_id,)).fetchone()
+                if row is None:
+                    continue
+                conn.execute("DELETE FROM files WHERE file_id = ?", (file_id,))
+                metadata = json.loads(row["data"])
+
+                release_blob = self._release_blob(conn, metadata.get("sha256"))
+                self._log_change(conn, DELETED, file_id, metadata, release_blob=release_blob)
+                results.append((file_id, metadata, release_blob))
+        return results
+
+    @staticmethod
+    def _release_blob(conn: sqlite3.Connection, sha256: Optional[str]) -> bool:
+        """Drop one reference to a blob; True when it was the last one"""
+        if not sha256:
+            return True
+        cursor = conn.execute(
+            "UPDATE blobs SET refcount = refcount - 1 WHERE sha256 = ?", (sha256,)
+        )
+        if cursor.rowcount == 0:
+            return True
+        cursor = conn.execute("DELETE FROM blobs WHERE sha256 = ? AND refcount <= 0", (sha256,))
+        return cursor.rowcount > 0
+
+    def find_blob(self, sha256: str) -> Optional[Dict[str, Any]]:
+        """Stored content with this hash, or None"""
+        row = self._connect().execute(
+            "SELECT sha256, filename, thumbnail, file_size, was_resized, refcount FROM blobs WHERE sha256 = ?",
+            (sha256,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def save_many_with_blobs(self, entries: Iterable[tuple]) -> List[Optional[Dict[str, Any]]]:
+        """
+        Insert files' metadata and take a reference on each one's content blob, atomically
+
+        `entries` are BlobEntry tuples, all saved in one transaction. If another upload
+        registered the same hash first, its blob wins: the metadata is pointed at the
+        existing blob and the caller should discard its own copy (compare the returned
+        blob's filename). `replace_blob` repoints an existing row whose content went
+        missing on disk at the caller's fresh copy. A `reuse` entry only takes a reference
+        on a blob that still exists; if the last file sharing it was deleted since the
+        caller looked it up, nothing is saved for that entry and its result is None.
+        """
+        canonicals = []
+        conn = self._connect()
+        with conn:
+            for entry in entries:
+                file_id, metadata, blob, replace_blob, reuse = BlobEntry(*entry)
+                if reuse:
+                    cursor = conn.execute(
+                        "UPDATE blobs SET refcount = refcount + 1 WHERE sha256 = ?", (blob["sha256"],)
+                    )
+                    if cursor.rowcount == 0:
+                        canonicals.append(None)
+                        continue
+                else:
+                    on_conflict = (
+                        "filename = excluded.filename, thumbnail = excluded.thumbnail, "
+                        "file_size = excluded.file_size, was_resized = excluded.was_resized, "
+                        "refcount = refcount + 1"
+                    ) if replace_blob else "refcount = refcount + 1"
+                    conn.execute(
+                        "INSERT INTO blobs (sha256, filename, thumbnail, file_size, was_resized, refcount) "
+                        f"VALUES (?, ?, ?, ?, ?, 1) ON CONFLICT(sha256) DO UPDATE SET {on_conflict}",
+                        (blob["sha256"], blob["filename"], blob.get("thumbnail"),
+                         blob.get("file_size", 0), int(bool(blob.get("was_resized"))))
+                    )
+                row = conn.execute(
+                    "SELECT sha256, filename, thumbnail, file_size, was_resized, refcount FROM blobs WHERE sha256 = ?",
+                    (blob["sha256"],)
+                ).fetchone()
+                canonical = dict(row)
+
+                metadata["filename"] = canonical["filename"]
+                if canonical["thumbnail"]:
+                    metadata["thumbnail"] = canonical["thumbnail"]
+                metadata["file_size"] = canonical["file_size"]
+                metadata["was_resized"] = bool(canonical["was_resized"])
+                previous = self._previous(conn, file_id)
+                conn.execute(
+                    "INSERT OR REPLACE INTO files "
+                    "(file_id, original_filename, filename, file_size, upload_time, file_type, data) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    self._row_values(file_id, metadata)
+                )
+                self._log_change(conn, SAVED, file_id, metadata, previous)
+                canonicals.append(canonical)
+        return canonicals
+
+    def all_files(self) -> List[Dict[str, Any]]:
+        """All metadata, newest first"""
+        rows = self._connect().execute(
+            "SELECT data FROM files ORDER BY upload_time DESC, file_id DESC"
+        ).fetchall()
+        return [json.loads(row["data"]) for row in rows]
+
+    @staticmethod
+    def _filter_clause(file_type: Optional[str] = None, uploaded_after: Optional[str] = None,
+                       uploaded_before: Optional[str] = None,
+                       name_prefix: Optional[str] = None) -> Tuple[List[str], List[Any]]:
+        clauses, params = [], []
+        if file_type:
+            clauses.append("file_type = ?")
+            params.append(file_type)
+        if uploaded_after:
+            clauses.append("upload_time >= ?")
+            params.append(uploaded_after)
+        if uploaded_before:
+            clauses.append("upload_time < ?")
+            params.append(uploaded_before)
+        if name_prefix:
+            escaped = name_prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            clauses.append("original_filename LIKE ? ESCAPE '\\'")
+            params.append(f"{escaped}%")
+        return clauses, params
+
+    def query_page(self, limit: int, cursor: Optional[Tuple[str, str]] = None, offset: int = 0,
+                   **filters) -> Tuple[List[Dict[str, Any]], Optional[Tuple[str, str]]]:
+        """
+        One page of metadata, newest first, using (upload_time, file_id) keyset pagination
+
+        Returns the page and the key to pass as `cursor` for the next one (None on the last page).
+        `offset` is only honoured without a cursor, for older clients.
+        """
+        clauses, params = self._filter_clause(**filters)
+        if cursor is not None:
+            clauses.append("(upload_time, file_id) < (?, ?)")
+            params.extend(cursor)
+
+        sql = "SELECT file_id, upload_time, data FROM files"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        # Fetch one extra row to know whether another page exists
+        sql += " ORDER BY upload_time DESC, file_id DESC LIMIT ?"
+        params.append(limit + 1)
+        if cursor is None and offset > 0:
+            sql += " OFFSET ?"
+            params.append(offset)
+
+        rows = self._connect().execute(sql, params).fetchall()
+        next_key = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_key = (rows[-1]["upload_time"], rows[-1]["file_id"])
+        return [json.loads(row["data"]) for row in rows], next_key
+
+    def count_matching(self, **filters) -> int:
+        """Number of files matching the same filters as query_page"""
+        clauses, params = self._filter_clause(**filters)
+        sql = "SELECT COUNT(*) FROM files"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        return self._connect().execute(sql, params).fetchone()[0]
+
+    def iter_oldest(self, file_type: Optional[str] = None,
+                    batch_size: int = 500) -> Iterator[Tuple[str, int, str, str]]:
+        """(file_id, file_size, upload_time, file_type), oldest first, read in keyset pages"""
+        where = "WHERE file_type = ? AND (upload_time, file_id) > (?, ?)" if file_type else \
+            "WHERE (upload_time, file_id) > (?, ?)"
+        last = ("", "")
+        while True:
+            params = ((file_type,) if file_type else ()) + last + (batch_size,)
+            rows = self._connect().execute(
+                "SELECT file_id, file_size, upload_time, file_type FROM files "
+                f"{where} ORDER BY upload_time, file_id LIMIT ?",
+                params
+            ).fetchall()
+            for row in rows:
+                yield tuple(row)
+            if len(rows) < batch_size:
+                return
+            last = (rows[-1]["upload_time"], rows[-1]["file_id"])
+
+    def count(self) -> int:
+        """Number of stored files"""
+        return self._connect().execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def type_aggregates(self) -> List[Tuple[str, int, int]]:
+        """(file_type, count, total size) per file type"""
+        return [
+            tuple(row) for row in self._connect().execute(
+                "SELECT file_type, COUNT(*), COALESCE(SUM(file_size), 0) FROM files GROUP BY file_type"
+            )
+        ]
+
+    def daily_upload_counts(self) -> List[Tuple[str, int]]:
+        """(YYYY-MM-DD, count) per upload day"""
+        return [
+            tuple(row) for row in self._connect().execute(
+                "SELECT substr(upload_time, 1, 10) AS day, COUNT(*) FROM files GROUP BY day"
+            )
+        ]
+
+    def create_session(self, session: Dict[str, Any]):
+        """Persist a new resumable upload session"""
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT INTO upload_sessions (session_id, filename, content_type, size, sha256, created_at, expires_at) "
+                "VALUES (:session_id, :filename, :content_type, :size, :sha256, :created_at, :expires_at)",
+                session
+            )
+
+    def load_session(self, session_id: str) -> Optional[Dict[str, Any]]:
+        row = self._connect().execute(
+            "SELECT * FROM upload_sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def touch_session(self, session_id: str, expires_at: float):
+        """Push back a session's expiry after activity"""
+        conn = self._connect()
+        with conn:
+            conn.execute("UPDATE upload_sessions SET expires_at = ? WHERE session_id = ?", (expires_at, session_id))
+
+    def delete_session(self, session_id: str) -> bool:
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute("DELETE FROM upload_sessions WHERE session_id = ?", (session_id,))
+        return cursor.rowcount > 0
+
+    def expired_sessions(self, now: float) -> List[str]:
+        """IDs of sessions whose expiry has passed"""
+        return [
+            row["session_id"] for row in self._connect().execute(
+                "SELECT session_id FROM upload_sessions WHERE expires_at < ?", (now,)
+            )
+        ]
+
+    def session_ids(self) -> List[str]:
+        return [row["session_id"] for row in self._connect().execute("SELECT session_id FROM upload_sessions")]
+
+    def last_change(self) -> int:
+        """Sequence number of the newest change log entry (0 when empty)"""
+        return self._connect().execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+
+    def snapshot(self) -> StoreSnapshot:
+        """
+        last_change(), type_aggregates(), daily_upload_counts() and all_files() in one
+        read transaction, so a write by another worker is either in all of them or in
+        the change log after last_change
+        """
+        conn = self._connect()
+        conn.execute("BEGIN")
+        try:
+            return StoreSnapshot(self.last_change(), self.type_aggregates(),
+                                 self.daily_upload_counts(), self.all_files())
+        finally:
+            conn.rollback()
+
+    def changes_since(self, seq: int, limit: int = 1000) -> List[Dict[str, Any]]:
+        """Change log entries after `seq`, oldest first"""
+        rows = self._connect().execute(
+            "SELECT seq, origin, op, file_id, data, previous, release_blob FROM changes "
+            "WHERE seq > ? ORDER BY seq LIMIT ?",
+            (seq, limit)
+        ).fetchall()
+        return [{
+            "seq": row["seq"],
+            "origin": row["origin"],
+            "op": row["op"],
+            "file_id": row["file_id"],
+            "metadata": json.loads(row["data"]),
+            "previous": json.loads(row["previous"]) if row["previous"] else None,
+            "release_blob": bool(row["release_blob"]),
+        } for row in rows]
+
+    def prune_changes(self, before: float) -> int:
+        """Drop change log entries written before a timestamp"""
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute("DELETE FROM changes WHERE created_at < ?", (before,))
+        return cursor.rowcount
+
+    def get_meta(self, key: str) -> Optional[str]:
+        row = self._connect().execute(
+            "SELECT value FROM store_meta WHERE key = ?", (key,)
+        ).fetchone()
+        return row["value"] if row else None
+
+    def set_meta(self, key: str, value: str):
+        conn = self._connect()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO store_meta (key, value) VALUES (?, ?)", (key, value))
+
+    def migrate_json_sidecars(self, directory: Path) -> int:
+        """One-shot import of legacy `{file_id}.json` sidecars; later calls are no-ops"""
+        if self.get_meta("json_sidecars_migrated"):
+            return 0
+
+        rows = []
+        for json_file in Path(directory).glob("*.json"):
+            try:
+                if json_file.stat().st_size > MAX_SIDECAR_SIZE:
+                    logger.warning(f"Skipping unusually large metadata file: {json_file}")
+                    continue
+
+                with open(json_file, 'r', encoding='utf-8') as f:
+                    metadata = json.load(f)
+
+                if 'file_id' in metadata and 'upload_time' in metadata:
+                    rows.append(self._row_values(metadata['file_id'], metadata))
+                else:
+                    logger.warning(f"Invalid metadata structure in {json_file}")
+
+            except (json.JSONDecodeError, UnicodeDecodeError) as e:
+                logger.error(f"Error reading metadata file {json_file}: {e}")
+            except Exception as e:
+                logger.error(f"Unexpected error reading metadata file {json_file}: {e}")
+
+        conn = self._connect()
+        with conn:
+            # OR IGNORE: rows written through the store win over stale sidecars
+            conn.executemany(
+                "INSERT OR IGNORE INTO files "
+                "(file_id, original_filename, filename, file_size, upload_time, file_type, data) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO store_meta (key, value) VALUES ('json_sidecars_migrated', ?)",
+                (str(len(rows)),)
+            )
+
+        logger.info(f"Migrated {len(rows)} JSON metadata sidecars into {self.db_path.name}")
+        return len(rows)
+
+
+if __name__ == "__main__":
+    import sys
+
+    # Manual migration: python -m src.services.metadata_store <upload_dir>
+    upload_dir = Path(sys.argv[1] if len(sys.argv) > 1 else "uploads")
+    logging.basicConfig(level=logging.INFO)
+    store = MetadataStore(upload_dir / "metadata.db")
+    print(f"Imported {store.migrate_json_sidecars(upload_dir)} sidecars, {store.count()} files in store")
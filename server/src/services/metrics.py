@@ -0,0 +1,227 @@
+"""
+Metrics
+In-process counters, gauges and histograms rendered in the Prometheus text exposition format
+"""
+
+import os
+import sys
+import time
+import bisect
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+# Request latency buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class _Metric:
+    type_name = "untyped"
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+
+    def samples(self) -> Iterable[Tuple[str, Labels, float]]:
+        return ()
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    """Monotonic total, optionally split by labels"""
+
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str):
+        super().__init__(name, documentation)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, labels, value) for labels, value in sorted(self._values.items())]
+
+
+class Gauge(_Metric):
+    """Current value read from `function()` at scrape time; None means no sample"""
+
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, function: Callable[[], Optional[float]]):
+        super().__init__(name, documentation)
+        self.function = function
+
+    def samples(self):
+        value = self.function()
+        return [] if value is None else [(self.name, (), value)]
+
+
+class CallbackCounter(Gauge):
+    """Counter whose total is kept elsewhere (e.g. a cache's own hit count)"""
+
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str,
+                 function: Callable[[], Dict[Labels, float]]):
+        super().__init__(name, documentation, function)
+
+    def samples(self):
+        return [(self.name, labels, value) for labels, value in sorted(self.function().items())]
+
+
+class Histogram(_Metric):
+    """Cumulative buckets plus sum and count per label set"""
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Labels, List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        # Per series: one slot per bucket (not yet cumulative), then +Inf, sum
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def time(self, **labels) -> "_Timer":
+        """`with histogram.time(route="x"):` observes the block's duration"""
+        return _Timer(self, labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            series = sorted((labels, list(values)) for labels, values in self._series.items())
+        for labels, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), values[:-1]):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", labels + (("le", _format_value(bound)),), cumulative))
+            samples.append((f"{self.name}_sum", labels, values[-1]))
+            samples.append((f"{self.name}_count", labels, cumulative))
+        return samples
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: Dict[str, str]):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class MetricsRegistry:
+    """Metrics in registration order, rendered together for /metrics"""
+
+    content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        return self.register(Counter(name, documentation))
+
+    def gauge(self, name: str, documentation: str, function: Callable[[], Optional[float]]) -> Gauge:
+        return self.register(Gauge(name, documentation, function))
+
+    def histogram(self, name: str, documentation: str, buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def open_file_descriptors() -> Optional[int]:
+    """Open file handles of this process (Linux), or None where that isn't cheap to find out"""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None
+
+
+class RequestMetricsMiddleware:
+    """
+    Observes every HTTP request's duration into `histogram`
+
+    Labelled by method, status and the matched route's path template (/files/{file_id},
+    not the concrete URL), so the series stay few; unmatched paths share one label.
+    The duration runs until the response has been sent.
+    """
+
+    def __init__(self, app: ASGIApp, histogram: Histogram):
+        self.app = app
+        self.histogram = histogram
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            self.histogram.observe(
+                time.perf_counter() - start,
+                method=scope["method"],
+                route=getattr(route, "path", None) or "unmatched",
+                status=str(status_code)
+            )
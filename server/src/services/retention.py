@@ -0,0 +1,130 @@
+"""
+Retention
+Policy-driven cleanup: picks files to delete by age, total size and per-type quotas
+"""
+
+import logging
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, List, Set
+
+logger = logging.getLogger(__name__)
+
+# Reasons a file was selected, in the order policies are applied
+MAX_AGE = "max_age"
+TYPE_QUOTA = "type_quota"
+MAX_TOTAL = "max_total_bytes"
+
+
+def parse_type_quotas(spec: str) -> Dict[str, int]:
+    """`images=2048,others=512` (MB per stored file type) -> bytes per type"""
+    quotas = {}
+    for part in (spec or "").split(","):
+        name, _, value = part.partition("=")
+        if not name.strip() or not value.strip():
+            continue
+        try:
+            quotas[name.strip().lower()] = int(float(value) * 1024 * 1024)
+        except ValueError:
+            logger.warning(f"Ignoring invalid retention quota: {part.strip()}")
+    return quotas
+
+
+class RetentionPolicy:
+    """Limits files are held to; a limit that is None is not enforced"""
+
+    def __init__(self, max_age_days: Optional[float] = None, max_total_bytes: Optional[int] = None,
+                 type_quotas: Optional[Dict[str, int]] = None):
+        self.max_age_days = max_age_days
+        self.max_total_bytes = max_total_bytes
+        self.type_quotas = type_quotas or {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_age_days is not None or self.max_total_bytes is not None or bool(self.type_quotas)
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "max_age_days": self.max_age_days,
+            "max_total_bytes": self.max_total_bytes,
+            "type_quotas": dict(self.type_quotas),
+        }
+
+
+class RetentionPlan:
+    """Files selected for deletion, with the policy that selected each"""
+
+    def __init__(self, policy: RetentionPolicy):
+        self.policy = policy
+        self.file_ids: List[str] = []
+        self.total_bytes = 0
+        self.by_reason: Dict[str, Dict[str, int]] = {}
+        self._selected: Set[str] = set()
+
+    def __len__(self) -> int:
+        return len(self.file_ids)
+
+    def __contains__(self, file_id: str) -> bool:
+        return file_id in self._selected
+
+    def add(self, file_id: str, size: int, reason: str):
+        if file_id in self._selected:
+            return
+        self._selected.add(file_id)
+        self.file_ids.append(file_id)
+        self.total_bytes += size
+        counts = self.by_reason.setdefault(reason, {"files": 0, "bytes": 0})
+        counts["files"] += 1
+        counts["bytes"] += size
+
+    def report(self, sample: int = 100) -> Dict[str, Any]:
+        return {
+            "policy": self.policy.describe(),
+            "files": len(self.file_ids),
+            "bytes": self.total_bytes,
+            "by_reason": self.by_reason,
+            "file_ids": self.file_ids[:sample],
+        }
+
+
+def plan_retention(store, policy: RetentionPolicy, now: Optional[datetime] = None) -> RetentionPlan:
+    """
+    Select files that break the policy, oldest first
+
+    Every rule walks the (file_type,) upload_time index from the oldest file and
+    stops as soon as it is satisfied, so only the files that go are read. Sizes are
+    per-file sizes as reported by /stats; content shared through deduplication is
+    counted once per file.
+    """
+    plan = RetentionPlan(policy)
+    now = now or datetime.now()
+
+    if policy.max_age_days is not None:
+        cutoff = (now - timedelta(days=policy.max_age_days)).isoformat()
+        for file_id, size, upload_time, _ in store.iter_oldest():
+            if upload_time >= cutoff:
+                break
+            plan.add(file_id, size, MAX_AGE)
+
+    type_totals = {file_type: size for file_type, _, size in store.type_aggregates()}
+
+    for file_type, quota in policy.type_quotas.items():
+        excess = type_totals.get(file_type, 0) - quota
+        for file_id, size, _, _ in store.iter_oldest(file_type):
+            if excess <= 0:
+                break
+            if file_id in plan:
+                excess -= size
+                continue
+            plan.add(file_id, size, TYPE_QUOTA)
+            excess -= size
+
+    if policy.max_total_bytes is not None:
+        excess = sum(type_totals.values()) - policy.max_total_bytes
+        for file_id, size, _, _ in store.iter_oldest():
+            if excess <= 0:
+                break
+            if file_id not in plan:
+                plan.add(file_id, size, MAX_TOTAL)
+            excess -= size
+
+    return plan
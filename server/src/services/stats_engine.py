@@ -0,0 +1,102 @@
+"""
+Statistics engine
+Running totals updated on every upload/delete so /stats and /admin/stats never scan the library
+"""
+
+import threading
+from collections import Counter
+from datetime import date
+from typing import Dict, Any, Callable, Iterable, Optional, Tuple
+
+
+class StatsEngine:
+    """In-memory counters: total size, count per file type and uploads per day"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.total_files = 0
+        self.total_size = 0
+        self.type_counts: Counter = Counter()
+        self.daily_uploads: Counter = Counter()
+
+    @staticmethod
+    def _size(metadata: Dict[str, Any]) -> int:
+        file_size = metadata.get("file_size", 0)
+        return file_size if isinstance(file_size, (int, float)) else 0
+
+    @staticmethod
+    def _day(upload_time: Any) -> str:
+        # ISO timestamps start with YYYY-MM-DD, no need to parse them
+        return upload_time[:10] if isinstance(upload_time, str) else ""
+
+    def rebuild(self, type_rows: Iterable[Tuple[str, int, int]], day_rows: Iterable[Tuple[str, int]]):
+        """Reset from store aggregates: (file_type, count, size) and (day, count) rows"""
+        type_counts, total_files, total_size = Counter(), 0, 0
+        for file_type, count, size in type_rows:
+            type_counts[file_type] += count
+            total_files += count
+            total_size += size or 0
+        daily_uploads = Counter({day: count for day, count in day_rows})
+
+        with self._lock:
+            self.total_files = total_files
+            self.total_size = total_size
+            self.type_counts = type_counts
+            self.daily_uploads = daily_uploads
+
+    def file_count(self, file_type: Optional[str] = None) -> int:
+        """Files stored in total, or of one file type"""
+        with self._lock:
+            return self.total_files if file_type is None else self.type_counts.get(file_type, 0)
+
+    def record_upload(self, metadata: Dict[str, Any]):
+        """Account for a newly stored file"""
+        with self._lock:
+            self.total_files += 1
+            self.total_size += self._size(metadata)
+            self.type_counts[metadata.get("file_type", "other")] += 1
+            self.daily_uploads[self._day(metadata.get("upload_time"))] += 1
+
+    def record_delete(self, metadata: Dict[str, Any]):
+        """Account for a removed file"""
+        with self._lock:
+            self.total_files = max(self.total_files - 1, 0)
+            self.total_size = max(self.total_size - self._size(metadata), 0)
+            self._decrement(self.type_counts, metadata.get("file_type", "other"))
+            self._decrement(self.daily_uploads, self._day(metadata.get("upload_time")))
+
+    @staticmethod
+    def _decrement(counter: Counter, key: str):
+        if counter.get(key, 0) > 1:
+            counter[key] -= 1
+        else:
+            counter.pop(key, None)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Payload for /stats"""
+        with self._lock:
+            total_size = self.total_size
+            return {
+                "total_files": self.total_files,
+                "total_size_bytes": total_size,
+                "total_size_mb": round(total_size / (1024 * 1024), 2) if total_size > 0 else 0.0,
+                "file_types": dict(self.type_counts),
+                "server_uptime": "Server running"
+            }
+
+    def admin_snapshot(self, categorize: Callable[[str], str]) -> Dict[str, Any]:
+        """Payload for /admin/stats, with file types bucketed by `categorize`"""
+        with self._lock:
+            categories = Counter()
+            for file_type, count in self.type_counts.items():
+                categories[categorize(file_type)] += count
+
+            total_size = self.total_size
+            return {
+                "total_files": self.total_files,
+                "total_size_bytes": total_size,
+                "total_size_mb": round(total_size / (1024 * 1024), 2) if total_size > 0 else 0.0,
+                "uploads_today": self.daily_uploads.get(date.today().isoformat(), 0),
+                "file_types": dict(categories),
+                "server_uptime": "Online"
+            }
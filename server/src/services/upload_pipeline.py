@@ -0,0 +1,320 @@
+"""
+Streaming upload ingest
+Spools request bodies to disk chunk by chunk so memory use per upload stays constant
+"""
+
+import os
+import time
+import hashlib
+import tempfile
+import logging
+from pathlib import Path
+from typing import AsyncIterator, Callable, Dict, List, Optional
+
+try:
+    import python_multipart as multipart
+    from python_multipart.exceptions import FormParserError
+    from python_multipart.multipart import parse_options_header
+except ModuleNotFoundError:  # python-multipart < 0.0.13
+    import multipart
+    from multipart.exceptions import FormParserError
+    from multipart.multipart import parse_options_header
+
+from starlette.concurrency import run_in_threadpool
+from starlette.types import ASGIApp, Receive, Scope, Send
+from starlette.responses import JSONResponse
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1MB per disk write
+TEMP_PREFIX = ".upload-"
+TEMP_SUFFIX = ".part"
+
+# Multipart framing (boundaries, part headers) on top of the file itself
+MULTIPART_OVERHEAD = 64 * 1024
+
+
+class UploadTooLarge(Exception):
+    """Raised when an upload body exceeds the configured size limit"""
+    pass
+
+
+class SpooledUpload:
+    """An upload that has been fully written to a temporary file"""
+
+    def __init__(self, temp_path: Path, size: int, sha256: str):
+        self.temp_path = temp_path
+        self.size = size
+        self.sha256 = sha256
+
+    def commit(self, final_path: Path) -> Path:
+        """Atomically move the spooled file into its final location"""
+        os.replace(self.temp_path, final_path)
+        self.temp_path = final_path
+        return final_path
+
+    def discard(self):
+        """Remove the temporary file if it is still around"""
+        try:
+            self.temp_path.unlink()
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"Error removing temporary upload {self.temp_path}: {e}")
+
+
+class MultipartError(Exception):
+    """Request body is not a well-formed multipart/form-data upload"""
+    pass
+
+
+class TooManyFiles(Exception):
+    """More file parts than the endpoint accepts"""
+    pass
+
+
+def _decode_header(value: bytes) -> str:
+    try:
+        return value.decode("utf-8")
+    except UnicodeDecodeError:
+        return value.decode("latin-1")
+
+
+class ReceivedFile:
+    """
+    One file part of a multipart body, spooled to a temp file in `directory` as it arrives
+
+    Data is hashed and written in UPLOAD_CHUNK_SIZE blocks off the event loop. Parts
+    that were not accepted, or that grew past `max_size`, keep no data (`spooled` is None).
+    """
+
+    def __init__(self, filename: str, content_type: Optional[str], directory: Path,
+                 max_size: int, accepted: bool = True):
+        self.filename = filename
+        self.content_type = content_type
+        self.max_size = max_size
+        self.accepted = accepted
+        self.size = 0
+        self.too_large = False
+        self.spooled: Optional[SpooledUpload] = None
+        self._hasher = hashlib.sha256()
+        self._buffer = bytearray()
+        self._file = None
+        self.temp_path: Optional[Path] = None
+        if accepted:
+            fd, temp_name = tempfile.mkstemp(dir=str(directory), prefix=TEMP_PREFIX, suffix=TEMP_SUFFIX)
+            self._file = os.fdopen(fd, "wb")
+            self.temp_path = Path(temp_name)
+
+    def feed(self, data: bytes) -> bool:
+        """Take part data; True when enough is buffered to write out"""
+        if self._file is None:
+            return False
+        self.size += len(data)
+        if self.size > self.max_size:
+            self.too_large = True
+            self.discard()
+            return False
+        self._buffer += data
+        return len(self._buffer) >= UPLOAD_CHUNK_SIZE
+
+    def _write(self, data: bytes):
+        self._hasher.update(data)
+        self._file.write(data)
+
+    async def flush(self):
+        if self._file is not None and self._buffer:
+            data = bytes(self._buffer)
+            self._buffer.clear()
+            await run_in_threadpool(self._write, data)
+
+    async def finish(self):
+        """End of the part: write what is left and hand the temp file over as `spooled`"""
+        if self._file is None:
+            return
+        await self.flush()
+        self._file.close()
+        self._file = None
+        self.spooled = SpooledUpload(self.temp_path, self.size, self._hasher.hexdigest())
+
+    def discard(self):
+        """Drop the temp file (rejected part, failed request, or nobody took the upload)"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.temp_path is not None:
+            SpooledUpload(self.temp_path, self.size, "").discard()
+        self.spooled = None
+        self._buffer.clear()
+
+
+class MultipartUploadParser:
+    """
+    Streams the file parts of a multipart/form-data request straight into spool files
+
+    Each part named `field_name` with a filename becomes a ReceivedFile; its bytes go
+    from the request stream to the temp file with nothing else in between, so an
+    upload is written to disk once and memory per upload stays at one chunk.
+    `accept(filename)` can refuse a part before any of its data is stored. With
+    `strict`, an oversized part fails the whole request (UploadTooLarge) as soon as
+    it passes `max_size`; otherwise it is only flagged and the rest keep coming.
+    Other form fields are skipped.
+    """
+
+    def __init__(self, directory: Path, max_size: int, field_name: str = "file", max_files: int = 1,
+                 accept: Optional[Callable[[str], bool]] = None, strict: bool = True):
+        self.directory = Path(directory)
+        self.max_size = max_size
+        self.field_name = field_name
+        self.max_files = max_files
+        self.accept = accept
+        self.strict = strict
+        self.files: List[ReceivedFile] = []
+        self._current: Optional[ReceivedFile] = None
+        self._header_name = b""
+        self._header_value = b""
+        self._headers: Dict[bytes, bytes] = {}
+        self._ready: List[ReceivedFile] = []
+        self._finished: List[ReceivedFile] = []
+
+    def _on_part_begin(self):
+        self._current = None
+        self._headers = {}
+
+    def _on_header_field(self, data: bytes, start: int, end: int):
+        self._header_name += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._header_name.lower()] = self._header_value
+        self._header_name = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition"))
+        if b"filename" not in options or _decode_header(options.get(b"name", b"")) != self.field_name:
+            return
+        if len(self.files) >= self.max_files:
+            raise TooManyFiles(f"At most {self.max_files} files per request")
+        filename = _decode_header(options[b"filename"])
+        content_type = self._headers.get(b"content-type")
+        accepted = self.accept is None or self.accept(filename)
+        self._current = ReceivedFile(
+            filename, _decode_header(content_type) if content_type else None,
+            self.directory, self.max_size, accepted
+        )
+        self.files.append(self._current)
+
+    def _on_part_data(self, data: bytes, start: int, end: int):
+        part = self._current
+        if part is not None and part.feed(data[start:end]) and part not in self._ready:
+            self._ready.append(part)
+
+    def _on_part_end(self):
+        if self._current is not None:
+            self._finished.append(self._current)
+            self._current = None
+
+    async def _write_pending(self):
+        for part in self._ready:
+            await part.flush()
+        for part in self._finished:
+            await part.finish()
+        self._ready.clear()
+        self._finished.clear()
+        if self.strict and any(part.too_large for part in self.files):
+            raise UploadTooLarge(f"Upload exceeds {self.max_size} bytes")
+
+    async def parse(self, headers, stream: AsyncIterator[bytes]) -> List[ReceivedFile]:
+        """Read the whole body; returns the file parts in request order"""
+        content_type, params = parse_options_header(headers.get("content-type"))
+        if content_type != b"multipart/form-data" or b"boundary" not in params:
+            raise MultipartError("Expected a multipart/form-data body")
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        parser = multipart.MultipartParser(params[b"boundary"], {
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+        })
+        try:
+            async for chunk in stream:
+                # Callbacks only buffer; the file writes happen here, off the event loop
+                parser.write(chunk)
+                await self._write_pending()
+            parser.finalize()
+            await self._write_pending()
+            if self._current is not None:
+                raise MultipartError("Request body ended in the middle of a file")
+        except BaseException as e:
+            for part in self.files:
+                part.discard()
+            if isinstance(e, FormParserError):
+                raise MultipartError("Invalid multipart data") from e
+            raise
+        return self.files
+
+
+def cleanup_stale_temp_files(directory: Path, max_age: float = 3600) -> int:
+    """Remove leftover spool files from interrupted uploads"""
+    removed = 0
+    if not directory.exists():
+        return removed
+
+    cutoff = time.time() - max_age
+    for temp_file in directory.glob(f"{TEMP_PREFIX}*{TEMP_SUFFIX}"):
+        try:
+            # Only touch old files - another worker may still be writing fresh ones
+            if temp_file.stat().st_mtime > cutoff:
+                continue
+            temp_file.unlink()
+            removed += 1
+        except Exception as e:
+            logger.error(f"Error removing stale upload {temp_file}: {e}")
+
+    if removed:
+        logger.info(f"Removed {removed} stale upload spool files")
+    return removed
+
+
+class UploadSizeLimitMiddleware:
+    """Reject upload requests whose declared Content-Length is over the limit before parsing the body"""
+
+    def __init__(self, app: ASGIApp, max_body_size: int, paths: tuple = ("/upload",),
+                 path_limits: Optional[Dict[str, int]] = None):
+        self.app = app
+        self.max_body_size = max_body_size + MULTIPART_OVERHEAD
+        self.paths = paths
+        # Exact paths with their own limit (e.g. multi-file batches)
+        self.path_limits = {path: limit + MULTIPART_OVERHEAD for path, limit in (path_limits or {}).items()}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "http" and scope["method"] in ("POST", "PUT", "PATCH"):
+            path = scope.get("path", "")
+            limit = self.path_limits.get(path)
+            if limit is None and any(path == p or path.startswith(f"{p}/") for p in self.paths):
+                limit = self.max_body_size
+            if limit is not None:
+                content_length = self._content_length(scope)
+                if content_length is not None and content_length > limit:
+                    response = JSONResponse({"detail": "File too large"}, status_code=413)
+                    await response(scope, receive, send)
+                    return
+
+        await self.app(scope, receive, send)
+
+    @staticmethod
+    def _content_length(scope: Scope) -> Optional[int]:
+        for name, value in scope.get("headers", []):
+            if name == b"content-length":
+                try:
+                    return int(value)
+                except ValueError:
+                    return None
+        return None
@@ -0,0 +1,298 @@
+"""
+Resumable uploads
+tus-style sessions: create, append chunks at an offset, query the offset, finalize
+"""
+
+import os
+import time
+import uuid
+import asyncio
+import shutil
+import hashlib
+import logging
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Optional, Dict, Any, AsyncIterator, BinaryIO
+
+from starlette.concurrency import run_in_threadpool
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process only
+    fcntl = None
+
+from .upload_pipeline import SpooledUpload, UPLOAD_CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Chunk size suggested to clients; small enough that a dropped connection loses little
+SESSION_CHUNK_SIZE = 2 * 1024 * 1024
+PART_SUFFIX = ".part"
+# Part files without a session are only removed once they are this old (seconds), so
+# one that create() is just setting up is never mistaken for an orphan
+ORPHAN_PART_AGE = 3600
+
+
+def _lock_part(part: BinaryIO) -> bool:
+    """Exclusive lock on an open part file against other worker processes; False if one holds it"""
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(part.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+
+
+class SessionNotFound(Exception):
+    """Unknown, finished or expired upload session"""
+    pass
+
+
+class OffsetMismatch(Exception):
+    """Chunk does not start where the session's data ends"""
+
+    def __init__(self, offset: int):
+        super().__init__(f"Expected offset {offset}")
+        self.offset = offset
+
+
+class SessionOverflow(Exception):
+    """Chunk would take the upload past its declared size"""
+    pass
+
+
+class SessionIncomplete(Exception):
+    """Finalize called before all bytes (or the right bytes) arrived"""
+    pass
+
+
+class SessionBusy(Exception):
+    """Another request or worker process is working on the session"""
+    pass
+
+
+class _SessionLock:
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+class SessionUpload(SpooledUpload):
+    """
+    A finalized session's data
+
+    The part file stays with the session until complete() or abort, so a store that
+    fails after commit() can simply be finalized again: commit() links the data into
+    place (copying where hard links are not supported) and discard() leaves it alone.
+    """
+
+    def commit(self, final_path: Path) -> Path:
+        try:
+            os.link(self.temp_path, final_path)
+        except OSError:
+            shutil.copyfile(self.temp_path, final_path)
+        return final_path
+
+    def discard(self):
+        pass
+
+
+class UploadSessionManager:
+    """
+    Resumable upload sessions
+
+    Session records live in the metadata store, received bytes in
+    `{directory}/{session_id}.part`; the part file's length is the authoritative
+    offset, so state survives restarts and partially received chunks are kept.
+    Sessions idle for longer than `ttl` seconds are garbage-collected.
+    """
+
+    def __init__(self, store, directory: Path, ttl: float, max_size: int):
+        self.store = store
+        self.directory = Path(directory)
+        self.ttl = ttl
+        self.max_size = max_size
+        self._locks: Dict[str, _SessionLock] = {}
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def part_path(self, session_id: str) -> Path:
+        return self.directory / f"{session_id}{PART_SUFFIX}"
+
+    def _lock_part_file(self, session_id: str) -> BinaryIO:
+        """Open the part file holding its cross-process lock; SessionBusy if another process has it"""
+        try:
+            part = open(self.part_path(session_id), "rb")
+        except FileNotFoundError:
+            raise SessionNotFound(session_id)
+        if not _lock_part(part):
+            part.close()
+            raise SessionBusy(session_id)
+        return part
+
+    @asynccontextmanager
+    async def lock(self, session_id: str):
+        """
+        Serializes appends, finalization and abort of one session
+
+        Requests in this process wait for each other; across worker processes an
+        flock on the part file is taken without waiting, raising SessionBusy if
+        another process holds it (SessionNotFound if there is no part file).
+        """
+        entry = self._locks.get(session_id)
+        if entry is None:
+            entry = self._locks[session_id] = _SessionLock()
+        entry.users += 1
+        try:
+            async with entry.lock:
+                part = self._lock_part_file(session_id)
+                try:
+                    yield
+                finally:
+                    part.close()
+        finally:
+            entry.users -= 1
+            if entry.users == 0:
+                del self._locks[session_id]
+
+    def create(self, filename: str, size: int, content_type: Optional[str] = None,
+               sha256: Optional[str] = None) -> Dict[str, Any]:
+        """Open a new session with an empty part file"""
+        if size < 0 or size > self.max_size:
+            raise SessionOverflow(f"Upload size must be between 0 and {self.max_size} bytes")
+        now = time.time()
+        session = {
+            "session_id": uuid.uuid4().hex,
+            "filename": filename,
+            "content_type": content_type,
+            "size": size,
+            "sha256": sha256.lower() if sha256 else None,
+            "created_at": now,
+            "expires_at": now + self.ttl,
+        }
+        # Record first: garbage collection deletes part files that have no session
+        self.store.create_session(session)
+        self.part_path(session["session_id"]).touch()
+        session["offset"] = 0
+        return session
+
+    def get(self, session_id: str) -> Dict[str, Any]:
+        """Session record plus its current offset"""
+        session = self.store.load_session(session_id)
+        if session is None or session["expires_at"] < time.time():
+            raise SessionNotFound(session_id)
+        try:
+            session["offset"] = os.path.getsize(self.part_path(session_id))
+        except FileNotFoundError:
+            raise SessionNotFound(session_id)
+        return session
+
+    async def append(self, session_id: str, offset: int, chunks: AsyncIterator[bytes]) -> Dict[str, Any]:
+        """Write a request body at `offset`; returns the session with its new offset"""
+        try:
+            async with self.lock(session_id):
+                return await self._append(session_id, offset, chunks)
+        except SessionBusy:
+            # Another worker is appending; the client re-reads the offset and resumes
+            raise OffsetMismatch(self.get(session_id)["offset"])
+
+    async def _append(self, session_id: str, offset: int, chunks: AsyncIterator[bytes]) -> Dict[str, Any]:
+        session = self.get(session_id)
+        if offset != session["offset"]:
+            raise OffsetMismatch(session["offset"])
+
+        remaining = session["size"] - offset
+        buffer = bytearray()
+        with open(self.part_path(session_id), "ab") as out:
+            try:
+                async for chunk in chunks:
+                    if len(chunk) > remaining:
+                        raise SessionOverflow(session_id)
+                    remaining -= len(chunk)
+                    buffer += chunk
+                    if len(buffer) >= UPLOAD_CHUNK_SIZE:
+                        await run_in_threadpool(out.write, bytes(buffer))
+                        buffer.clear()
+            finally:
+                # Whatever arrived before a disconnect is kept; the client resumes after it
+                if buffer:
+                    await run_in_threadpool(out.write, bytes(buffer))
+
+        self.store.touch_session(session_id, time.time() + self.ttl)
+        session["offset"] = session["size"] - remaining
+        return session
+
+    def _hash_part(self, session_id: str) -> str:
+        hasher = hashlib.sha256()
+        with open(self.part_path(session_id), "rb") as f:
+            for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    async def finalize(self, session_id: str) -> SessionUpload:
+        """
+        Verify a fully received session and hand its data over as a SessionUpload
+
+        Call while holding `lock(session_id)`; the session stays open until
+        `complete()` so a failed store can be retried.
+        """
+        session = self.get(session_id)
+        if session["offset"] != session["size"]:
+            raise SessionIncomplete(f"Received {session['offset']} of {session['size']} bytes")
+
+        sha256 = await run_in_threadpool(self._hash_part, session_id)
+        if session["sha256"] and session["sha256"] != sha256:
+            # Corrupt data can't be resumed - start over
+            self._remove(session_id)
+            raise SessionIncomplete("Checksum mismatch, upload discarded")
+        return SessionUpload(self.part_path(session_id), session["size"], sha256)
+
+    def complete(self, session_id: str):
+        """Close a finalized session (its part file has been committed or discarded); call while holding the lock"""
+        self._remove(session_id)
+
+    def _remove(self, session_id: str) -> bool:
+        self.part_path(session_id).unlink(missing_ok=True)
+        return self.store.delete_session(session_id)
+
+    async def abort(self, session_id: str) -> bool:
+        """Drop a session and any data received for it; SessionBusy while it is being worked on"""
+        try:
+            async with self.lock(session_id):
+                return self._remove(session_id)
+        except SessionNotFound:
+            # No data left, at most a record
+            return self.store.delete_session(session_id)
+
+    def collect_garbage(self, now: Optional[float] = None) -> int:
+        """Remove expired sessions that nobody is working on, and old part files that no session owns"""
+        now = time.time() if now is None else now
+        removed = 0
+        for session_id in self.store.expired_sessions(now):
+            try:
+                part = self._lock_part_file(session_id)
+            except SessionNotFound:
+                removed += int(self.store.delete_session(session_id))
+                continue
+            except SessionBusy:
+                continue
+            try:
+                removed += int(self._remove(session_id))
+            finally:
+                part.close()
+
+        known = set(self.store.session_ids())
+        for part in self.directory.glob(f"*{PART_SUFFIX}"):
+            if part.name[:-len(PART_SUFFIX)] in known:
+                continue
+            try:
+                if part.stat().st_mtime > now - ORPHAN_PART_AGE:
+                    continue
+            except FileNotFoundError:
+                continue
+            part.unlink(missing_ok=True)
+            removed += 1
+
+        if removed:
+            logger.info(f"Removed {removed} expired upload sessions")
+        return removed
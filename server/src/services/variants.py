@@ -0,0 +1,334 @@
+"""
+Image variants
+Lazily generated resized copies of stored images, kept in an LRU disk cache with a byte budget
+"""
+
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional, Dict, Set, Tuple, Callable, Awaitable, Sequence
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process only
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_VARIANT_SIZE = 200
+MAX_VARIANT_SIZE = 2048
+
+# Formats offered through Accept negotiation, most compact first
+NEGOTIATED_FORMATS = ("avif", "webp")
+# Sources worth transcoding (GIFs may be animated, WebP is already compact)
+TRANSCODABLE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.bmp', '.tiff', '.tif'}
+# Render temp files older than this (seconds) were left by a process that died; fresher
+# ones may belong to another worker's render in progress
+STALE_TEMP_AGE = 3600
+
+
+def normalize_variant_size(width: Optional[int], height: Optional[int]) -> Tuple[int, int]:
+    """Bounding box for a request; a missing side is unconstrained, both missing is the default thumbnail"""
+    if width is None and height is None:
+        return DEFAULT_VARIANT_SIZE, DEFAULT_VARIANT_SIZE
+    width = MAX_VARIANT_SIZE if width is None else width
+    height = MAX_VARIANT_SIZE if height is None else height
+    return max(1, min(width, MAX_VARIANT_SIZE)), max(1, min(height, MAX_VARIANT_SIZE))
+
+
+def variant_name(source: str, size: Tuple[int, int], extension: str) -> str:
+    """Cache filename for one variant of a stored file"""
+    return f"{source}_{size[0]}x{size[1]}{extension}"
+
+
+def variant_etag(source_etag: str, size: Optional[Tuple[int, int]], fmt: str) -> str:
+    """Strong ETag derived from the source's, so it survives eviction and regeneration"""
+    if size is None:
+        return f'"{source_etag.strip(chr(34))}-{fmt}"'
+    return f'"{source_etag.strip(chr(34))}-{size[0]}x{size[1]}-{fmt}"'
+
+
+def negotiate_format(accept: Optional[str], available: Sequence[str]) -> Optional[str]:
+    """
+    First of `available` (in order) that the Accept header explicitly allows, or None
+
+    Wildcards don't count: a client that only says `*/*` or `image/*` gets the original.
+    """
+    if not accept:
+        return None
+    accepted = {}
+    for part in accept.split(","):
+        media_type, *params = part.split(";")
+        quality = 1.0
+        for param in params:
+            key, _, value = param.strip().partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[media_type.strip().lower()] = quality
+    for fmt in available:
+        if accepted.get(f"image/{fmt}", 0) > 0:
+            return fmt
+    return None
+
+
+class _Coalescing:
+    """Runs at most one render per key; later callers wait on the same task"""
+
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    def _start(self, key: str, factory: Callable[[], Awaitable]) -> asyncio.Task:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._finished(key, done))
+        return task
+
+    def _finished(self, key: str, task: asyncio.Task):
+        self._inflight.pop(key, None)
+        if not task.cancelled() and task.exception() is not None:
+            # Retrieved here so a render nobody waits for any more doesn't log as unhandled
+            logger.debug(f"Render of {key} failed: {task.exception()!r}")
+
+
+class TranscodeCache(_Coalescing):
+    """
+    Full-size re-encodings of stored images, kept next to the original
+
+    `{stored filename}.{fmt}` lives in the same directory as the original and goes
+    away with it; there is no separate budget since at most one copy per format exists.
+    What became of each copy is remembered (up to `max_remembered`, least recently
+    used dropped): usable ones with their stat, so serving them needs no disk probe,
+    and failed or not-smaller ones as None, so they are not made again on every request.
+    """
+
+    def __init__(self, extensions: Dict[str, str], max_remembered: int = 10000,
+                 transient_errors: Tuple[type, ...] = ()):
+        super().__init__()
+        self.extensions = extensions
+        self.max_remembered = max_remembered
+        # Render failures worth trying again later (e.g. a busy pool)
+        self.transient_errors = transient_errors
+        self._known: "OrderedDict[str, Optional[os.stat_result]]" = OrderedDict()
+
+    def path_for(self, source: Path, fmt: str) -> Path:
+        return source.with_name(source.name + self.extensions[fmt])
+
+    def _remember(self, key: str, stat: Optional[os.stat_result]):
+        self._known[key] = stat
+        self._known.move_to_end(key)
+        while len(self._known) > self.max_remembered:
+            self._known.popitem(last=False)
+
+    def lookup(self, source: Path, fmt: str, source_size: int) -> Tuple[Optional[Path], Optional[os.stat_result]]:
+        """Transcoded copy and its stat when it exists and is smaller than the source, else (None, None)"""
+        path = self.path_for(source, fmt)
+        key = str(path)
+        if key in self._known:
+            self._known.move_to_end(key)
+            stat = self._known[key]
+            return (path, stat) if stat is not None else (None, None)
+        if key in self._inflight:
+            return None, None
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None, None
+        # Made before this process started (or by another worker)
+        self._remember(key, stat if stat.st_size < source_size else None)
+        return self.lookup(source, fmt, source_size)
+
+    def wanted(self, source: Path, fmt: str) -> bool:
+        """False when the copy is already known (usable or not) or being made"""
+        key = str(self.path_for(source, fmt))
+        return key not in self._known and key not in self._inflight
+
+    def schedule(self, source: Path, fmt: str, source_size: int,
+                 render: Callable[[Path], Awaitable[int]]) -> asyncio.Task:
+        """Start (or join) the transcode in the background"""
+        path = self.path_for(source, fmt)
+        return self._start(str(path), lambda: self._transcode(path, source_size, render))
+
+    async def _transcode(self, path: Path, source_size: int, render: Callable[[Path], Awaitable[int]]):
+        key = str(path)
+        try:
+            size = await render(path)
+        except self.transient_errors:
+            raise
+        except Exception:
+            self._remember(key, None)
+            raise
+        if size >= source_size:
+            # Not worth serving; the original is sent instead from now on
+            path.unlink(missing_ok=True)
+            self._remember(key, None)
+        else:
+            self._remember(key, os.stat(path))
+
+    def forget(self, source: Path):
+        """Drop what is known about a stored file's copies (its content is being removed)"""
+        for fmt in self.extensions:
+            self._known.pop(str(self.path_for(source, fmt)), None)
+
+
+class VariantCache(_Coalescing):
+    """
+    On-disk LRU of generated variants
+
+    Variants are keyed by the stored file they were made from (the blob filename
+    stem, so deduplicated uploads share them). Concurrent requests for a variant
+    that is still being generated wait on the same task instead of rendering it
+    again. When the total size exceeds `max_bytes` the least recently served
+    variants are deleted.
+
+    `workers` processes may share the directory, each with an equal share of the
+    budget: a worker tracks the variants it rendered or served and only evicts
+    those. A variant another worker rendered is adopted on lookup.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int, workers: int = 1):
+        super().__init__()
+        self.directory = Path(directory)
+        self.workers = max(workers, 1)
+        self.directory_bytes = max_bytes
+        self.max_bytes = max_bytes // self.workers
+        self.total_bytes = 0
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._by_source: Dict[str, Set[str]] = {}
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @contextmanager
+    def _directory_lock(self):
+        """Exclusive against the other worker processes sharing the directory"""
+        with open(self.directory / ".lock", "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            yield
+
+    def load(self) -> int:
+        """
+        Tidy up after a previous run and adopt the variants left on disk
+
+        Workers start together, so one at a time removes stale render temp files and
+        trims the directory to the whole budget, least recently modified first. A
+        single worker adopts what is left; with several, each variant goes to the
+        worker that serves it first.
+        """
+        stale = time.time() - STALE_TEMP_AGE
+        found = []
+        with self._directory_lock():
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    if entry.name.startswith("."):
+                        if entry.name.endswith(".tmp") and stat.st_mtime < stale:
+                            Path(entry.path).unlink(missing_ok=True)
+                        continue
+                    found.append((stat.st_mtime, entry.name, stat.st_size))
+
+            found.sort()
+            total = sum(size for _, _, size in found)
+            # The newest variant always stays, even if it alone is over budget
+            while total > self.directory_bytes and len(found) > 1:
+                _, name, size = found.pop(0)
+                (self.directory / name).unlink(missing_ok=True)
+                total -= size
+
+        self._entries.clear()
+        self._by_source.clear()
+        self.total_bytes = 0
+        if self.workers == 1:
+            for _, name, size in found:
+                self._register(name, size)
+        logger.info(f"Variant cache loaded {len(self._entries)} of {len(found)} files ({self.total_bytes} bytes)")
+        return len(self._entries)
+
+    @staticmethod
+    def _source_of(name: str) -> str:
+        return name.rsplit("_", 1)[0]
+
+    def _register(self, name: str, size: int):
+        previous = self._entries.pop(name, None)
+        if previous is not None:
+            self.total_bytes -= previous
+        self._entries[name] = size
+        self.total_bytes += size
+        self._by_source.setdefault(self._source_of(name), set()).add(name)
+
+    def _forget(self, name: str):
+        size = self._entries.pop(name, None)
+        if size is None:
+            return
+        self.total_bytes -= size
+        source = self._source_of(name)
+        names = self._by_source.get(source)
+        if names is not None:
+            names.discard(name)
+            if not names:
+                del self._by_source[source]
+        (self.directory / name).unlink(missing_ok=True)
+
+    def _evict(self):
+        # The newest entry always stays, even if it alone is over budget
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            oldest = next(iter(self._entries))
+            self._forget(oldest)
+
+    def lookup(self, name: str) -> Optional[Path]:
+        """Path of a cached variant (marking it recently used), or None"""
+        path = self.directory / name
+        if name not in self._entries:
+            # Rendered by another worker, or left by a previous run
+            try:
+                size = path.stat().st_size
+            except FileNotFoundError:
+                return None
+            self._register(name, size)
+            self._evict()
+            return path
+        if not path.exists():
+            self._forget(name)
+            return None
+        self._entries.move_to_end(name)
+        return path
+
+    async def get_or_create(self, name: str, render: Callable[[Path], Awaitable[int]]) -> Path:
+        """
+        Cached variant `name`, generating it with `render(path) -> size` on a miss
+
+        Only one render per name runs at a time; it is not cancelled when the request
+        that started it goes away, since others may be waiting on it.
+        """
+        path = self.lookup(name)
+        if path is not None:
+            return path
+
+        task = self._start(name, lambda: self._create(name, render))
+        return await asyncio.shield(task)
+
+    async def _create(self, name: str, render: Callable[[Path], Awaitable[int]]) -> Path:
+        path = self.directory / name
+        size = await render(path)
+        self._register(name, size)
+        self._evict()
+        return path
+
+    def discard_source(self, source: str) -> int:
+        """Delete every variant of a stored file (when its content is removed)"""
+        names = list(self._by_source.get(source, ()))
+        for name in names:
+            self._forget(name)
+        return len(names)
@@ -11,8 +11,10 @@ def main():
     # Get port from Railway environment, default to 8080 for testing
     port = int(os.environ.get("PORT", 8080))
     host = os.environ.get("HOST", "0.0.0.0")
+    # One process per core is a good start; workers share state through the metadata database
+    workers = max(1, int(os.environ.get("WEB_CONCURRENCY", 1)))
     
-    print(f"Starting VRCPhoto2URL server on {host}:{port}")
+    print(f"Starting VRCPhoto2URL server on {host}:{port} ({workers} worker{'s' if workers > 1 else ''})")
     print(f"Public URL: {os.environ.get('RAILWAY_PUBLIC_DOMAIN', 'http://localhost:8000')}")
     
     # Start the FastAPI application
@@ -20,6 +22,7 @@ def main():
         "src.app:app",
         host=host,
         port=port,
+        workers=workers,
         timeout_keep_alive=300,
         access_log=True,
         reload=False  # Disable reload in production
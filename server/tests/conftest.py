@@ -0,0 +1,64 @@
+"""
+Shared fixtures for the server tests
+
+Run from the server directory: python -m pytest tests
+The app reads its configuration at import time, so the environment is set up here,
+before any test imports src.app.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+from pathlib import Path
+
+import pytest
+
+SERVER_DIR = Path(__file__).resolve().parent.parent
+if str(SERVER_DIR) not in sys.path:
+    sys.path.insert(0, str(SERVER_DIR))
+
+API_KEY = "test-api-key"
+UPLOAD_DIR = Path(tempfile.mkdtemp(prefix="vrcphoto2url-tests-"))
+
+os.environ["UPLOAD_DIR"] = str(UPLOAD_DIR)
+os.environ["API_KEY"] = API_KEY
+# Image jobs run on the threadpool instead of spawning worker processes
+os.environ["IMAGE_WORKERS"] = "0"
+os.environ.pop("WEB_CONCURRENCY", None)
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(UPLOAD_DIR, ignore_errors=True)
+
+
+@pytest.fixture(scope="session")
+def server():
+    """The app module (its stores, caches and config)"""
+    from src import app as server_app
+    return server_app
+
+
+@pytest.fixture(scope="session")
+def client(server):
+    """Authenticated client; the app's startup runs once for the whole session"""
+    from fastapi.testclient import TestClient
+
+    with TestClient(server.app, headers={"Authorization": f"Bearer {API_KEY}"}) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def image_bytes():
+    """PNG of a given size; `seed` makes the content (and so its hash) unique"""
+    import io
+    from PIL import Image
+
+    def make(size=(64, 48), seed=0, fmt="PNG"):
+        img = Image.new("RGB", size, ((seed * 37) % 256, (seed * 91) % 256, (seed * 53) % 256))
+        img.putpixel((0, 0), (seed % 256, (seed >> 8) % 256, (seed >> 16) % 256))
+        buffer = io.BytesIO()
+        img.save(buffer, fmt)
+        return buffer.getvalue()
+
+    return make
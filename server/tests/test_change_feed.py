@@ -0,0 +1,79 @@
+"""Change feed: a worker's startup state and the log it follows afterwards"""
+
+import anyio
+
+from src.services.change_feed import ChangeFeed
+from src.services.file_list import FileListCache
+from src.services.metadata_store import MetadataStore
+from src.services.stats_engine import StatsEngine
+
+
+def metadata_for(file_id, sha256):
+    return {"file_id": file_id, "original_filename": f"{file_id}.png", "upload_time": "2020-01-01T00:00:00",
+            "file_type": "images", "file_size": 3, "sha256": sha256}
+
+
+def upload(store, file_id):
+    store.save_many_with_blobs([(file_id, metadata_for(file_id, file_id),
+                                 {"sha256": file_id, "filename": f"{file_id}.png", "file_size": 3}, False)])
+
+
+class Worker:
+    """The state one server process builds at startup and keeps current from the feed"""
+
+    def __init__(self, store):
+        self.stats = StatsEngine()
+        self.files = FileListCache()
+        self.feed = ChangeFeed(store, self.apply)
+
+    def apply(self, changes):
+        for change in changes:
+            if change["op"] == "delete":
+                self.stats.record_delete(change["metadata"])
+                self.files.remove(change["file_id"])
+            else:
+                self.stats.record_upload(change["metadata"])
+                self.files.add(change["metadata"])
+
+    def start(self, snapshot):
+        self.feed.mark(snapshot.last_change)
+        self.stats.rebuild(snapshot.type_aggregates, snapshot.daily_upload_counts)
+        self.files.load(snapshot.files)
+
+
+def test_write_during_startup_is_counted_once(tmp_path):
+    db = tmp_path / "metadata.db"
+    starting, other = MetadataStore(db, origin="a"), MetadataStore(db, origin="b")
+    upload(other, "before")
+
+    # The other worker commits an upload while this one is reading its startup state
+    read_last_change = starting.last_change
+    def last_change_then_upload():
+        position = read_last_change()
+        upload(other, "during")
+        return position
+    starting.last_change = last_change_then_upload
+
+    worker = Worker(starting)
+    worker.start(starting.snapshot())
+    assert worker.stats.file_count() == 1
+
+    assert anyio.run(worker.feed.poll) == 1
+    assert worker.stats.file_count() == 2
+    assert sorted(metadata["file_id"] for metadata in worker.files.newest_first()) == ["before", "during"]
+
+
+def test_feed_applies_only_other_workers_changes(tmp_path):
+    db = tmp_path / "metadata.db"
+    mine, other = MetadataStore(db, origin="a"), MetadataStore(db, origin="b")
+    worker = Worker(mine)
+    worker.start(mine.snapshot())
+
+    upload(mine, "own")
+    upload(other, "remote")
+    other.delete_many(["remote"])
+    applied = []
+    worker.feed.apply = applied.extend
+    assert anyio.run(worker.feed.poll) == 2
+    assert [(change["op"], change["file_id"]) for change in applied] == [("save", "remote"), ("delete", "remote")]
+    assert anyio.run(worker.feed.poll) == 0
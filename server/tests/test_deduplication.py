@@ -0,0 +1,75 @@
+"""Content-addressed deduplication and its race with deletes"""
+
+import anyio.from_thread
+
+from src.services.metadata_store import MetadataStore, BlobEntry
+
+
+def metadata_for(file_id, sha256):
+    return {"file_id": file_id, "original_filename": f"{file_id}.png", "upload_time": "2020-01-01T00:00:00",
+            "file_type": "images", "sha256": sha256}
+
+
+def test_reuse_of_a_released_blob_saves_nothing(tmp_path):
+    """One worker's dedup lookup, another worker's delete, then the first worker's registration"""
+    db = tmp_path / "metadata.db"
+    uploader, deleter = MetadataStore(db, origin="a"), MetadataStore(db, origin="b")
+    uploader.save_many_with_blobs([("x", metadata_for("x", "h"), {"sha256": "h", "filename": "h.png", "file_size": 3}, False)])
+
+    found = uploader.find_blob("h")
+    [(_, _, released)] = deleter.delete_many(["x"])
+    assert released
+
+    assert uploader.save_many_with_blobs([BlobEntry("y", metadata_for("y", "h"), found, reuse=True)]) == [None]
+    assert uploader.find_blob("h") is None
+    assert uploader.load("y") is None
+
+
+def test_reuse_of_a_live_blob_takes_a_reference(tmp_path):
+    store = MetadataStore(tmp_path / "metadata.db")
+    store.save_many_with_blobs([("x", metadata_for("x", "h"), {"sha256": "h", "filename": "h.png", "file_size": 3}, False)])
+
+    [canonical] = store.save_many_with_blobs([BlobEntry("y", metadata_for("y", "h"), store.find_blob("h"), reuse=True)])
+    assert canonical["refcount"] == 2
+    assert store.load("y")["filename"] == "h.png"
+    # The content stays until the last file using it is gone
+    assert [released for _, _, released in store.delete_many(["x"])] == [False]
+    assert [released for _, _, released in store.delete_many(["y"])] == [True]
+
+
+def test_duplicate_upload_shares_content(server, client, image_bytes):
+    data = image_bytes(seed=2001)
+    first = client.post("/upload", files={"file": ("a.png", data, "image/png")}).json()
+    second = client.post("/upload", files={"file": ("b.png", data, "image/png")}).json()
+    assert second["deduplicated"] and not first["deduplicated"]
+
+    assert client.delete(f"/files/{first['file_id']}").status_code == 200
+    served = client.get(f"/files/{second['file_id']}")
+    assert served.status_code == 200 and served.content == data
+
+
+def test_duplicate_of_content_deleted_mid_upload_stores_its_own_copy(server, client, image_bytes, monkeypatch):
+    data = image_bytes(seed=2002)
+    first = client.post("/upload", files={"file": ("a.png", data, "image/png")}).json()
+
+    find_blob = server.metadata_store.find_blob
+
+    def find_then_lose_blob(sha256):
+        blob = find_blob(sha256)
+        # The last file using the content is deleted right after the dedup check
+        anyio.from_thread.run(server.purge_files, [first["file_id"]])
+        return blob
+
+    monkeypatch.setattr(server.metadata_store, "find_blob", find_then_lose_blob)
+    response = client.post("/upload", files={"file": ("b.png", data, "image/png")})
+    monkeypatch.undo()
+
+    assert response.status_code == 200, response.text
+    second = response.json()
+    assert not second["deduplicated"]
+    assert client.get(f"/files/{first['file_id']}").status_code == 404
+    served = client.get(f"/files/{second['file_id']}")
+    assert served.status_code == 200 and served.content == data
+    sha256 = server.metadata_store.load(second["file_id"])["sha256"]
+    assert server.metadata_store.find_blob(sha256)["refcount"] == 1
+    assert not list(server.Config.FILES_DIR.glob(".upload-*"))
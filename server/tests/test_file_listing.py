@@ -0,0 +1,81 @@
+"""Keyset paging and totals for GET /files"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+
+@pytest.fixture(scope="module")
+def listed(server, client):
+    """40 text files under one name prefix, one second apart, saved through the store"""
+    start = datetime(2001, 1, 1)
+    file_ids = []
+    entries = []
+    for i in range(40):
+        file_id = f"listing-{i:02d}"
+        metadata = {
+            "file_id": file_id,
+            "original_filename": f"listing_{i:02d}.txt",
+            "url": f"http://localhost/files/{file_id}",
+            "upload_time": (start + timedelta(seconds=i)).isoformat(),
+            "file_type": "documents",
+            "content_type": "text/plain",
+            "sha256": f"listing-{i}",
+        }
+        blob = {"sha256": metadata["sha256"], "filename": f"{file_id}.txt", "file_size": 10}
+        entries.append((file_id, metadata, blob, False))
+        file_ids.append(file_id)
+    server.metadata_store.save_many_with_blobs(entries)
+    for _, metadata, _, _ in entries:
+        server.stats_engine.record_upload(metadata)
+    yield list(reversed(file_ids))
+    server.metadata_store.delete_many(file_ids)
+    for _, metadata, _, _ in entries:
+        server.stats_engine.record_delete(metadata)
+
+
+def walk(client, **params):
+    pages, cursor = [], None
+    while True:
+        response = client.get("/files", params={**params, **({"cursor": cursor} if cursor else {})})
+        assert response.status_code == 200, response.text
+        body = response.json()
+        pages.append(body)
+        cursor = body["next_cursor"]
+        if cursor is None:
+            return pages
+
+
+def test_cursor_pages_cover_every_file_once_newest_first(client, listed):
+    pages = walk(client, limit=7, name_prefix="listing_")
+    assert [f["file_id"] for page in pages for f in page["files"]] == listed
+    assert [len(page["files"]) for page in pages] == [7] * 5 + [5]
+
+
+def test_filtered_total_is_counted_on_the_first_page_only(server, client, listed, monkeypatch):
+    calls = []
+    count_matching = server.metadata_store.count_matching
+    monkeypatch.setattr(server.metadata_store, "count_matching",
+                        lambda **filters: calls.append(filters) or count_matching(**filters))
+
+    pages = walk(client, limit=15, name_prefix="listing_", uploaded_after="2001-01-01T00:00:10")
+    assert pages[0]["total_count"] == 30
+    assert all(page["total_count"] is None for page in pages[1:])
+    assert len(calls) == 1
+
+
+def test_unfiltered_and_type_totals_come_from_running_stats(server, client, listed, monkeypatch):
+    documents = server.metadata_store.count_matching(file_type="documents")
+    monkeypatch.setattr(server.metadata_store, "count_matching",
+                        lambda **filters: pytest.fail("counted in the database"))
+
+    first = client.get("/files", params={"limit": 5}).json()
+    later = client.get("/files", params={"limit": 5, "cursor": first["next_cursor"]}).json()
+    assert first["total_count"] == later["total_count"] == server.metadata_store.count()
+
+    typed = client.get("/files", params={"limit": 5, "file_type": "documents"}).json()
+    assert typed["total_count"] == documents
+
+
+def test_invalid_cursor(client):
+    assert client.get("/files", params={"cursor": "not-a-cursor"}).status_code == 400
@@ -0,0 +1,81 @@
+"""Downloads: validators, ranges and the open-descriptor pool"""
+
+import threading
+
+import pytest
+
+DATA = bytes(range(256)) * 4
+
+
+@pytest.fixture(scope="module")
+def stored(client):
+    response = client.post("/upload", files={"file": ("data.txt", DATA, "text/plain")})
+    assert response.status_code == 200, response.text
+    return response.json()["file_id"]
+
+
+def test_full_download_carries_validators(client, stored):
+    response = client.get(f"/files/{stored}")
+    assert response.status_code == 200
+    assert response.content == DATA
+    assert response.headers["Accept-Ranges"] == "bytes"
+    assert response.headers["ETag"].startswith('"')
+
+    etag = response.headers["ETag"]
+    assert client.get(f"/files/{stored}", headers={"If-None-Match": etag}).status_code == 304
+    assert client.get(f"/files/{stored}", headers={"If-None-Match": '"other"'}).status_code == 200
+
+
+def test_ranges(client, stored):
+    etag = client.get(f"/files/{stored}").headers["ETag"]
+
+    response = client.get(f"/files/{stored}", headers={"Range": "bytes=2-5"})
+    assert response.status_code == 206
+    assert response.content == DATA[2:6]
+    assert response.headers["Content-Range"] == f"bytes 2-5/{len(DATA)}"
+
+    response = client.get(f"/files/{stored}", headers={"Range": "bytes=-4", "If-Range": etag})
+    assert response.status_code == 206
+    assert response.content == DATA[-4:]
+
+    # The client's copy is stale: it gets the whole file instead of a piece
+    response = client.get(f"/files/{stored}", headers={"Range": "bytes=2-5", "If-Range": '"stale"'})
+    assert response.status_code == 200
+    assert response.content == DATA
+
+    response = client.get(f"/files/{stored}", headers={"Range": f"bytes={len(DATA)}-"})
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == f"bytes */{len(DATA)}"
+
+
+def test_pool_opens_files_off_the_event_loop(server, client, monkeypatch):
+    pool = server.file_pool
+    file_id = client.post("/upload", files={"file": ("pooled.txt", b"pooled", "text/plain")}).json()["file_id"]
+    threads = {"pooled": [], "opened": []}
+    acquire_pooled, acquire = pool.acquire_pooled, pool.acquire
+    monkeypatch.setattr(pool, "acquire_pooled",
+                        lambda *args: threads["pooled"].append(threading.get_ident()) or acquire_pooled(*args))
+    monkeypatch.setattr(pool, "acquire",
+                        lambda *args: threads["opened"].append(threading.get_ident()) or acquire(*args))
+
+    assert client.get(f"/files/{file_id}").content == b"pooled"
+    assert client.get(f"/files/{file_id}").content == b"pooled"
+    # Both lookups ran on the event loop; only the first needed an open, on another thread
+    assert len(threads["pooled"]) == 2 and len(set(threads["pooled"])) == 1
+    assert len(threads["opened"]) == 1
+    assert threads["opened"][0] != threads["pooled"][0]
+
+    path = str(server.file_index.get(file_id).path)
+    assert path in pool._entries
+    assert client.delete(f"/files/{file_id}").status_code == 200
+    assert path not in pool._entries
+
+
+def test_range_of_a_file_deleted_after_lookup_is_not_found(server, client):
+    file_id = client.post("/upload", files={"file": ("gone.txt", DATA, "text/plain")}).json()["file_id"]
+    # Still indexed, but the file went away (another worker deleted it)
+    server.file_index.get(file_id).path.unlink()
+
+    response = client.get(f"/files/{file_id}", headers={"Range": "bytes=2-5"})
+    assert response.status_code == 404
+    assert "Content-Range" not in response.headers
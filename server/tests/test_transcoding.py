@@ -0,0 +1,115 @@
+"""Accept-negotiated WebP/AVIF copies of stored images"""
+
+import time
+import asyncio
+
+import pytest
+
+from src.services.variants import TranscodeCache
+
+
+class Busy(Exception):
+    pass
+
+
+def transcode(cache, source, size, render):
+    async def run():
+        try:
+            await cache.schedule(source, "webp", size, render)
+        except Exception:
+            pass
+    asyncio.run(run())
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "image.png"
+    path.write_bytes(b"p" * 1000)
+    return path
+
+
+def test_failed_transcode_is_not_attempted_again(source):
+    cache = TranscodeCache({"webp": ".webp"}, transient_errors=(Busy,))
+
+    async def broken(dest):
+        raise OSError("cannot encode")
+
+    transcode(cache, source, 1000, broken)
+    assert not cache.wanted(source, "webp")
+    assert cache.lookup(source, "webp", 1000) == (None, None)
+
+
+def test_busy_pool_is_not_remembered(source):
+    cache = TranscodeCache({"webp": ".webp"}, transient_errors=(Busy,))
+
+    async def busy(dest):
+        raise Busy()
+
+    transcode(cache, source, 1000, busy)
+    assert cache.wanted(source, "webp")
+
+
+def test_larger_copy_is_dropped_and_remembered(source):
+    cache = TranscodeCache({"webp": ".webp"})
+
+    async def larger(dest):
+        dest.write_bytes(b"w" * 2000)
+        return 2000
+
+    transcode(cache, source, 1000, larger)
+    assert not cache.path_for(source, "webp").exists()
+    assert not cache.wanted(source, "webp")
+    assert cache.lookup(source, "webp", 1000) == (None, None)
+
+
+def test_usable_copy_is_served_from_memory(source, monkeypatch):
+    cache = TranscodeCache({"webp": ".webp"})
+
+    async def smaller(dest):
+        dest.write_bytes(b"w" * 100)
+        return 100
+
+    transcode(cache, source, 1000, smaller)
+    monkeypatch.setattr("src.services.variants.os.stat", lambda path: pytest.fail("stat on lookup"))
+    path, stat = cache.lookup(source, "webp", 1000)
+    assert path == cache.path_for(source, "webp") and stat.st_size == 100
+
+    cache.forget(source)
+    assert cache.wanted(source, "webp")
+
+
+def test_copy_made_by_another_process_is_adopted(source):
+    cache = TranscodeCache({"webp": ".webp"})
+    cache.path_for(source, "webp").write_bytes(b"w" * 10)
+    path, stat = cache.lookup(source, "webp", 1000)
+    assert stat.st_size == 10 and not cache.wanted(source, "webp")
+
+
+def wait_for_transcodes(server, timeout=10):
+    deadline = time.monotonic() + timeout
+    while server.transcode_cache._inflight and time.monotonic() < deadline:
+        time.sleep(0.02)
+
+
+def test_negotiated_requests_use_their_own_pool(server, client, image_bytes, monkeypatch):
+    if not server.NEGOTIABLE_FORMATS:
+        pytest.skip("Pillow built without WebP/AVIF")
+    fmt = server.NEGOTIABLE_FORMATS[0]
+    data = image_bytes(size=(300, 200), seed=3001)
+    file_id = client.post("/upload", files={"file": ("t.png", data, "image/png")}).json()["file_id"]
+
+    jobs = []
+    run = server.transcode_processor.run
+    monkeypatch.setattr(server.transcode_processor, "run", lambda func, *args: jobs.append(args) or run(func, *args))
+    # Uploads' pool is full; negotiated requests must neither wait for it nor take from it
+    monkeypatch.setattr(server.image_processor, "_pending", 1000)
+    assert server.image_processor.saturated and not server.transcode_processor.saturated
+
+    headers = {"accept": f"image/{fmt},image/*"}
+    first = client.get(f"/files/{file_id}.png", headers=headers)
+    assert first.status_code == 200 and first.content == data
+    wait_for_transcodes(server)
+    for _ in range(3):
+        client.get(f"/files/{file_id}.png", headers=headers)
+        wait_for_transcodes(server)
+    assert len(jobs) == 1
@@ -0,0 +1,149 @@
+"""Streaming multipart ingest (POST /upload, POST /upload/batch)"""
+
+import asyncio
+import hashlib
+
+import pytest
+
+from src.services.upload_pipeline import (
+    MultipartUploadParser, MultipartError, TooManyFiles, UploadTooLarge, TEMP_PREFIX
+)
+
+BOUNDARY = "test-boundary"
+
+
+def multipart_body(parts):
+    """Encode (field, filename, data) parts; filename None makes a plain form field"""
+    body = b""
+    for field, filename, data in parts:
+        disposition = f'form-data; name="{field}"'
+        if filename is not None:
+            disposition += f'; filename="{filename}"'
+        body += (f"--{BOUNDARY}\r\nContent-Disposition: {disposition}\r\n"
+                 "Content-Type: application/octet-stream\r\n\r\n").encode() + data + b"\r\n"
+    return body + f"--{BOUNDARY}--\r\n".encode()
+
+
+async def chunked(body, size):
+    for i in range(0, len(body), size):
+        yield body[i:i + size]
+
+
+def parse(tmp_path, body, chunk_size=1000, **kwargs):
+    parser = MultipartUploadParser(tmp_path, kwargs.pop("max_size", 10 * 1024 * 1024), **kwargs)
+    headers = {"content-type": f"multipart/form-data; boundary={BOUNDARY}"}
+    return asyncio.run(parser.parse(headers, chunked(body, chunk_size)))
+
+
+def spool_files(directory):
+    return sorted(path.name for path in directory.iterdir() if path.name.startswith(TEMP_PREFIX))
+
+
+def test_file_part_is_spooled_once_with_hash_and_size(tmp_path):
+    data = bytes(range(256)) * 9000  # a few MB, spanning several disk writes
+    files = parse(tmp_path, multipart_body([("note", None, b"ignored"), ("file", "a.png", data)]))
+
+    assert [f.filename for f in files] == ["a.png"]
+    spooled = files[0].spooled
+    assert spooled.size == len(data)
+    assert spooled.sha256 == hashlib.sha256(data).hexdigest()
+    assert spooled.temp_path.read_bytes() == data
+    # The spool file is the only copy on disk
+    assert spool_files(tmp_path) == [spooled.temp_path.name]
+
+
+def test_strict_oversize_fails_and_leaves_nothing_behind(tmp_path):
+    with pytest.raises(UploadTooLarge):
+        parse(tmp_path, multipart_body([("file", "a.png", b"x" * 5000)]), max_size=4096)
+    assert spool_files(tmp_path) == []
+
+
+def test_lenient_oversize_is_flagged_and_later_parts_kept(tmp_path):
+    body = multipart_body([("files", "big.png", b"x" * 5000), ("files", "small.png", b"y" * 10)])
+    big, small = parse(tmp_path, body, max_size=4096, field_name="files", max_files=5, strict=False)
+
+    assert big.too_large and big.spooled is None
+    assert small.spooled.temp_path.read_bytes() == b"y" * 10
+    assert spool_files(tmp_path) == [small.spooled.temp_path.name]
+
+
+def test_refused_parts_store_no_data(tmp_path):
+    files = parse(tmp_path, multipart_body([("file", "run.exe", b"MZ" * 100)]),
+                  accept=lambda name: not name.endswith(".exe"))
+    assert not files[0].accepted and files[0].spooled is None
+    assert spool_files(tmp_path) == []
+
+
+def test_too_many_files(tmp_path):
+    body = multipart_body([("files", f"{i}.png", b"x") for i in range(3)])
+    with pytest.raises(TooManyFiles):
+        parse(tmp_path, body, field_name="files", max_files=2, strict=False)
+    assert spool_files(tmp_path) == []
+
+
+def test_truncated_body_is_rejected(tmp_path):
+    body = multipart_body([("file", "a.png", b"x" * 5000)])
+    with pytest.raises(MultipartError):
+        parse(tmp_path, body[:2000])
+    assert spool_files(tmp_path) == []
+
+
+def test_upload_round_trip(client, image_bytes):
+    data = image_bytes(seed=1001)
+    response = client.post("/upload", files={"file": ("photo.png", data, "image/png")})
+    assert response.status_code == 200, response.text
+    file_id = response.json()["file_id"]
+
+    served = client.get(f"/files/{file_id}")
+    assert served.status_code == 200
+    assert served.content == data
+
+
+def test_upload_rejects_non_multipart_and_disallowed_types(client):
+    assert client.post("/upload", content=b"raw", headers={"content-type": "application/octet-stream"}).status_code == 400
+    assert client.post("/upload", files={"file": ("run.exe", b"MZ", "application/octet-stream")}).status_code == 400
+    assert client.post("/upload", files={"other": ("a.png", b"x", "image/png")}).status_code == 400
+
+
+def stored_files(server):
+    return set(server.Config.FILES_DIR.iterdir())
+
+
+def failing_save(entries):
+    raise RuntimeError("database is locked")
+
+
+def test_failed_registration_leaves_no_files(server, client, image_bytes, monkeypatch):
+    before = stored_files(server)
+    monkeypatch.setattr(server.metadata_store, "save_many_with_blobs", failing_save)
+
+    response = client.post("/upload", files={"file": ("photo.png", image_bytes(seed=1002), "image/png")})
+    assert response.status_code == 500
+
+    response = client.post("/upload/batch", files=[
+        ("files", ("a.png", image_bytes(seed=1003), "image/png")),
+        ("files", ("b.txt", b"notes", "text/plain")),
+    ])
+    assert response.status_code == 200
+    assert [(item["success"], item["status_code"]) for item in response.json()["results"]] == [(False, 500)] * 2
+    assert stored_files(server) == before
+
+
+def test_saturated_pool_refuses_image_batches_up_front(server, client, image_bytes, monkeypatch):
+    before = stored_files(server)
+    monkeypatch.setattr(server.image_processor, "_pending", 1000)
+    monkeypatch.setattr(server.metadata_store, "find_blob", lambda sha256: pytest.fail("batch was processed"))
+
+    response = client.post("/upload/batch", files=[
+        ("files", ("a.txt", b"first", "text/plain")),
+        ("files", ("b.png", image_bytes(seed=1004), "image/png")),
+    ])
+    assert response.status_code == 503
+    assert "Retry-After" in response.headers
+    assert stored_files(server) == before
+
+    # Nothing in a batch of documents needs the pool
+    monkeypatch.undo()
+    monkeypatch.setattr(server.image_processor, "_pending", 1000)
+    response = client.post("/upload/batch", files=[("files", ("c.txt", b"second", "text/plain"))])
+    assert response.json()["uploaded"] == 1
@@ -0,0 +1,186 @@
+"""Resumable upload sessions: resuming, locking against other workers, garbage collection"""
+
+import io
+import os
+import time
+import fcntl
+import hashlib
+
+import anyio
+import pytest
+from PIL import Image
+
+from src.services.metadata_store import MetadataStore
+from src.services.upload_sessions import (
+    UploadSessionManager, SessionNotFound, OffsetMismatch, ORPHAN_PART_AGE
+)
+
+
+@pytest.fixture
+def sessions(tmp_path):
+    return UploadSessionManager(MetadataStore(tmp_path / "metadata.db"), tmp_path / "sessions",
+                                ttl=60, max_size=1024)
+
+
+async def body(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+def held_by_another_worker(sessions, session_id):
+    """A separate open file description flocked, as another process would hold it"""
+    part = open(sessions.part_path(session_id), "rb")
+    fcntl.flock(part.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    return part
+
+
+def test_upload_resumes_and_finalizes(client, image_bytes):
+    data = image_bytes(seed=1301)
+    response = client.post("/upload/sessions", json={"filename": "resumed.png", "size": len(data)})
+    assert response.status_code == 201
+    session_url = response.headers["Location"]
+
+    half = len(data) // 2
+    assert client.put(session_url, content=data[:half], headers={"Upload-Offset": "0"}).status_code == 200
+    # A resend of the same chunk is told where to continue
+    stale = client.put(session_url, content=data[:half], headers={"Upload-Offset": "0"})
+    assert stale.status_code == 409
+    assert stale.headers["Upload-Offset"] == str(half)
+    assert client.get(session_url).json()["offset"] == half
+
+    assert client.put(session_url, content=data[half:], headers={"Upload-Offset": str(half)}).status_code == 200
+    response = client.post(f"{session_url}/finalize")
+    assert response.status_code == 200
+    assert client.get(response.json()["url"]).content == data
+    assert client.get(session_url).status_code == 404
+
+
+def test_finalize_and_abort_wait_for_another_worker(client, server, image_bytes):
+    data = image_bytes(seed=1302)
+    session_id = client.post("/upload/sessions", json={"filename": "contended.png", "size": len(data)}).json()["session_id"]
+    client.put(f"/upload/sessions/{session_id}", content=data, headers={"Upload-Offset": "0"})
+
+    part = held_by_another_worker(server.upload_sessions, session_id)
+    try:
+        for response in (client.post(f"/upload/sessions/{session_id}/finalize"),
+                         client.delete(f"/upload/sessions/{session_id}")):
+            assert response.status_code == 503
+            assert response.headers["Retry-After"] == "1"
+    finally:
+        part.close()
+
+    assert client.get(f"/upload/sessions/{session_id}").json()["offset"] == len(data)
+    assert client.post(f"/upload/sessions/{session_id}/finalize").status_code == 200
+
+
+def received_session(client, data, filename):
+    session = client.post("/upload/sessions", json={
+        "filename": filename, "size": len(data), "sha256": hashlib.sha256(data).hexdigest()
+    }).json()
+    client.put(f"/upload/sessions/{session['session_id']}", content=data, headers={"Upload-Offset": "0"})
+    return f"/upload/sessions/{session['session_id']}"
+
+
+def test_finalize_is_retried_after_the_pool_fills_up(client, server, image_bytes, monkeypatch):
+    data = image_bytes(size=(2100, 60), seed=1303)
+    session_url = received_session(client, data, "busy.png")
+
+    # The pool has room when finalize checks, and is full by the time the resize is queued
+    find_blob = server.metadata_store.find_blob
+    def fill_pool_then_find_blob(sha256):
+        server.image_processor._pending += 1000
+        return find_blob(sha256)
+    monkeypatch.setattr(server.metadata_store, "find_blob", fill_pool_then_find_blob)
+    response = client.post(f"{session_url}/finalize")
+    assert response.status_code == 503
+    monkeypatch.undo()
+    server.image_processor._pending -= 1000
+
+    assert client.get(session_url).json()["offset"] == len(data)
+    response = client.post(f"{session_url}/finalize")
+    assert response.status_code == 200, response.text
+    with Image.open(io.BytesIO(client.get(response.json()["url"]).content)) as stored:
+        assert stored.width == 2048
+
+
+def test_finalize_is_retried_after_registration_fails(client, server, image_bytes, monkeypatch):
+    # Resized after linking into place: the part file must keep the original bytes
+    data = image_bytes(size=(2100, 60), seed=1304)
+    session_url = received_session(client, data, "failed.png")
+
+    def failing_save(entries):
+        raise RuntimeError("database is locked")
+    monkeypatch.setattr(server.metadata_store, "save_many_with_blobs", failing_save)
+    assert client.post(f"{session_url}/finalize").status_code == 500
+    monkeypatch.undo()
+
+    response = client.post(f"{session_url}/finalize")
+    assert response.status_code == 200, response.text
+    assert client.get(session_url).status_code == 404
+
+
+def test_append_reports_offset_while_another_worker_writes(sessions):
+    session_id = sessions.create("a.bin", 4)["session_id"]
+    part = held_by_another_worker(sessions, session_id)
+    try:
+        with pytest.raises(OffsetMismatch):
+            anyio.run(sessions.append, session_id, 0, body(b"ab"))
+    finally:
+        part.close()
+    assert anyio.run(sessions.append, session_id, 0, body(b"ab"))["offset"] == 2
+
+
+def test_abort_waits_for_an_append_in_progress(sessions):
+    session_id = sessions.create("a.bin", 4)["session_id"]
+
+    async def main():
+        appended = anyio.Event()
+
+        async def slow_body():
+            yield b"ab"
+            appended.set()
+            await anyio.sleep(0.05)
+            yield b"cd"
+
+        async with anyio.create_task_group() as tasks:
+            tasks.start_soon(sessions.append, session_id, 0, slow_body())
+            await appended.wait()
+            assert await sessions.abort(session_id)
+            # The append finished before the abort removed the data
+            assert not sessions.part_path(session_id).exists()
+
+    anyio.run(main)
+    assert sessions._locks == {}
+
+
+def test_garbage_collection(sessions):
+    expired = sessions.create("expired.bin", 4)["session_id"]
+    busy = sessions.create("busy.bin", 4)["session_id"]
+    live = sessions.create("live.bin", 4)["session_id"]
+    for session_id in (expired, busy):
+        sessions.store.touch_session(session_id, time.time() - 1)
+
+    # Parts without a session: one create() is setting up right now, one left behind long ago
+    fresh_orphan = sessions.part_path("fresh")
+    old_orphan = sessions.part_path("old")
+    fresh_orphan.touch()
+    old_orphan.touch()
+    stale = time.time() - ORPHAN_PART_AGE - 1
+    os.utime(old_orphan, (stale, stale))
+
+    part = held_by_another_worker(sessions, busy)
+    try:
+        assert sessions.collect_garbage() == 2
+    finally:
+        part.close()
+
+    assert not sessions.part_path(expired).exists()
+    assert sessions.store.load_session(expired) is None
+    assert sessions.part_path(busy).exists()
+    assert sessions.part_path(live).exists()
+    assert fresh_orphan.exists()
+    assert not old_orphan.exists()
+
+    assert sessions.collect_garbage() == 1
+    with pytest.raises(SessionNotFound):
+        sessions.get(busy)
@@ -0,0 +1,95 @@
+"""Variant cache shared by several worker processes"""
+
+import os
+import time
+import threading
+
+import anyio
+import pytest
+from PIL import Image
+
+from src.services.image_processing import render_variant
+from src.services.variants import VariantCache, STALE_TEMP_AGE
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "source.png"
+    Image.new("RGB", (400, 300), (10, 120, 200)).save(path)
+    return path
+
+
+def write(path, size, age=0):
+    path.write_bytes(b"x" * size)
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_concurrent_renders_of_one_variant_do_not_collide(source, tmp_path):
+    target = tmp_path / "variants" / "source_100x100.jpg"
+    target.parent.mkdir()
+    errors = []
+
+    def render():
+        try:
+            for _ in range(10):
+                render_variant(source, target, (100, 100))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=render) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert [path.name for path in target.parent.iterdir()] == [target.name]
+    with Image.open(target) as img:
+        assert img.size == (100, 75)
+
+
+def test_variant_rendered_by_another_worker_is_adopted(source, tmp_path):
+    directory = tmp_path / "variants"
+    first, second = VariantCache(directory, 10_000, workers=2), VariantCache(directory, 10_000, workers=2)
+    rendered = []
+
+    async def render(path):
+        rendered.append(path)
+        return render_variant(source, path, (50, 50))
+
+    path = anyio.run(first.get_or_create, "source_50x50.jpg", render)
+    assert anyio.run(second.get_or_create, "source_50x50.jpg", render) == path
+    assert len(rendered) == 1
+    assert second.total_bytes == path.stat().st_size
+    # Its budget share applies to what it adopted
+    assert second.max_bytes == 5_000
+
+
+def test_startup_leaves_other_workers_files_alone(tmp_path):
+    directory = tmp_path / "variants"
+    directory.mkdir()
+    variants = [write(directory / f"v{i}_10x10.jpg", 1_000, age=100 - i) for i in range(6)]
+    in_progress = write(directory / ".v9_10x10.jpg.abc.tmp", 500)
+    abandoned = write(directory / ".v8_10x10.jpg.def.tmp", 500, age=STALE_TEMP_AGE + 1)
+
+    workers = [VariantCache(directory, 8_000, workers=2) for _ in range(2)]
+    for worker in workers:
+        assert worker.load() == 0
+
+    # Under the whole budget, though each worker's share is smaller: nothing is trimmed
+    assert all(path.exists() for path in variants)
+    assert in_progress.exists()
+    assert not abandoned.exists()
+
+
+def test_startup_trims_to_the_whole_budget_oldest_first(tmp_path):
+    directory = tmp_path / "variants"
+    directory.mkdir()
+    variants = [write(directory / f"v{i}_10x10.jpg", 1_000, age=100 - i) for i in range(6)]
+
+    cache = VariantCache(directory, 4_000)
+    assert cache.load() == 4
+    assert [path.exists() for path in variants] == [False, False, True, True, True, True]
+    assert cache.total_bytes == 4_000